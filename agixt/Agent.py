@@ -23,6 +23,8 @@ from Providers import Providers
 from Extensions import Extensions
 from Globals import getenv, get_tokens, DEFAULT_SETTINGS, DEFAULT_USER
 from MagicalAuth import MagicalAuth, get_user_id
+from IdentityCache import invalidate_agent, resolve_agent_id, resolve_user_id
+from AgentConfigCache import agent_configs, invalidate_agent_configs
 from agixtsdk import AGiXTSDK
 from fastapi import HTTPException
 from datetime import datetime, timezone, timedelta
@@ -33,14 +35,26 @@ import base64
 import jwt
 import os
 import re
+import threading
+import time
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
     format=getenv("LOG_FORMAT"),
 )
 
+# Seconds an impersonation token is reused, well within its one day expiry
+IMPERSONATION_TOKEN_TTL = int(getenv("IMPERSONATION_TOKEN_TTL", "3600"))
+_impersonation_tokens = {}
+_impersonation_tokens_lock = threading.Lock()
+
 
 def impersonate_user(user_id: str):
+    now = time.monotonic()
+    with _impersonation_tokens_lock:
+        cached = _impersonation_tokens.get(str(user_id))
+    if cached and cached[1] > now:
+        return cached[0]
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
     # Get users email
     session = get_session()
@@ -60,6 +74,8 @@ def impersonate_user(user_id: str):
         AGIXT_API_KEY,
         algorithm="HS256",
     )
+    with _impersonation_tokens_lock:
+        _impersonation_tokens[user_id] = (token, now + IMPERSONATION_TOKEN_TTL)
     return token
 
 
@@ -83,8 +99,7 @@ def add_agent(agent_name, provider_settings=None, commands=None, user=DEFAULT_US
                 .first()
             )
             i += 1
-    user_data = session.query(User).filter(User.email == user).first()
-    user_id = user_data.id
+    user_id = get_user_id(user)
 
     if provider_settings is None or provider_settings == "" or provider_settings == {}:
         provider_settings = DEFAULT_SETTINGS
@@ -130,8 +145,7 @@ def add_agent(agent_name, provider_settings=None, commands=None, user=DEFAULT_US
 
 def delete_agent(agent_name, user=DEFAULT_USER):
     session = get_session()
-    user_data = session.query(User).filter(User.email == user).first()
-    user_id = user_data.id
+    user_id = get_user_id(user)
     agent = (
         session.query(AgentModel)
         .filter(AgentModel.name == agent_name, AgentModel.user_id == user_id)
@@ -177,13 +191,14 @@ def delete_agent(agent_name, user=DEFAULT_USER):
     session.delete(agent)
     session.commit()
     session.close()
+    invalidate_agent(user_id, agent_name)
+    invalidate_agent_configs()
     return {"message": f"Agent {agent_name} deleted."}, 200
 
 
 def rename_agent(agent_name, new_name, user=DEFAULT_USER):
     session = get_session()
-    user_data = session.query(User).filter(User.email == user).first()
-    user_id = user_data.id
+    user_id = get_user_id(user)
     agent = (
         session.query(AgentModel)
         .filter(AgentModel.name == agent_name, AgentModel.user_id == user_id)
@@ -195,28 +210,30 @@ def rename_agent(agent_name, new_name, user=DEFAULT_USER):
     agent.name = new_name
     session.commit()
     session.close()
+    invalidate_agent(user_id, agent_name)
+    invalidate_agent_configs()
     return {"message": f"Agent {agent_name} renamed to {new_name}."}, 200
 
 
 def get_agents(user=DEFAULT_USER, company=None):
     session = get_session()
-    user_data = session.query(User).filter(User.email == user).first()
+    user_id = get_user_id(user)
     try:
         default_agent_id = str(
             session.query(UserPreferences)
-            .filter(UserPreferences.user_id == user_data.id)
+            .filter(UserPreferences.user_id == user_id)
             .filter(UserPreferences.pref_key == "agent_id")
             .first()
             .pref_value
         )
     except:
         default_agent_id = ""
-    agents = session.query(AgentModel).filter(AgentModel.user_id == user_data.id).all()
+    agents = session.query(AgentModel).filter(AgentModel.user_id == user_id).all()
     if default_agent_id == "":
         # Add a user preference of the first agent's ID in the agent list
         if agents:
             user_preference = UserPreferences(
-                user_id=user_data.id, pref_key="agent_id", pref_value=agents[0].id
+                user_id=user_id, pref_key="agent_id", pref_value=agents[0].id
             )
             session.add(user_preference)
             session.commit()
@@ -244,7 +261,7 @@ def get_agents(user=DEFAULT_USER, company=None):
             if company_id != company:
                 continue
         if not company_id:
-            auth = MagicalAuth(token=impersonate_user(user_id=str(user_data.id)))
+            auth = MagicalAuth(token=impersonate_user(user_id=str(user_id)))
             company_id = str(auth.company_id)
             # update agent settings
             agent_setting = AgentSettingModel(
@@ -254,6 +271,7 @@ def get_agents(user=DEFAULT_USER, company=None):
             )
             session.add(agent_setting)
             session.commit()
+            invalidate_agent_configs()
         output.append(
             {
                 "name": agent.name,
@@ -384,9 +402,14 @@ class Agent:
             if str(self.company_id).lower() == "none":
                 self.company_id = None
         self.PROVIDER_SETTINGS["company_id"] = self.company_id
-        self.company_agent = None
-        if self.company_id and str(self.company_id).lower() != "none":
-            self.company_agent = self.get_company_agent()
+        self._company_agent = None
+
+    @property
+    def company_agent(self):
+        """The company's agent, only built once something needs it"""
+        if self._company_agent is None and str(self.company_id).lower() != "none":
+            self._company_agent = self.get_company_agent()
+        return self._company_agent
 
     def get_company_agent(self):
         if self.company_id:
@@ -467,6 +490,23 @@ class Agent:
         return agent_settings
 
     def get_agent_config(self):
+        agent_id = resolve_agent_id(self.user_id, self.agent_name)
+        generation = agent_configs.generation
+        if agent_id:
+            config = agent_configs.get(agent_id)
+            if config is not None:
+                self.agent_id = str(agent_id)
+                company_id = config["settings"].get("company_id")
+                if company_id:
+                    self.company_id = company_id
+                return config
+        config = self.load_agent_config()
+        # Agents without a company are assigned one on load, cache them afterwards
+        if self.agent_id and config["settings"].get("company_id"):
+            agent_configs.set(self.agent_id, config, generation)
+        return config
+
+    def load_agent_config(self):
         session = get_session()
         agent = (
             session.query(AgentModel)
@@ -563,7 +603,10 @@ class Agent:
             )
         output_tokens = get_tokens(answer)
         self.auth.increase_token_counts(
-            input_tokens=input_tokens, output_tokens=output_tokens
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            agent_id=self.agent_id,
+            provider=provider_name,
         )
         answer = str(answer).replace("\_", "_")
         if answer.endswith("\n\n"):
@@ -589,7 +632,10 @@ class Agent:
             )
         output_tokens = get_tokens(answer)
         self.auth.increase_token_counts(
-            input_tokens=input_tokens, output_tokens=output_tokens
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            agent_id=self.agent_id,
+            provider=provider_name,
         )
         answer = str(answer).replace("\_", "_")
         if answer.endswith("\n\n"):
@@ -722,6 +768,7 @@ class Agent:
     def update_agent_config(self, new_config, config_key):
         logging.info(f"Updating {config_key} with {json.dumps(new_config)}.")
         session = get_session()
+        changed = False
         try:
             agent = (
                 session.query(AgentModel)
@@ -736,14 +783,11 @@ class Agent:
                     logging.info(f"Agent {self.agent_name} not found for update.")
                     return f"Agent {self.agent_name} not found for update."
                 # Check if it is a global agent and copy it if necessary
-                global_user = (
-                    session.query(User).filter(User.email == DEFAULT_USER).first()
-                )
                 global_agent = (
                     session.query(AgentModel)
                     .filter(
                         AgentModel.name == self.agent_name,
-                        AgentModel.user_id == global_user.id,
+                        AgentModel.user_id == get_user_id(DEFAULT_USER),
                     )
                     .first()
                 )
@@ -824,6 +868,7 @@ class Agent:
                     except:
                         agent_command = None
 
+                    changed = True
                     if agent_command:
                         agent_command.state = enabled
                     else:
@@ -841,6 +886,7 @@ class Agent:
                         .first()
                     )
                     if agent_setting:
+                        changed = True
                         logging.info(
                             f"Found existing agent setting {setting_name} for {self.agent_name} with value {str(agent_setting.value)}."
                         )
@@ -856,6 +902,7 @@ class Agent:
                             agent_setting.value = str(setting_value)
                     else:
                         if setting_value:
+                            changed = True
                             logging.info(
                                 f"Creating new agent setting {setting_name} for {self.agent_name} with value {str(setting_value)}."
                             )
@@ -885,7 +932,8 @@ class Agent:
             )
         finally:
             session.close()
-
+        if changed:
+            invalidate_agent_configs()
         return f"Agent {self.agent_name} configuration updated."
 
     def get_browsed_links(self, conversation_id=None):
@@ -998,28 +1046,13 @@ class Agent:
         return f"Link {url} deleted from browsed links."
 
     def get_agent_id(self):
-        session = get_session()
-        agent = (
-            session.query(AgentModel)
-            .filter(
-                AgentModel.name == self.agent_name, AgentModel.user_id == self.user_id
-            )
-            .first()
-        )
-        if not agent:
-            agent = (
-                session.query(AgentModel)
-                .filter(
-                    AgentModel.name == self.agent_name,
-                    AgentModel.user.has(email=DEFAULT_USER),
-                )
-                .first()
-            )
-            session.close()
-            if not agent:
+        agent_id = resolve_agent_id(self.user_id, self.agent_name)
+        if not agent_id:
+            default_user_id = resolve_user_id(DEFAULT_USER)
+            if not default_user_id:
                 return None
-        session.close()
-        return agent.id
+            agent_id = resolve_agent_id(default_user_id, self.agent_name)
+        return agent_id
 
     def get_conversation_tasks(self, conversation_id: str) -> str:
         """Get all tasks assigned to an agent"""
@@ -0,0 +1,91 @@
+import copy
+import logging
+import threading
+import time
+from typing import Dict, Optional
+from Globals import getenv
+from IdentityCache import SharedCacheVersion
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Seconds an agent configuration snapshot is served before it is rebuilt
+AGENT_CONFIG_CACHE_TTL = int(getenv("AGENT_CONFIG_CACHE_TTL", "300"))
+AGENT_CONFIG_CACHE_VERSION_NAME = "agent_config"
+
+
+class AgentConfigCache:
+    """
+    Snapshots of merged agent configurations keyed by agent id.
+
+    A snapshot is what Agent.get_agent_config assembles from the agent's settings and
+    commands, the user's registration requirement preferences and the settings the
+    agent inherits from its company agent, so warm agents are built without a query.
+
+    Company agent settings flow into every member agent, so any change drops all
+    snapshots rather than one, and bumps the shared "agent_config" version so other
+    workers drop theirs on their next check.
+    """
+
+    def __init__(self, ttl: int = AGENT_CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[str, tuple] = {}
+        self.generation = 0
+        self.version = SharedCacheVersion(AGENT_CONFIG_CACHE_VERSION_NAME)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, agent_id) -> Optional[dict]:
+        """A private copy of the agent's snapshot, or None when it has to be loaded"""
+        if self.version.changed():
+            self.clear()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(str(agent_id))
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            config = entry[0]
+        return copy.deepcopy(config)
+
+    def set(self, agent_id, config: dict, generation: int):
+        """Store a snapshot loaded while `generation` was current, unless it went stale"""
+        snapshot = copy.deepcopy(config)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[str(agent_id)] = (snapshot, time.monotonic() + self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def invalidate(self):
+        self.clear()
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+agent_configs = AgentConfigCache()
+
+
+def invalidate_agent_configs():
+    agent_configs.invalidate()
+
+
+def get_agent_config_cache_metrics() -> dict:
+    return agent_configs.metrics()
@@ -17,100 +17,261 @@ from Globals import getenv, DEFAULT_USER
 from Prompts import Prompts
 from Extensions import Extensions
 from MagicalAuth import get_user_id
+from ChainPlans import get_chain_plan
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 import logging
 import asyncio
+import re
+import threading
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
     format=getenv("LOG_FORMAT"),
 )
+# Steps of one chain run that may execute at the same time
+CHAIN_STEP_CONCURRENCY = int(getenv("CHAIN_STEP_CONCURRENCY", "4"))
+# Longest a step waits for a dependency before checking the database again, for
+# responses written by other workers
+CHAIN_DEPENDENCY_CHECK_SECONDS = float(getenv("CHAIN_DEPENDENCY_CHECK_SECONDS", "5"))
+# Milliseconds recorded step responses of a run are gathered before they are written
+CHAIN_RESPONSE_FLUSH_MS = float(getenv("CHAIN_RESPONSE_FLUSH_MS", "100"))
+STEP_REFERENCE = re.compile(r"\{STEP(\d+)\}")
+STEP_PLACEHOLDER = re.compile(r"\{(user_input|agent_name|STEP(\d+))\}")
 
 
-class Chain:
-    def __init__(self, user=DEFAULT_USER):
-        self.user = user
-        self.user_id = get_user_id(self.user)
+@lru_cache(maxsize=1024)
+def compile_step_template(text: str) -> Tuple[tuple, ...]:
+    """
+    Split step content into literal text and placeholders once.
 
-    def get_chain(self, chain_name):
-        session = get_session()
-        chain_name = chain_name.replace("%20", " ")
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        chain_db = (
-            session.query(ChainDB)
-            .filter(ChainDB.user_id == user_data.id, ChainDB.name == chain_name)
-            .first()
-        )
-        if chain_db is None:
-            chain_db = (
-                session.query(ChainDB)
-                .filter(
-                    ChainDB.name == chain_name,
-                    ChainDB.user_id == self.user_id,
-                )
-                .first()
-            )
-        if chain_db is None:
-            session.close()
-            return []
-        chain_steps = (
-            session.query(ChainStep)
-            .filter(ChainStep.chain_id == chain_db.id)
-            .order_by(ChainStep.step_number)
-            .all()
-        )
+    Parts are ("text", literal), ("user_input",), ("agent_name",) or ("step", n).
+    """
+    parts = []
+    position = 0
+    for match in STEP_PLACEHOLDER.finditer(text):
+        if match.start() > position:
+            parts.append(("text", text[position : match.start()]))
+        if match.group(2) is not None:
+            parts.append(("step", int(match.group(2)), match.group(0)))
+        else:
+            parts.append((match.group(1),))
+        position = match.end()
+    if position < len(text):
+        parts.append(("text", text[position:]))
+    return tuple(parts)
 
-        steps = []
-        for step in chain_steps:
-            agent_name = session.query(Agent).get(step.agent_id).name
-            prompt = {}
-            if step.target_chain_id:
-                prompt["chain_name"] = (
-                    session.query(ChainDB).get(step.target_chain_id).name
-                )
-            elif step.target_command_id:
-                prompt["command_name"] = (
-                    session.query(Command).get(step.target_command_id).name
-                )
-            elif step.target_prompt_id:
-                prompt["prompt_name"] = (
-                    session.query(Prompt).get(step.target_prompt_id).name
-                )
 
-            # Retrieve argument data for the step
-            arguments = (
-                session.query(Argument, ChainStepArgument)
-                .join(ChainStepArgument, ChainStepArgument.argument_id == Argument.id)
-                .filter(ChainStepArgument.chain_step_id == step.id)
-                .all()
+class StepCompletions:
+    """In-process wakeups for coroutines waiting on responses of a chain run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters: Dict[str, list] = {}
+
+    def subscribe(self, chain_run_id) -> asyncio.Event:
+        event = asyncio.Event()
+        with self.lock:
+            self.waiters.setdefault(str(chain_run_id), []).append(
+                (asyncio.get_running_loop(), event)
             )
+        return event
 
-            prompt_args = {}
-            for argument, chain_step_argument in arguments:
-                prompt_args[argument.name] = chain_step_argument.value
+    def unsubscribe(self, chain_run_id, event: asyncio.Event):
+        with self.lock:
+            waiters = self.waiters.get(str(chain_run_id), [])
+            waiters[:] = [waiter for waiter in waiters if waiter[1] is not event]
+            if not waiters:
+                self.waiters.pop(str(chain_run_id), None)
+
+    def notify(self, chain_run_id):
+        with self.lock:
+            waiters = list(self.waiters.get(str(chain_run_id), []))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiting loop has been closed
+                pass
 
-            prompt.update(prompt_args)
 
-            step_data = {
-                "step": step.step_number,
-                "agent_name": agent_name,
-                "prompt_type": step.prompt_type,
-                "prompt": prompt,
+step_completions = StepCompletions()
+
+
+class ChainRunContext:
+    """
+    Step outputs of one chain run, kept in memory for the life of the run.
+
+    Placeholders are filled from memory. The run's stored responses are loaded in
+    one query the first time a step that didn't run here is referenced, such as a
+    step before a resumed run's from_step. Recorded outputs are written to
+    ChainStepResponse in batches in the background, flush() waits for them.
+    """
+
+    def __init__(self, chain: "Chain", chain_name: str, chain_run_id):
+        self.chain = chain
+        self.chain_name = chain_name
+        self.chain_run_id = chain_run_id
+        self.outputs: Dict[int, object] = {}
+        self.stored_loaded = False
+        self.pending: Dict[int, object] = {}
+        self.writer: Optional[asyncio.Task] = None
+        self.write_lock = asyncio.Lock()
+
+    def get(self, step_number):
+        step_number = int(step_number)
+        if step_number not in self.outputs and not self.stored_loaded:
+            self.stored_loaded = True
+            stored = self.chain.get_step_response(
+                chain_name=self.chain_name,
+                chain_run_id=self.chain_run_id,
+                step_number="all",
+            )
+            for number, responses in stored.items():
+                if responses and int(number) not in self.outputs:
+                    self.outputs[int(number)] = responses[0]
+        return self.outputs.get(step_number)
+
+    def render(self, text: str, user_input, agent_name) -> str:
+        values = []
+        for part in compile_step_template(text):
+            if part[0] == "text":
+                values.append(part[1])
+            elif part[0] == "user_input":
+                values.append(f"{user_input}")
+            elif part[0] == "agent_name":
+                values.append(f"{agent_name}")
+            else:
+                output = self.get(part[1])
+                # Steps without a response keep their placeholder
+                values.append(f"{output}" if output else part[2])
+        return "".join(values)
+
+    def substitute(self, prompt_content, user_input, agent_name):
+        """Fill {user_input}, {agent_name} and {STEPn} in a step's prompt in one pass"""
+        if isinstance(prompt_content, dict):
+            return {
+                arg: (
+                    self.render(value, user_input, agent_name)
+                    if isinstance(value, str)
+                    else value
+                )
+                for arg, value in prompt_content.items()
             }
-            steps.append(step_data)
+        if isinstance(prompt_content, str):
+            return self.render(prompt_content, user_input, agent_name)
+        return prompt_content
+
+    def record(self, step_number, response):
+        """Keep a step's output and write it with the next batch"""
+        if not response:
+            return
+        self.outputs[int(step_number)] = response
+        self.pending[int(step_number)] = response
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.ensure_future(self.write_soon())
+
+    async def write_soon(self):
+        await asyncio.sleep(CHAIN_RESPONSE_FLUSH_MS / 1000)
+        await self.write_pending()
+
+    async def write_pending(self):
+        async with self.write_lock:
+            while self.pending:
+                pending, self.pending = self.pending, {}
+                try:
+                    await asyncio.to_thread(
+                        self.chain.write_step_responses,
+                        chain_run_id=self.chain_run_id,
+                        chain_name=self.chain_name,
+                        responses=pending,
+                    )
+                except Exception as e:
+                    logging.error(
+                        f"Error writing {len(pending)} step responses of chain run {self.chain_run_id}: {e}"
+                    )
+                    for step_number, response in pending.items():
+                        self.pending.setdefault(step_number, response)
+                    return
+
+    async def flush(self):
+        """Write every recorded output that hasn't been written yet"""
+        if self.writer is not None and not self.writer.done():
+            await self.writer
+        await self.write_pending()
 
-        chain_data = {
-            "id": chain_db.id,
-            "chain_name": chain_db.name,
-            "steps": steps,
+
+def get_step_graph(
+    step_numbers: Iterable[int], dependencies: Dict[str, List[int]]
+) -> Dict[int, set]:
+    """
+    Steps each step has to wait for, limited to earlier steps of the same run.
+
+    References to later steps are ignored as they were when steps ran in order, which
+    also keeps the graph acyclic. Steps before a resumed run's from_step are not in
+    `step_numbers`, so their stored responses count as already available.
+    """
+    step_numbers = set(int(step_number) for step_number in step_numbers)
+    return {
+        step_number: {
+            int(dependency)
+            for dependency in dependencies.get(str(step_number), [])
+            if int(dependency) in step_numbers and int(dependency) < step_number
         }
-        session.close()
-        return chain_data
+        for step_number in step_numbers
+    }
+
+
+async def run_step_graph(
+    graph: Dict[int, set],
+    run_step: Callable[[int], Awaitable[object]],
+    concurrency: int = CHAIN_STEP_CONCURRENCY,
+) -> Dict[int, object]:
+    """
+    Run every step of `graph` once all steps it depends on have finished.
+
+    Independent steps run concurrently, at most `concurrency` at a time. Ready steps
+    start in step order, so a concurrency of 1 runs a chain exactly as before.
+    """
+    finished = {step_number: asyncio.Event() for step_number in graph}
+    slots = asyncio.Semaphore(max(int(concurrency), 1))
+    results = {}
+
+    async def run(step_number):
+        try:
+            for dependency in sorted(graph[step_number]):
+                await finished[dependency].wait()
+            async with slots:
+                results[step_number] = await run_step(step_number)
+        finally:
+            finished[step_number].set()
+
+    tasks = [asyncio.ensure_future(run(step_number)) for step_number in sorted(graph)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return results
+
+
+class Chain:
+    def __init__(self, user=DEFAULT_USER):
+        self.user = user
+        self.user_id = get_user_id(self.user)
+
+    def get_chain(self, chain_name):
+        plan = get_chain_plan(self.user_id, chain_name)
+        if plan is None:
+            return []
+        return plan.to_dict()
 
     def get_global_chains(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
+        default_user_id = get_user_id(DEFAULT_USER)
         global_chains = (
-            session.query(ChainDB).filter(ChainDB.user_id == user_data.id).all()
+            session.query(ChainDB).filter(ChainDB.user_id == default_user_id).all()
         )
         chains = session.query(ChainDB).filter(ChainDB.user_id == self.user_id).all()
         chain_list = []
@@ -148,9 +309,9 @@ class Chain:
     def get_chains(self):
         session = get_session()
         """
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
+        default_user_id = get_user_id(DEFAULT_USER)
         global_chains = (
-            session.query(ChainDB).filter(ChainDB.user_id == user_data.id).all()
+            session.query(ChainDB).filter(ChainDB.user_id == default_user_id).all()
         )
         """
         chains = session.query(ChainDB).filter(ChainDB.user_id == self.user_id).all()
@@ -496,43 +657,16 @@ class Chain:
         session.close()
 
     def get_steps(self, chain_name):
-        session = get_session()
-        chain_name = chain_name.replace("%20", " ")
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        chain_db = (
-            session.query(ChainDB)
-            .filter(ChainDB.user_id == user_data.id, ChainDB.name == chain_name)
-            .first()
-        )
-        if chain_db is None:
-            chain_db = (
-                session.query(ChainDB)
-                .filter(
-                    ChainDB.name == chain_name,
-                    ChainDB.user_id == self.user_id,
-                )
-                .first()
-            )
-        if chain_db is None:
-            session.close()
+        plan = get_chain_plan(self.user_id, chain_name)
+        if plan is None:
             return []
-        chain_steps = (
-            session.query(ChainStep)
-            .filter(ChainStep.chain_id == chain_db.id)
-            .order_by(ChainStep.step_number)
-            .all()
-        )
-        session.close()
-        return chain_steps
+        return list(plan.steps)
 
     def get_step(self, chain_name, step_number):
-        steps = self.get_steps(chain_name=chain_name)
-        chain_step = None
-        for step in steps:
-            if step.step_number == step_number:
-                chain_step = step
-                break
-        return chain_step
+        plan = get_chain_plan(self.user_id, chain_name)
+        if plan is None:
+            return None
+        return plan.step(step_number)
 
     def move_step(self, chain_name, current_step_number, new_step_number):
         session = get_session()
@@ -572,72 +706,35 @@ class Chain:
     def get_step_response(self, chain_name, chain_run_id=None, step_number="all"):
         if chain_run_id is None:
             chain_run_id = self.get_last_chain_run_id(chain_name=chain_name)
-        chain_data = self.get_chain(chain_name=chain_name)
-        session = get_session()
         if step_number == "all":
-            chain_steps = (
-                session.query(ChainStep)
-                .filter(ChainStep.chain_id == chain_data["id"])
-                .order_by(ChainStep.step_number)
-                .all()
-            )
-
-            responses = {}
-            for step in chain_steps:
-                chain_step_responses = (
-                    session.query(ChainStepResponse)
-                    .filter(
-                        ChainStepResponse.chain_step_id == step.id,
-                        ChainStepResponse.chain_run_id == chain_run_id,
-                    )
-                    .order_by(ChainStepResponse.timestamp)
-                    .all()
-                )
-                step_responses = [response.content for response in chain_step_responses]
-                responses[str(step.step_number)] = step_responses
-            session.close()
-            return responses
-        else:
-            step_number = int(step_number)
-            chain_step = (
-                session.query(ChainStep)
-                .filter(
-                    ChainStep.chain_id == chain_data["id"],
-                    ChainStep.step_number == step_number,
-                )
-                .first()
-            )
-
-            if chain_step:
-                chain_step_responses = (
-                    session.query(ChainStepResponse)
-                    .filter(
-                        ChainStepResponse.chain_step_id == chain_step.id,
-                        ChainStepResponse.chain_run_id == chain_run_id,
-                    )
-                    .order_by(ChainStepResponse.timestamp)
-                    .all()
-                )
-                step_responses = [response.content for response in chain_step_responses]
-                session.close()
-                return step_responses
-            else:
-                session.close()
-                return None
+            chain_steps = self.get_steps(chain_name=chain_name)
+            responses = self.load_step_responses(chain_steps, chain_run_id)
+            return {
+                str(step.step_number): responses[str(step.id)] for step in chain_steps
+            }
+        chain_step = self.get_step(chain_name=chain_name, step_number=int(step_number))
+        if chain_step is None:
+            return None
+        return self.load_step_responses([chain_step], chain_run_id)[str(chain_step.id)]
 
     def get_chain_responses(self, chain_name):
         chain_steps = self.get_steps(chain_name=chain_name)
-        responses = {}
+        responses = self.load_step_responses(chain_steps)
+        return {str(step.step_number): responses[str(step.id)] for step in chain_steps}
+
+    def load_step_responses(self, chain_steps, chain_run_id=None):
+        """Response contents of each step by step id, oldest first, in one query"""
+        responses = {str(step.id): [] for step in chain_steps}
+        if not responses:
+            return responses
         session = get_session()
-        for step in chain_steps:
-            chain_step_responses = (
-                session.query(ChainStepResponse)
-                .filter(ChainStepResponse.chain_step_id == step.id)
-                .order_by(ChainStepResponse.timestamp)
-                .all()
-            )
-            step_responses = [response.content for response in chain_step_responses]
-            responses[str(step.step_number)] = step_responses
+        query = session.query(
+            ChainStepResponse.chain_step_id, ChainStepResponse.content
+        ).filter(ChainStepResponse.chain_step_id.in_([step.id for step in chain_steps]))
+        if chain_run_id is not None:
+            query = query.filter(ChainStepResponse.chain_run_id == chain_run_id)
+        for chain_step_id, content in query.order_by(ChainStepResponse.timestamp):
+            responses[str(chain_step_id)].append(content)
         session.close()
         return responses
 
@@ -770,41 +867,29 @@ class Chain:
         chain_dependencies = {}
         for step in chain_steps:
             step_dependencies = []
-            prompt = step.prompt
-            if not isinstance(prompt, dict) and not isinstance(prompt, str):
-                prompt = str(prompt)
-            if isinstance(prompt, dict):
-                for key, value in prompt.items():
-                    if "{STEP" in value:
-                        step_count = value.count("{STEP")
-                        for i in range(step_count):
-                            new_step_number = int(value.split("{STEP")[1].split("}")[0])
-                            step_dependencies.append(new_step_number)
-                if "prompt_name" in prompt:
-                    prompt_text = prompts.get_prompt(
-                        prompt_name=prompt["prompt_name"],
-                        prompt_category=(
-                            prompt["prompt_category"]
-                            if "prompt_category" in prompt
-                            else "Default"
-                        ),
+            prompt = step.resolved_prompt()
+            for value in prompt.values():
+                if isinstance(value, str):
+                    step_dependencies.extend(
+                        int(step_number)
+                        for step_number in STEP_REFERENCE.findall(value)
                     )
-                    # See if "{context}" is in the prompt
-                    if "{context}" in prompt_text:
-                        # Add all prior steps in the chain as deps
-                        for i in range(step.step_number):
-                            step_dependencies.append(i)
-            elif isinstance(prompt, str):
-                if "{STEP" in prompt:
-                    step_count = prompt.count("{STEP")
-                    for i in range(step_count):
-                        new_step_number = int(prompt.split("{STEP")[1].split("}")[0])
-                        step_dependencies.append(new_step_number)
-                    if "{context}" in prompt:
-                        # Add all prior steps in the chain as deps
-                        for i in range(step.step_number):
-                            step_dependencies.append(i)
-            chain_dependencies[str(step.step_number)] = step_dependencies
+            if "prompt_name" in prompt:
+                prompt_text = prompts.get_prompt(
+                    prompt_name=prompt["prompt_name"],
+                    prompt_category=(
+                        prompt["prompt_category"]
+                        if "prompt_category" in prompt
+                        else "Default"
+                    ),
+                )
+                # See if "{context}" is in the prompt
+                if prompt_text and "{context}" in prompt_text:
+                    # Add all prior steps in the chain as deps
+                    step_dependencies.extend(range(step.step_number))
+            chain_dependencies[str(step.step_number)] = list(
+                dict.fromkeys(step_dependencies)
+            )
         return chain_dependencies
 
     async def check_if_dependencies_met(
@@ -828,115 +913,91 @@ class Chain:
                     return False
             return True
 
-        dependencies_met = await check_dependencies_met(dependencies)
-        while not dependencies_met:
-            await asyncio.sleep(1)
-            dependencies_met = await check_dependencies_met(dependencies)
-        return True
+        while True:
+            # Subscribe before checking so a response written in between still wakes us
+            completed = step_completions.subscribe(chain_run_id)
+            try:
+                if await check_dependencies_met(dependencies):
+                    return True
+                try:
+                    await asyncio.wait_for(
+                        completed.wait(), timeout=CHAIN_DEPENDENCY_CHECK_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                step_completions.unsubscribe(chain_run_id, completed)
 
     def get_step_content(
         self, chain_run_id, chain_name, prompt_content, user_input, agent_name
     ):
-        if isinstance(prompt_content, dict):
-            new_prompt_content = {}
-            for arg, value in prompt_content.items():
-                if isinstance(value, str):
-                    if "{user_input}" in value:
-                        value = value.replace("{user_input}", user_input)
-                    if "{agent_name}" in value:
-                        value = value.replace("{agent_name}", agent_name)
-                    if "{STEP" in value:
-                        step_count = value.count("{STEP")
-                        for i in range(step_count):
-                            new_step_number = int(value.split("{STEP")[1].split("}")[0])
-                            step_response = self.get_step_response(
-                                chain_run_id=chain_run_id,
-                                chain_name=chain_name,
-                                step_number=new_step_number,
-                            )
-                            if step_response:
-                                resp = (
-                                    step_response[0]
-                                    if isinstance(step_response, list)
-                                    else step_response
-                                )
-                                value = value.replace(
-                                    f"{{STEP{new_step_number}}}", f"{resp}"
-                                )
-                new_prompt_content[arg] = value
-            return new_prompt_content
-        elif isinstance(prompt_content, str):
-            new_prompt_content = prompt_content
-            if "{user_input}" in prompt_content:
-                new_prompt_content = new_prompt_content.replace(
-                    "{user_input}", user_input
-                )
-            if "{agent_name}" in new_prompt_content:
-                new_prompt_content = new_prompt_content.replace(
-                    "{agent_name}", agent_name
-                )
-            if "{STEP" in prompt_content:
-                step_count = prompt_content.count("{STEP")
-                for i in range(step_count):
-                    new_step_number = int(
-                        prompt_content.split("{STEP")[1].split("}")[0]
-                    )
-                    step_response = self.get_step_response(
-                        chain_run_id=chain_run_id,
-                        chain_name=chain_name,
-                        step_number=new_step_number,
-                    )
-                    if step_response:
-                        resp = (
-                            step_response[0]
-                            if isinstance(step_response, list)
-                            else step_response
-                        )
-                        new_prompt_content = new_prompt_content.replace(
-                            f"{{STEP{new_step_number}}}", f"{resp}"
-                        )
-            return new_prompt_content
-        else:
-            return prompt_content
+        return ChainRunContext(
+            chain=self, chain_name=chain_name, chain_run_id=chain_run_id
+        ).substitute(
+            prompt_content=prompt_content,
+            user_input=user_input,
+            agent_name=agent_name,
+        )
 
     async def update_step_response(
         self, chain_run_id, chain_name, step_number, response
     ):
-        chain_step = self.get_step(chain_name=chain_name, step_number=step_number)
-        if chain_step and response:
-            session = get_session()
-            existing_response = (
-                session.query(ChainStepResponse)
+        if response:
+            self.write_step_responses(
+                chain_run_id=chain_run_id,
+                chain_name=chain_name,
+                responses={step_number: response},
+            )
+
+    def write_step_responses(self, chain_run_id, chain_name, responses: dict):
+        """Store the responses of several steps of a run with one read and one commit"""
+        plan = get_chain_plan(self.user_id, chain_name)
+        if plan is None:
+            return
+        step_ids = {}
+        for step_number, response in responses.items():
+            chain_step = plan.step(step_number)
+            if chain_step and response:
+                step_ids[str(chain_step.id)] = (chain_step.id, response)
+        if not step_ids:
+            return
+        session = get_session()
+        try:
+            existing_responses = {
+                str(existing_response.chain_step_id): existing_response
+                for existing_response in session.query(ChainStepResponse)
                 .filter(
-                    ChainStepResponse.chain_step_id == chain_step.id,
+                    ChainStepResponse.chain_step_id.in_(
+                        [chain_step_id for chain_step_id, _ in step_ids.values()]
+                    ),
                     ChainStepResponse.chain_run_id == chain_run_id,
                 )
-                .order_by(ChainStepResponse.timestamp.desc())
-                .first()
-            )
-            if existing_response:
-                if isinstance(existing_response.content, dict) and isinstance(
+                .order_by(ChainStepResponse.timestamp)
+            }
+            for key, (chain_step_id, response) in step_ids.items():
+                existing_response = existing_responses.get(key)
+                if existing_response is None:
+                    session.add(
+                        ChainStepResponse(
+                            chain_step_id=chain_step_id,
+                            chain_run_id=chain_run_id,
+                            content=response,
+                        )
+                    )
+                elif isinstance(existing_response.content, dict) and isinstance(
                     response, dict
                 ):
                     existing_response.content.update(response)
-                    session.commit()
                 elif isinstance(existing_response.content, list) and isinstance(
                     response, list
                 ):
                     existing_response.content.extend(response)
-                    session.commit()
                 else:
                     existing_response.content = response
-                    session.commit()
-            else:
-                chain_step_response = ChainStepResponse(
-                    chain_step_id=chain_step.id,
-                    chain_run_id=chain_run_id,
-                    content=response,
-                )
-                session.add(chain_step_response)
-                session.commit()
+            session.commit()
+        finally:
             session.close()
+        step_completions.notify(chain_run_id)
 
     async def get_chain_run_id(self, chain_name):
         session = get_session()
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+from sqlalchemy.orm import aliased
+from DB import (
+    get_session,
+    Chain as ChainDB,
+    ChainStep,
+    Agent,
+    Argument,
+    ChainStepArgument,
+    Prompt,
+    Command,
+)
+from Globals import getenv, DEFAULT_USER
+from IdentityCache import SharedCacheVersion, invalidate_on_commit, resolve_user_id
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Seconds a resolved chain plan is reused before it is loaded again
+CHAIN_PLAN_CACHE_TTL = int(getenv("CHAIN_PLAN_CACHE_TTL", "300"))
+# Models whose changes alter a plan: its chain, steps, arguments and the names they point to
+CHAIN_PLAN_MODELS = (
+    ChainDB,
+    ChainStep,
+    ChainStepArgument,
+    Argument,
+    Agent,
+    Command,
+    Prompt,
+)
+
+
+class ChainPlanStep(NamedTuple):
+    id: object
+    chain_id: object
+    step_number: int
+    agent_id: object
+    agent_name: Optional[str]
+    prompt_type: str
+    prompt: Optional[str]
+    target_chain_id: object
+    target_command_id: object
+    target_prompt_id: object
+    target: Mapping[str, str]
+    arguments: Mapping[str, str]
+
+    def resolved_prompt(self) -> dict:
+        """The step's target name and arguments, as chains store and run them"""
+        return {**self.target, **self.arguments}
+
+    def to_dict(self) -> dict:
+        return {
+            "step": self.step_number,
+            "agent_name": self.agent_name,
+            "prompt_type": self.prompt_type,
+            "prompt": self.resolved_prompt(),
+        }
+
+
+class ChainPlan(NamedTuple):
+    """A chain with every step's agent, target and arguments resolved"""
+
+    id: object
+    name: str
+    user_id: object
+    steps: Tuple[ChainPlanStep, ...]
+
+    def step(self, step_number) -> Optional[ChainPlanStep]:
+        for step in self.steps:
+            if step.step_number == step_number:
+                return step
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "chain_name": self.name,
+            "steps": [step.to_dict() for step in self.steps],
+        }
+
+
+def load_chain_plan(user_id, chain_name: str) -> Optional[ChainPlan]:
+    """
+    Build the plan of a chain in one query.
+
+    Like Chain.get_chain, the default user's chain of that name wins over the user's.
+    """
+    default_user_id = resolve_user_id(DEFAULT_USER)
+    TargetChain = aliased(ChainDB)
+    session = get_session()
+    try:
+        rows = (
+            session.query(
+                ChainDB.id,
+                ChainDB.name,
+                ChainDB.user_id,
+                ChainStep,
+                Agent.name,
+                TargetChain.name,
+                Command.name,
+                Prompt.name,
+                Argument.name,
+                ChainStepArgument.value,
+            )
+            .outerjoin(ChainStep, ChainStep.chain_id == ChainDB.id)
+            .outerjoin(Agent, Agent.id == ChainStep.agent_id)
+            .outerjoin(TargetChain, TargetChain.id == ChainStep.target_chain_id)
+            .outerjoin(Command, Command.id == ChainStep.target_command_id)
+            .outerjoin(Prompt, Prompt.id == ChainStep.target_prompt_id)
+            .outerjoin(
+                ChainStepArgument, ChainStepArgument.chain_step_id == ChainStep.id
+            )
+            .outerjoin(Argument, Argument.id == ChainStepArgument.argument_id)
+            .filter(
+                ChainDB.name == chain_name,
+                ChainDB.user_id.in_([default_user_id, user_id]),
+            )
+            .order_by(ChainStep.step_number)
+            .all()
+        )
+    finally:
+        session.close()
+    if not rows:
+        return None
+    chain_id, name, owner_id = next(
+        (
+            (row[0], row[1], row[2])
+            for row in rows
+            if str(row[2]) == str(default_user_id)
+        ),
+        (rows[0][0], rows[0][1], rows[0][2]),
+    )
+    steps: Dict[str, dict] = {}
+    for (
+        row_chain_id,
+        _,
+        _,
+        step,
+        agent_name,
+        target_chain_name,
+        command_name,
+        prompt_name,
+        argument_name,
+        argument_value,
+    ) in rows:
+        if row_chain_id != chain_id or step is None:
+            continue
+        key = str(step.id)
+        if key not in steps:
+            target = {}
+            if step.target_chain_id:
+                target["chain_name"] = target_chain_name
+            elif step.target_command_id:
+                target["command_name"] = command_name
+            elif step.target_prompt_id:
+                target["prompt_name"] = prompt_name
+            steps[key] = {
+                "step": step,
+                "agent_name": agent_name,
+                "target": target,
+                "arguments": {},
+            }
+        if argument_name is not None:
+            steps[key]["arguments"][argument_name] = argument_value
+    return ChainPlan(
+        id=chain_id,
+        name=name,
+        user_id=owner_id,
+        steps=tuple(
+            ChainPlanStep(
+                id=data["step"].id,
+                chain_id=data["step"].chain_id,
+                step_number=data["step"].step_number,
+                agent_id=data["step"].agent_id,
+                agent_name=data["agent_name"],
+                prompt_type=data["step"].prompt_type,
+                prompt=data["step"].prompt,
+                target_chain_id=data["step"].target_chain_id,
+                target_command_id=data["step"].target_command_id,
+                target_prompt_id=data["step"].target_prompt_id,
+                target=MappingProxyType(data["target"]),
+                arguments=MappingProxyType(data["arguments"]),
+            )
+            for data in steps.values()
+        ),
+    )
+
+
+class ChainPlanCache:
+    """
+    Resolved chain plans keyed by (user id, chain name).
+
+    Plans are immutable, so every caller shares them. A plan names the agents,
+    chains, commands and prompts its steps point to, so any committed change to
+    those drops every plan and bumps the shared "chain_plan" version so other
+    workers drop theirs on their next check.
+    """
+
+    def __init__(self, ttl: int = CHAIN_PLAN_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[tuple, tuple] = {}
+        self.generation = 0
+        self.version = SharedCacheVersion("chain_plan")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, chain_name: str) -> Optional[ChainPlan]:
+        if self.version.changed():
+            self.clear()
+        key = (str(user_id), chain_name)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+        plan = load_chain_plan(user_id, chain_name)
+        # Missing chains aren't cached so they resolve as soon as they're created
+        if plan is not None:
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (plan, now + self.ttl)
+        return plan
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def invalidate(self):
+        self.clear()
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+chain_plans = ChainPlanCache()
+invalidate_on_commit(CHAIN_PLAN_MODELS, chain_plans.invalidate)
+
+
+def get_chain_plan(user_id, chain_name: str) -> Optional[ChainPlan]:
+    """Plan of the chain the user runs by this name, or None if there is none"""
+    return chain_plans.get(user_id, chain_name.replace("%20", " "))
+
+
+def get_chain_plan_cache_metrics() -> dict:
+    return chain_plans.metrics()
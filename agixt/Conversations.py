@@ -1,5 +1,11 @@
+from collections import OrderedDict, deque
 from datetime import datetime
+import base64
+import json
 import logging
+import re
+import threading
+import uuid
 from DB import (
     Conversation,
     Agent,
@@ -7,11 +13,20 @@ from DB import (
     User,
     UserPreferences,
     get_session,
+    get_message_activity,
+    DATABASE_TYPE,
 )
 from Globals import getenv, DEFAULT_USER
+from fastapi import HTTPException
+from sqlalchemy import tuple_
 from sqlalchemy.sql import func
 import pytz
-from MagicalAuth import convert_time
+from MagicalAuth import get_local_timezone, get_user_id, to_local_time
+from IdentityCache import (
+    invalidate_conversation,
+    resolve_conversation_id,
+)
+from MessageLog import message_log, new_message_id, utc_now
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -21,23 +36,14 @@ logging.basicConfig(
 
 def get_conversation_id_by_name(conversation_name, user_id):
     user_id = str(user_id)
+    conversation_id = resolve_conversation_id(user_id, conversation_name)
+    if conversation_id:
+        return str(conversation_id)
     session = get_session()
     user = session.query(User).filter(User.id == user_id).first()
-    conversation = (
-        session.query(Conversation)
-        .filter(
-            Conversation.name == conversation_name,
-            Conversation.user_id == user_id,
-        )
-        .first()
-    )
-    if not conversation:
-        c = Conversations(conversation_name=conversation_name, user=user.email)
-        conversation_id = c.get_conversation_id()
-    else:
-        conversation_id = str(conversation.id)
     session.close()
-    return conversation_id
+    c = Conversations(conversation_name=conversation_name, user=user.email)
+    return c.get_conversation_id()
 
 
 def get_conversation_name_by_id(conversation_id, user_id):
@@ -61,47 +67,249 @@ def get_conversation_name_by_id(conversation_id, user_id):
     return conversation_name
 
 
+# Interactions, activities and subactivities per activity kept for prompt context
+CONVERSATION_CONTEXT_WINDOW = int(getenv("CONVERSATION_CONTEXT_WINDOW", "50"))
+CONVERSATION_ACTIVITY_WINDOW = int(getenv("CONVERSATION_ACTIVITY_WINDOW", "10"))
+CONVERSATION_CONTEXT_CACHE_SIZE = int(getenv("CONVERSATION_CONTEXT_CACHE_SIZE", "256"))
+# Messages fetched per round trip while streaming a conversation export
+CONVERSATION_EXPORT_BATCH_SIZE = int(getenv("CONVERSATION_EXPORT_BATCH_SIZE", "500"))
+
+
+def encode_message_cursor(message):
+    """Opaque keyset cursor that resumes right after this message"""
+    value = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_message_cursor(cursor: str):
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = value.split("|", 1)
+        timestamp = datetime.fromisoformat(timestamp)
+        if DATABASE_TYPE != "sqlite":
+            message_id = uuid.UUID(message_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return timestamp, message_id
+
+
+def after_message_cursor(session, query, cursor: str):
+    """
+    Keyset filter for messages ordered by (timestamp, id) after the cursor.
+
+    The position is read from the cursor's own message when it still exists, so the
+    comparison is column to column, and falls back to the encoded timestamp.
+    """
+    timestamp, message_id = decode_message_cursor(cursor)
+    anchor = func.coalesce(
+        session.query(Message.timestamp)
+        .filter(Message.id == message_id)
+        .scalar_subquery(),
+        timestamp,
+    )
+    return query.filter(
+        tuple_(Message.timestamp, Message.id) > tuple_(anchor, message_id)
+    )
+
+
+def page_messages(session, query, limit: int, page: int = 1, cursor: str = None):
+    """
+    One page of messages in (timestamp, id) order and the cursor of the next page.
+
+    With a cursor the page is found by seeking the index, so deep pages cost the same
+    as the first one. Without one it falls back to `page` and an offset.
+    """
+    query = query.order_by(Message.timestamp.asc(), Message.id.asc())
+    if cursor:
+        query = after_message_cursor(session, query, cursor)
+    else:
+        query = query.offset((page - 1) * limit)
+    messages = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_message_cursor(messages[-1])
+    return messages, next_cursor
+
+
+class ConversationContext:
+    """
+    Rolling prompt context of one conversation.
+
+    Keeps the most recent interactions and activities already rendered, so building
+    the conversation history for a prompt costs O(window) regardless of how long
+    the conversation is. `signature` is the conversation's updated_at when the
+    context was last in sync with the database.
+    """
+
+    def __init__(self, signature=None):
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.interactions = deque(maxlen=CONVERSATION_CONTEXT_WINDOW)
+        self.activities = deque(maxlen=CONVERSATION_ACTIVITY_WINDOW)
+        self.activity_summary = None
+        # Ids of messages added here that the message log hasn't written yet
+        self.pending_ids = set()
+
+    def add_message(
+        self,
+        message_id,
+        message_type,
+        role,
+        content,
+        timestamp,
+        local_timestamp,
+        parent_activity_id=None,
+    ):
+        with self.lock:
+            if message_type == "activity":
+                self.activities.append(
+                    [
+                        str(message_id),
+                        f"### Activity at {timestamp}\n{content}\n",
+                        deque(maxlen=CONVERSATION_CONTEXT_WINDOW),
+                    ]
+                )
+                self.activity_summary = None
+            elif message_type == "subactivity":
+                # Attach to the parent activity, dropping it if the parent has left the
+                # window. Legacy subactivities without a parent id belong to the
+                # activity logged before them.
+                if parent_activity_id:
+                    parent = next(
+                        (
+                            activity
+                            for activity in self.activities
+                            if activity[0] == str(parent_activity_id)
+                        ),
+                        None,
+                    )
+                else:
+                    parent = self.activities[-1] if self.activities else None
+                if parent:
+                    parent[2].append(f"#### Subactivity at {timestamp}\n{content}")
+                    self.activity_summary = None
+            elif not content.startswith("<audio controls>"):
+                content = re.sub(r"(```.*?```)", "", content)
+                self.interactions.append(f"{local_timestamp} {role}: {content} \n ")
+
+    def get_history(self, limit: int) -> str:
+        with self.lock:
+            if not self.interactions and not self.activities:
+                return ""
+            interactions = list(self.interactions)[-limit:] if limit > 0 else []
+            if self.activity_summary is None:
+                activities = "\n".join(
+                    header + "\n".join(subactivities)
+                    for _, header, subactivities in self.activities
+                )
+                self.activity_summary = f"### Detailed Activities:\n{activities}"
+            history = "\n".join(interactions)
+            history += "\n## The assistant's recent activities:\n"
+            return history + self.activity_summary
+
+
+class ConversationContextCache:
+    """Process-wide LRU of ConversationContext keyed by conversation id"""
+
+    def __init__(self, max_size: int = CONVERSATION_CONTEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.contexts = OrderedDict()
+
+    def get(self, conversation_id):
+        with self.lock:
+            context = self.contexts.get(str(conversation_id))
+            if context is not None:
+                self.contexts.move_to_end(str(conversation_id))
+            return context
+
+    def set(self, conversation_id, context: ConversationContext):
+        with self.lock:
+            self.contexts[str(conversation_id)] = context
+            self.contexts.move_to_end(str(conversation_id))
+            while len(self.contexts) > self.max_size:
+                self.contexts.popitem(last=False)
+
+    def invalidate(self, conversation_id):
+        with self.lock:
+            self.contexts.pop(str(conversation_id), None)
+
+
+conversation_contexts = ConversationContextCache()
+
+
+def mark_conversation_changed(conversation: Conversation):
+    """Move updated_at so every worker's cached context of the conversation goes stale"""
+    conversation.updated_at = utc_now()
+
+
+def sync_conversation_contexts(rows, previous_updates):
+    """Move cached contexts to the updated_at the message log just wrote, or drop them"""
+    flushed = {}
+    for row in rows:
+        flushed.setdefault(str(row["conversation_id"]), []).append(row)
+    for conversation_id, conversation_rows in flushed.items():
+        context = conversation_contexts.get(conversation_id)
+        if context is None:
+            continue
+        ids = {str(row["id"]) for row in conversation_rows}
+        with context.lock:
+            in_sync = context.signature == previous_updates.get(
+                conversation_id
+            ) and ids.issubset(context.pending_ids)
+            if in_sync:
+                context.pending_ids -= ids
+                context.signature = max(row["timestamp"] for row in conversation_rows)
+        if not in_sync:
+            conversation_contexts.invalidate(conversation_id)
+
+
+message_log.add_flush_listener(sync_conversation_contexts)
+
+
 class Conversations:
     def __init__(self, conversation_name=None, user=DEFAULT_USER):
         self.conversation_name = conversation_name
         self.user = user
 
-    def export_conversation(self):
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+    def iter_conversation_export(self, batch_size=CONVERSATION_EXPORT_BATCH_SIZE):
+        """Yield the conversation's interactions oldest first from a server-side cursor"""
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
+        user_id = get_user_id(self.user)
+        conversation_id = resolve_conversation_id(user_id, self.conversation_name)
+        if not conversation_id:
+            return
+        session = get_session()
+        try:
+            messages = (
+                session.query(Message.role, Message.content, Message.timestamp)
+                .filter(Message.conversation_id == conversation_id)
+                .order_by(Message.timestamp.asc(), Message.id.asc())
+                .yield_per(batch_size)
             )
-            .first()
-        )
-        history = {"interactions": []}
-        if not conversation:
-            return history
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .all()
-        )
-        for message in messages:
-            interaction = {
-                "role": message.role,
-                "message": message.content,
-                "timestamp": message.timestamp,
-            }
-            history["interactions"].append(interaction)
-        session.close()
-        return history
+            for role, content, timestamp in messages:
+                yield {"role": role, "message": content, "timestamp": timestamp}
+        finally:
+            session.close()
+
+    def export_conversation_ndjson(self):
+        """Stream the conversation as newline-delimited JSON in constant memory"""
+        for interaction in self.iter_conversation_export():
+            interaction["timestamp"] = (
+                interaction["timestamp"].isoformat()
+                if interaction["timestamp"]
+                else None
+            )
+            yield json.dumps(interaction) + "\n"
+
+    def export_conversation(self):
+        return {"interactions": list(self.iter_conversation_export())}
 
     def get_conversations(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         # Use a LEFT OUTER JOIN to get conversations and their messages
         conversations = (
@@ -120,8 +328,7 @@ class Conversations:
 
     def get_conversations_with_ids(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         # Use a LEFT OUTER JOIN to get conversations and their messages
         conversations = (
@@ -159,8 +366,7 @@ class Conversations:
 
     def get_conversations_with_detail(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         # Add notification check to the query
         conversations = (
@@ -177,13 +383,16 @@ class Conversations:
             .order_by(Conversation.updated_at.desc())
             .all()
         )
+        # Resolved once for the whole listing rather than per conversation
+        agent_id = self.get_agent_id(user_id)
+        local_tz = get_local_timezone(user_id)
         # If the agent's company_id does not match
         result = {
             str(conversation.id): {
                 "name": conversation.name,
-                "agent_id": self.get_agent_id(user_id),
-                "created_at": convert_time(conversation.created_at, user_id=user_id),
-                "updated_at": convert_time(conversation.updated_at, user_id=user_id),
+                "agent_id": agent_id,
+                "created_at": to_local_time(conversation.created_at, local_tz),
+                "updated_at": to_local_time(conversation.updated_at, local_tz),
                 "has_notifications": notification_count > 0,
                 "summary": (
                     conversation.summary if Conversation.summary else "None available"
@@ -197,8 +406,7 @@ class Conversations:
 
     def get_notifications(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         # Get all messages with notify=True for this user's conversations
         notifications = (
@@ -209,6 +417,7 @@ class Conversations:
             .all()
         )
 
+        local_tz = get_local_timezone(user_id)
         result = []
         for message, conversation in notifications:
             result.append(
@@ -218,17 +427,16 @@ class Conversations:
                     "message_id": str(message.id),
                     "message": message.content,
                     "role": message.role,
-                    "timestamp": convert_time(message.timestamp, user_id=user_id),
+                    "timestamp": to_local_time(message.timestamp, local_tz),
                 }
             )
 
         session.close()
         return result
 
-    def get_conversation(self, limit=100, page=1):
+    def get_conversation(self, limit=100, page=1, cursor=None):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -254,37 +462,35 @@ class Conversations:
                 .update({"notify": False})
             )
         session.commit()
-        offset = (page - 1) * limit
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .order_by(Message.timestamp.asc())
-            .limit(limit)
-            .offset(offset)
-            .all()
+        messages, next_cursor = page_messages(
+            session,
+            session.query(Message).filter(Message.conversation_id == conversation.id),
+            limit=limit,
+            page=page,
+            cursor=cursor,
         )
         if not messages:
             session.close()
-            return {"interactions": []}
+            return {"interactions": [], "next_cursor": None}
+        local_tz = get_local_timezone(user_id)
         return_messages = []
         for message in messages:
             msg = {
                 "id": message.id,
                 "role": message.role,
                 "message": message.content,
-                "timestamp": convert_time(message.timestamp, user_id=user_id),
-                "updated_at": convert_time(message.updated_at, user_id=user_id),
+                "timestamp": to_local_time(message.timestamp, local_tz),
+                "updated_at": to_local_time(message.updated_at, local_tz),
                 "updated_by": message.updated_by,
                 "feedback_received": message.feedback_received,
             }
             return_messages.append(msg)
         session.close()
-        return {"interactions": return_messages}
+        return {"interactions": return_messages, "next_cursor": next_cursor}
 
     def fork_conversation(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         # Get the original conversation
         original_conversation = (
@@ -350,6 +556,8 @@ class Conversations:
                     updated_by=message.updated_by,
                     feedback_received=message.feedback_received,
                     notify=False,
+                    message_type=message.message_type,
+                    parent_activity_id=message.parent_activity_id,
                 )
                 session.add(new_message)
 
@@ -372,10 +580,9 @@ class Conversations:
         finally:
             session.close()
 
-    def get_activities(self, limit=100, page=1):
+    def get_activities(self, limit=100, page=1, cursor=None):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -388,38 +595,35 @@ class Conversations:
         )
         if not conversation:
             session.close()
-            return {"activities": []}
-        offset = (page - 1) * limit
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .order_by(Message.timestamp.asc())
-            .limit(limit)
-            .offset(offset)
-            .all()
+            return {"activities": [], "next_cursor": None}
+        messages, next_cursor = page_messages(
+            session,
+            session.query(Message).filter(
+                Message.conversation_id == conversation.id,
+                Message.message_type == "activity",
+            ),
+            limit=limit,
+            page=page,
+            cursor=cursor,
         )
         if not messages:
             session.close()
-            return {"activities": []}
-        return_activities = []
-        for message in messages:
-            if message.content.startswith("[ACTIVITY]"):
-                msg = {
-                    "id": message.id,
-                    "role": message.role,
-                    "message": message.content,
-                    "timestamp": message.timestamp,
-                }
-                return_activities.append(msg)
-        # Order messages by timestamp oldest to newest
-        return_activities = sorted(return_activities, key=lambda x: x["timestamp"])
+            return {"activities": [], "next_cursor": None}
+        return_activities = [
+            {
+                "id": message.id,
+                "role": message.role,
+                "message": message.content,
+                "timestamp": message.timestamp,
+            }
+            for message in messages
+        ]
         session.close()
-        return {"activities": return_activities}
+        return {"activities": return_activities, "next_cursor": next_cursor}
 
     def get_subactivities(self, activity_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -435,27 +639,26 @@ class Conversations:
             return ""
         messages = (
             session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.message_type == "subactivity",
+                Message.parent_activity_id == activity_id,
+            )
             .order_by(Message.timestamp.asc())
             .all()
         )
         if not messages:
             session.close()
             return ""
-        return_subactivities = []
-        for message in messages:
-            if message.content.startswith(f"[SUBACTIVITY][{activity_id}]"):
-                msg = {
-                    "id": message.id,
-                    "role": message.role,
-                    "message": message.content,
-                    "timestamp": message.timestamp,
-                }
-                return_subactivities.append(msg)
-        # Order messages by timestamp oldest to newest
-        return_subactivities = sorted(
-            return_subactivities, key=lambda x: x["timestamp"]
-        )
+        return_subactivities = [
+            {
+                "id": message.id,
+                "role": message.role,
+                "message": message.content,
+                "timestamp": message.timestamp,
+            }
+            for message in messages
+        ]
         session.close()
         # Return it as a string with timestamps per subactivity in markdown format
         subactivities = "\n".join(
@@ -468,8 +671,7 @@ class Conversations:
 
     def get_activities_with_subactivities(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -485,7 +687,10 @@ class Conversations:
             return ""
         messages = (
             session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.message_type.in_(["activity", "subactivity"]),
+            )
             .order_by(Message.timestamp.asc())
             .all()
         )
@@ -495,7 +700,7 @@ class Conversations:
         return_activities = []
         current_activity = None
         for message in messages:
-            if message.content.startswith("[ACTIVITY]"):
+            if message.message_type == "activity":
                 if current_activity:
                     return_activities.append(current_activity)
                 current_activity = {
@@ -505,7 +710,7 @@ class Conversations:
                     "timestamp": message.timestamp,
                     "subactivities": [],
                 }
-            elif message.content.startswith("[SUBACTIVITY]"):
+            else:
                 if current_activity:
                     if "subactivities" not in current_activity:
                         current_activity["subactivities"] = []
@@ -535,10 +740,97 @@ class Conversations:
         )
         return f"### Detailed Activities:\n{activities}"
 
+    def load_conversation_context(self, session, conversation, user_id):
+        """Build the rolling context of a conversation from its most recent rows"""
+        context = ConversationContext(signature=conversation.updated_at)
+        local_tz = get_local_timezone(user_id)
+        interactions = (
+            session.query(Message)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.message_type == "message",
+            )
+            .order_by(Message.timestamp.desc())
+            .limit(CONVERSATION_CONTEXT_WINDOW)
+            .all()
+        )
+        activities = (
+            session.query(Message)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.message_type == "activity",
+            )
+            .order_by(Message.timestamp.desc())
+            .limit(CONVERSATION_ACTIVITY_WINDOW)
+            .all()
+        )
+        subactivities = []
+        if activities:
+            subactivities = (
+                session.query(Message)
+                .filter(
+                    Message.conversation_id == conversation.id,
+                    Message.message_type == "subactivity",
+                    Message.timestamp
+                    >= session.query(Message.timestamp)
+                    .filter(Message.id == activities[-1].id)
+                    .scalar_subquery(),
+                )
+                .order_by(Message.timestamp.asc())
+                .all()
+            )
+        # Rows were read newest first, replay them oldest first
+        for message in list(reversed(interactions)) + list(reversed(activities)):
+            context.add_message(
+                message_id=message.id,
+                message_type=message.message_type,
+                role=message.role,
+                content=message.content,
+                timestamp=message.timestamp,
+                local_timestamp=to_local_time(message.timestamp, local_tz),
+            )
+        for message in subactivities:
+            context.add_message(
+                message_id=message.id,
+                message_type=message.message_type,
+                role=message.role,
+                content=message.content,
+                timestamp=message.timestamp,
+                local_timestamp=None,
+                parent_activity_id=message.parent_activity_id,
+            )
+        return context
+
+    def get_conversation_context(self, conversation_results=5):
+        """Recent interactions and activities rendered for a prompt, served from the rolling context cache"""
+        if message_log.has_unflushed():
+            message_log.flush()
+        session = get_session()
+        user_id = get_user_id(self.user)
+        if not self.conversation_name:
+            self.conversation_name = "-"
+        conversation = (
+            session.query(Conversation)
+            .filter(
+                Conversation.name == self.conversation_name,
+                Conversation.user_id == user_id,
+            )
+            .first()
+        )
+        if not conversation:
+            session.close()
+            return ""
+        context = conversation_contexts.get(conversation.id)
+        if context is None or context.signature != conversation.updated_at:
+            # Written to by another worker since this context was built
+            context = self.load_conversation_context(session, conversation, user_id)
+            conversation_contexts.set(conversation.id, context)
+        session.close()
+        return context.get_history(limit=conversation_results)
+
     def new_conversation(self, conversation_content=[]):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         # Check if the conversation already exists for the agent
         existing_conversation = (
             session.query(Conversation)
@@ -566,19 +858,11 @@ class Conversations:
 
     def get_thinking_id(self, agent_name):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
-        if not conversation:
+        conversation_id = resolve_conversation_id(user_id, self.conversation_name)
+        if not conversation_id:
             session.close()
             return None
 
@@ -586,8 +870,8 @@ class Conversations:
         current_parent_activity = (
             session.query(Message)
             .filter(
-                Message.conversation_id == conversation.id,
-                Message.content.like("[ACTIVITY]%"),
+                Message.conversation_id == conversation_id,
+                Message.message_type == "activity",
                 Message.content != "[ACTIVITY] Thinking.",
             )
             .order_by(Message.timestamp.desc())
@@ -598,7 +882,8 @@ class Conversations:
         current_thinking = (
             session.query(Message)
             .filter(
-                Message.conversation_id == conversation.id,
+                Message.conversation_id == conversation_id,
+                Message.message_type == "activity",
                 Message.content == "[ACTIVITY] Thinking.",
             )
             .order_by(Message.timestamp.desc())
@@ -637,6 +922,14 @@ class Conversations:
         session.close()
         return str(thinking_id)
 
+    def resolve_conversation(self):
+        """(user_id, conversation_id) of this conversation, creating it if needed"""
+        user_id = get_user_id(self.user)
+        conversation_id = resolve_conversation_id(user_id, self.conversation_name)
+        if not conversation_id:
+            conversation_id = self.get_conversation_id()
+        return user_id, str(conversation_id)
+
     def log_interaction(self, role, message):
         message = str(message)
         if str(message).startswith("[SUBACTIVITY] "):
@@ -650,17 +943,6 @@ class Conversations:
                 )
             else:
                 message = message.replace("[SUBACTIVITY] ", "[ACTIVITY] ")
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
         notify = False
         if role.lower() == "user":
             role = "USER"
@@ -669,38 +951,42 @@ class Conversations:
                 "[SUBACTIVITY]"
             ):
                 notify = True
-        if not conversation:
-            conversation = self.new_conversation()
-            session.close()
-            session = get_session()
         if message.endswith("\n"):
             message = message[:-1]
         if message.endswith("\n"):
             message = message[:-1]
-        try:
-            new_message = Message(
-                role=role,
-                content=message,
-                conversation_id=conversation.id,
-                notify=notify,
-            )
-            # Update the conversation's updated_at timestamp
-            conversation.updated_at = func.now()
-        except Exception as e:
-            conversation = self.new_conversation()
-            session.close()
-            session = get_session()
-            new_message = Message(
+        user_id, conversation_id = self.resolve_conversation()
+        message_type, parent_activity_id = get_message_activity(message)
+        message_id = new_message_id()
+        timestamp = utc_now()
+        context = conversation_contexts.get(conversation_id)
+        if context is not None:
+            context.pending_ids.add(str(message_id))
+            context.add_message(
+                message_id=message_id,
+                message_type=message_type,
                 role=role,
                 content=message,
-                conversation_id=conversation.id,
-                notify=notify,
+                timestamp=timestamp,
+                local_timestamp=to_local_time(timestamp, get_local_timezone(user_id)),
+                parent_activity_id=parent_activity_id,
             )
-            # Update the conversation's updated_at timestamp
-            conversation.updated_at = func.now()
-
-        session.add(new_message)
-        session.commit()
+        # The message and the conversation's updated_at are written by the message log
+        message_log.enqueue(
+            {
+                "id": message_id,
+                "role": role,
+                "content": message,
+                "timestamp": timestamp,
+                "updated_at": timestamp,
+                "conversation_id": conversation_id,
+                "updated_by": None,
+                "feedback_received": False,
+                "notify": notify,
+                "message_type": message_type,
+                "parent_activity_id": parent_activity_id,
+            }
+        )
 
         if role.lower() == "user":
             logging.info(f"{self.user}: {message}")
@@ -711,14 +997,11 @@ class Conversations:
                 logging.error(f"{role}: {message}")
             else:
                 logging.info(f"{role}: {message}")
-        message_id = str(new_message.id)
-        session.close()
-        return message_id
+        return str(message_id)
 
     def delete_conversation(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -734,19 +1017,21 @@ class Conversations:
             session.close()
             return
 
+        conversation_id = conversation.id
         session.query(Message).filter(
-            Message.conversation_id == conversation.id
+            Message.conversation_id == conversation_id
         ).delete()
         session.query(Conversation).filter(
-            Conversation.id == conversation.id, Conversation.user_id == user_id
+            Conversation.id == conversation_id, Conversation.user_id == user_id
         ).delete()
         session.commit()
+        conversation_contexts.invalidate(conversation_id)
+        invalidate_conversation(user_id, self.conversation_name)
         session.close()
 
     def delete_message(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         conversation = (
             session.query(Conversation)
@@ -785,13 +1070,14 @@ class Conversations:
             session.close()
             return
         session.delete(message)
+        mark_conversation_changed(conversation)
         session.commit()
+        conversation_contexts.invalidate(conversation.id)
         session.close()
 
     def get_message_by_id(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         conversation = (
             session.query(Conversation)
@@ -827,8 +1113,7 @@ class Conversations:
     def get_last_agent_name(self):
         # Get the last role in the conversation that isn't "user"
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
         conversation = (
@@ -858,8 +1143,7 @@ class Conversations:
 
     def delete_message_by_id(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
 
         conversation = (
             session.query(Conversation)
@@ -890,13 +1174,14 @@ class Conversations:
             session.close()
             return
         session.delete(message)
+        mark_conversation_changed(conversation)
         session.commit()
+        conversation_contexts.invalidate(conversation.id)
         session.close()
 
     def toggle_feedback_received(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -937,8 +1222,7 @@ class Conversations:
 
     def has_received_feedback(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -979,8 +1263,7 @@ class Conversations:
 
     def update_message(self, message, new_message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1016,13 +1299,17 @@ class Conversations:
             session.close()
             return
         message.content = new_message
+        message.message_type, message.parent_activity_id = get_message_activity(
+            new_message
+        )
+        mark_conversation_changed(conversation)
         session.commit()
+        conversation_contexts.invalidate(conversation.id)
         session.close()
 
     def update_message_by_id(self, message_id, new_message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1054,9 +1341,14 @@ class Conversations:
 
         # Update the message content directly
         message.content = str(new_message)  # Ensure the content is a string
+        message.message_type, message.parent_activity_id = get_message_activity(
+            message.content
+        )
+        mark_conversation_changed(conversation)
 
         try:
             session.commit()
+            conversation_contexts.invalidate(conversation.id)
         except Exception as e:
             logging.error(f"Error updating message: {e}")
             session.rollback()
@@ -1068,9 +1360,11 @@ class Conversations:
             conversation_name = "-"
         else:
             conversation_name = self.conversation_name
+        user_id = get_user_id(self.user)
+        conversation_id = resolve_conversation_id(user_id, conversation_name)
+        if conversation_id:
+            return str(conversation_id)
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1089,8 +1383,7 @@ class Conversations:
 
     def rename_conversation(self, new_name: str):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1105,30 +1398,23 @@ class Conversations:
             session.commit()
         conversation.name = new_name
         session.commit()
+        invalidate_conversation(user_id, self.conversation_name)
         session.close()
         return new_name
 
     def get_last_activity_id(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
-        if not conversation:
+        conversation_id = resolve_conversation_id(user_id, self.conversation_name)
+        if not conversation_id:
             session.close()
             return None
         last_activity = (
             session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .filter(Message.content.like("[ACTIVITY]%"))
+            .filter(Message.conversation_id == conversation_id)
+            .filter(Message.message_type == "activity")
             .order_by(Message.timestamp.desc())
             .first()
         )
@@ -1141,8 +1427,7 @@ class Conversations:
 
     def set_conversation_summary(self, summary: str):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1166,8 +1451,7 @@ class Conversations:
 
     def get_conversation_summary(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1185,8 +1469,7 @@ class Conversations:
 
     def get_attachment_count(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1204,8 +1487,7 @@ class Conversations:
 
     def update_attachment_count(self, count: int):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1229,8 +1511,7 @@ class Conversations:
 
     def increment_attachment_count(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = get_user_id(self.user)
         conversation = (
             session.query(Conversation)
             .filter(
@@ -1,26 +1,37 @@
+import io
+import csv
+import re
 import uuid
+import json
 import time
 import logging
+from datetime import datetime, timezone
 from sqlalchemy import (
     create_engine,
     Column,
     Text,
     String,
     Integer,
+    BigInteger,
     ForeignKey,
+    Date,
     DateTime,
     Boolean,
+    LargeBinary,
+    Index,
     event,
+    inspect,
     or_,
     func,
     text,
 )
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.types import TypeDecorator, VARCHAR
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql.sqltypes import ARRAY, Float
 from cryptography.fernet import Fernet
 from Globals import getenv
+from VectorIndex import memory_indexes
 import numpy as np
 
 logging.basicConfig(
@@ -45,12 +56,32 @@ try:
     else:
         DATABASE_URI = f"sqlite:///{DATABASE_NAME}.db"
     engine = create_engine(DATABASE_URI, pool_size=40, max_overflow=-1)
+    # Store embeddings in a native pgvector column so similarity search runs in SQL,
+    # opt-in since it needs the vector extension installed or the rights to create it
+    USE_PGVECTOR = (
+        DATABASE_TYPE != "sqlite" and str(getenv("PGVECTOR", "false")).lower() == "true"
+    )
     connection = engine.connect()
     Base = declarative_base()
 except Exception as e:
     logging.error(f"Error connecting to database: {e}")
     Base = None
     engine = None
+    USE_PGVECTOR = False
+
+if USE_PGVECTOR:
+    from pgvector.sqlalchemy import Vector as PGVector
+    from Embeddings import get_embedding_dimension
+
+    try:
+        EMBEDDING_DIMENSION = get_embedding_dimension()
+    except Exception as e:
+        logging.warning(f"Unable to read the embedding dimension, using 384: {e}")
+        EMBEDDING_DIMENSION = 384
+    # Candidates an HNSW search visits before the agent and conversation filters apply
+    PGVECTOR_EF_SEARCH = int(getenv("PGVECTOR_EF_SEARCH", "200"))
+    # Collections up to this many memories are scored exactly instead of through the index
+    PGVECTOR_EXACT_SEARCH_ROWS = int(getenv("PGVECTOR_EXACT_SEARCH_ROWS", "20000"))
 
 
 def get_session():
@@ -178,6 +209,23 @@ class UserPreferences(Base):
     pref_value = Column(String, nullable=True)
 
 
+class TokenUsage(Base):
+    """Token usage counters per user, UTC day, agent and provider"""
+
+    __tablename__ = "token_usage"
+    user_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        ForeignKey("user.id"),
+        primary_key=True,
+    )
+    usage_date = Column(Date, primary_key=True)
+    # Empty string rather than NULL when the agent or provider isn't known
+    agent_id = Column(String, primary_key=True, default="")
+    provider = Column(String, primary_key=True, default="")
+    input_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+
+
 class UserOAuth(Base):
     __tablename__ = "user_oauth"
     id = Column(
@@ -397,6 +445,14 @@ class Conversation(Base):
     user = relationship("User", backref="conversation")
 
 
+class CacheVersion(Base):
+    """Version counters bumped to tell every worker to drop a process-local cache"""
+
+    __tablename__ = "cache_version"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class Message(Base):
     __tablename__ = "message"
     id = Column(
@@ -420,6 +476,200 @@ class Message(Base):
     )
     feedback_received = Column(Boolean, default=False)
     notify = Column(Boolean, default=False, nullable=False)
+    # "activity", "subactivity" or "message", derived from the content prefix when logged
+    message_type = Column(String, nullable=True)
+    parent_activity_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        nullable=True,
+    )
+
+    __table_args__ = (
+        Index(
+            "message_conversation_type_timestamp_idx",
+            "conversation_id",
+            "message_type",
+            "timestamp",
+        ),
+        Index("message_parent_activity_idx", "parent_activity_id", "timestamp"),
+        Index(
+            "message_conversation_timestamp_idx", "conversation_id", "timestamp", "id"
+        ),
+    )
+
+
+SUBACTIVITY_PATTERN = re.compile(r"^\[SUBACTIVITY\]\[([0-9a-fA-F-]{36})\]")
+
+
+def get_message_activity(content):
+    """Classify message content as (message_type, parent_activity_id) from its prefix"""
+    content = str(content)
+    if content.startswith("[ACTIVITY]"):
+        return "activity", None
+    if content.startswith("[SUBACTIVITY]"):
+        match = SUBACTIVITY_PATTERN.match(content)
+        return "subactivity", match.group(1) if match else None
+    return "message", None
+
+
+def migrate_message_activity_columns(batch_size: int = 1000):
+    """Add the activity columns and message indexes, then backfill the columns from content"""
+    columns = {column["name"] for column in inspect(engine).get_columns("message")}
+    id_type = "UUID" if DATABASE_TYPE != "sqlite" else "VARCHAR"
+    with engine.begin() as connection:
+        if "message_type" not in columns:
+            connection.execute(
+                text("ALTER TABLE message ADD COLUMN message_type VARCHAR")
+            )
+        if "parent_activity_id" not in columns:
+            connection.execute(
+                text(f"ALTER TABLE message ADD COLUMN parent_activity_id {id_type}")
+            )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS message_conversation_type_timestamp_idx
+                ON message (conversation_id, message_type, timestamp);
+                """
+            )
+        )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS message_parent_activity_idx
+                ON message (parent_activity_id, timestamp);
+                """
+            )
+        )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS message_conversation_timestamp_idx
+                ON message (conversation_id, timestamp, id);
+                """
+            )
+        )
+    migrated = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, content FROM message WHERE message_type IS NULL LIMIT :limit"
+                ),
+                {"limit": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for message_id, content in rows:
+                message_type, parent_activity_id = get_message_activity(content)
+                updates.append(
+                    {
+                        "id": message_id,
+                        "message_type": message_type,
+                        "parent_activity_id": parent_activity_id,
+                    }
+                )
+            connection.execute(
+                text(
+                    "UPDATE message SET message_type = :message_type, "
+                    f"parent_activity_id = CAST(:parent_activity_id AS {id_type}) "
+                    "WHERE id = :id"
+                ),
+                updates,
+            )
+            migrated += len(updates)
+    if migrated:
+        logging.info(f"Backfilled activity columns for {migrated} messages.")
+
+
+def migrate_task_leases():
+    """Add the task lease columns and the indexes the task scheduler claims by"""
+    columns = {column["name"] for column in inspect(engine).get_columns("task_item")}
+    with engine.begin() as connection:
+        if "lease_owner" not in columns:
+            connection.execute(
+                text("ALTER TABLE task_item ADD COLUMN lease_owner VARCHAR")
+            )
+        if "lease_expires_at" not in columns:
+            timestamp_type = "TIMESTAMP" if DATABASE_TYPE != "sqlite" else "DATETIME"
+            connection.execute(
+                text(
+                    f"ALTER TABLE task_item ADD COLUMN lease_expires_at {timestamp_type}"
+                )
+            )
+        if "attempts" not in columns:
+            connection.execute(
+                text(
+                    "ALTER TABLE task_item ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS task_item_due_idx
+                ON task_item (completed, scheduled, due_date);
+                """
+            )
+        )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS task_item_lease_idx
+                ON task_item (lease_owner, lease_expires_at);
+                """
+            )
+        )
+
+
+def migrate_token_usage():
+    """Move input_tokens and output_tokens totals out of user preferences into token_usage"""
+    session = get_session()
+    try:
+        preferences = (
+            session.query(UserPreferences)
+            .filter(UserPreferences.pref_key.in_(["input_tokens", "output_tokens"]))
+            .all()
+        )
+        if not preferences:
+            return
+        totals = {}
+        for preference in preferences:
+            try:
+                value = int(preference.pref_value or 0)
+            except ValueError:
+                value = 0
+            user_totals = totals.setdefault(
+                preference.user_id, {"input_tokens": 0, "output_tokens": 0}
+            )
+            user_totals[preference.pref_key] += value
+        today = datetime.now(timezone.utc).date()
+        for user_id, user_totals in totals.items():
+            if not user_totals["input_tokens"] and not user_totals["output_tokens"]:
+                continue
+            # Carried over totals land on the migration day with no agent or provider
+            usage = session.get(TokenUsage, (user_id, today, "", ""))
+            if usage is None:
+                session.add(
+                    TokenUsage(
+                        user_id=user_id,
+                        usage_date=today,
+                        agent_id="",
+                        provider="",
+                        **user_totals,
+                    )
+                )
+            else:
+                usage.input_tokens += user_totals["input_tokens"]
+                usage.output_tokens += user_totals["output_tokens"]
+        for preference in preferences:
+            session.delete(preference)
+        session.commit()
+        logging.info(f"Moved token usage of {len(totals)} users to token_usage.")
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error migrating token usage: {e}")
+    finally:
+        session.close()
 
 
 class Setting(Base):
@@ -696,8 +946,17 @@ class TaskItem(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     completed_at = Column(DateTime, nullable=True)
     priority = Column(Integer)
+    # Worker holding the task while it runs, and when its claim lapses if it crashes
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
     user = relationship("User", backref="task_item")
 
+    __table_args__ = (
+        Index("task_item_due_idx", "completed", "scheduled", "due_date"),
+        Index("task_item_lease_idx", "lease_owner", "lease_expires_at"),
+    )
+
 
 class Prompt(Base):
     __tablename__ = "prompt"
@@ -724,10 +983,59 @@ class Prompt(Base):
     arguments = relationship("Argument", backref="prompt", cascade="all, delete-orphan")
 
 
+# Binary vector formats, stored as a 4 byte header (format tag + padding) then the data
+VECTOR_FORMATS = {"float32": 0, "float16": 1, "int8": 2}
+VECTOR_STORAGE_FORMAT = str(getenv("VECTOR_STORAGE_FORMAT", "float32")).lower()
+if VECTOR_STORAGE_FORMAT not in VECTOR_FORMATS:
+    logging.warning(
+        f"Unknown VECTOR_STORAGE_FORMAT {VECTOR_STORAGE_FORMAT}, using float32"
+    )
+    VECTOR_STORAGE_FORMAT = "float32"
+
+
+def encode_vector(vector, storage_format=VECTOR_STORAGE_FORMAT) -> bytes:
+    """Serialize a vector to a little-endian binary blob"""
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    header = bytes([VECTOR_FORMATS[storage_format], 0, 0, 0])
+    if storage_format == "float16":
+        return header + vector.astype("<f2").tobytes()
+    if storage_format == "int8":
+        # Symmetric quantization with a per-row scale stored after the header
+        max_value = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = max_value / 127 if max_value else 1.0
+        quantized = np.clip(np.round(vector / scale), -127, 127).astype(np.int8)
+        return header + np.float32(scale).astype("<f4").tobytes() + quantized.tobytes()
+    return header + vector.astype("<f4").tobytes()
+
+
+def decode_vector(blob) -> np.ndarray:
+    """Deserialize a blob written by encode_vector, without copying float32 data"""
+    storage_format = blob[0]
+    if storage_format == VECTOR_FORMATS["float16"]:
+        return np.frombuffer(blob, dtype="<f2", offset=4)
+    if storage_format == VECTOR_FORMATS["int8"]:
+        scale = np.frombuffer(blob, dtype="<f4", count=1, offset=4)[0]
+        return np.frombuffer(blob, dtype=np.int8, offset=8).astype(np.float32) * scale
+    return np.frombuffer(blob, dtype="<f4", offset=4)
+
+
+def parse_text_vector(value: str):
+    """Parse the legacy '[0.1,0.2,...]' SQLite representation"""
+    try:
+        return np.array(json.loads(value), dtype=np.float32).reshape(-1)
+    except Exception:
+        return None
+
+
 class Vector(TypeDecorator):
     """Unified vector storage for both SQLite and PostgreSQL"""
 
-    impl = VARCHAR if DATABASE_TYPE == "sqlite" else ARRAY(Float)
+    if DATABASE_TYPE == "sqlite":
+        impl = LargeBinary
+    elif USE_PGVECTOR:
+        impl = PGVector(EMBEDDING_DIMENSION)
+    else:
+        impl = ARRAY(Float)
     cache_ok = True
 
     def process_bind_param(self, value, dialect):
@@ -735,6 +1043,10 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
+        # For SQLite, store as a binary blob
+        if DATABASE_TYPE == "sqlite":
+            return encode_vector(value)
+
         # Convert to numpy array and ensure 1D
         if isinstance(value, np.ndarray):
             value = value.reshape(-1).tolist()
@@ -742,11 +1054,7 @@ class Vector(TypeDecorator):
             # Handle nested lists
             value = np.array(value).reshape(-1).tolist()
 
-        # For SQLite, store as string representation
-        if DATABASE_TYPE == "sqlite":
-            return f'[{",".join(map(str, value))}]'
-
-        # For PostgreSQL, return as list
+        # For PostgreSQL, return as list (pgvector serializes it to its text format)
         return value
 
     def process_result_value(self, value, dialect):
@@ -754,17 +1062,51 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
-        # For SQLite, parse string representation
+        # For SQLite, decode the blob, or parse rows not yet migrated from text
         if DATABASE_TYPE == "sqlite":
-            try:
-                value = eval(value)
-            except:
-                return None
+            if isinstance(value, str):
+                return parse_text_vector(value)
+            return decode_vector(value)
 
         # Convert to 1D numpy array
         return np.array(value).reshape(-1)
 
 
+def migrate_sqlite_embeddings(batch_size: int = 1000):
+    """Rewrite text-encoded SQLite embeddings as binary blobs"""
+    if DATABASE_TYPE != "sqlite":
+        return
+    migrated = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, embedding FROM memory WHERE typeof(embedding) = 'text' LIMIT :limit"
+                ),
+                {"limit": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for memory_id, embedding in rows:
+                vector = parse_text_vector(embedding)
+                updates.append(
+                    {
+                        "id": memory_id,
+                        "embedding": (
+                            encode_vector(vector) if vector is not None else None
+                        ),
+                    }
+                )
+            connection.execute(
+                text("UPDATE memory SET embedding = :embedding WHERE id = :id"),
+                updates,
+            )
+            migrated += len(updates)
+    if migrated:
+        logging.info(f"Migrated {migrated} memory embeddings to binary storage.")
+
+
 # Update the embedding function to ensure consistent output shape
 def process_embedding_for_storage(embedding):
     """Ensure embedding is in the correct format for storage"""
@@ -812,6 +1154,12 @@ class Memory(Base):
         super().__init__(**kwargs)
 
 
+@event.listens_for(Memory.__table__, "before_create")
+def setup_vector_extension(target, connection, **kw):
+    if USE_PGVECTOR:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+
+
 @event.listens_for(Memory.__table__, "after_create")
 def setup_vector_column(target, connection, **kw):
     try:
@@ -826,6 +1174,61 @@ def setup_vector_column(target, connection, **kw):
         )
     except Exception as e:
         logging.error(f"Error setting up memory indices: {e}")
+    if USE_PGVECTOR:
+        create_vector_index(connection)
+
+
+def create_vector_index(connection):
+    """Create the approximate nearest neighbor index used by ORDER BY embedding <=> :q"""
+    index_type = str(getenv("PGVECTOR_INDEX", "hnsw")).lower()
+    if index_type == "ivfflat":
+        index_sql = """
+            CREATE INDEX IF NOT EXISTS memory_embedding_ivfflat_idx
+            ON memory USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+            """
+    else:
+        index_sql = """
+            CREATE INDEX IF NOT EXISTS memory_embedding_hnsw_idx
+            ON memory USING hnsw (embedding vector_cosine_ops);
+            """
+    try:
+        connection.execute(text(index_sql))
+    except Exception as e:
+        logging.error(f"Error creating vector index: {e}")
+
+
+def migrate_memory_embeddings():
+    """Convert an existing float8[] embedding column to vector, backfilling every row"""
+    if not USE_PGVECTOR:
+        return
+    with engine.begin() as connection:
+        column_type = connection.execute(
+            text(
+                """
+                SELECT udt_name FROM information_schema.columns
+                WHERE table_name = 'memory' AND column_name = 'embedding';
+                """
+            )
+        ).scalar()
+        if column_type is None or column_type == "vector":
+            return
+        logging.info("Migrating memory embeddings to pgvector...")
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        # Rows that don't match the embedding dimension can't be cast and are cleared
+        connection.execute(
+            text(
+                f"""
+                ALTER TABLE memory ALTER COLUMN embedding
+                TYPE vector({EMBEDDING_DIMENSION})
+                USING CASE
+                    WHEN array_length(embedding, 1) = {EMBEDDING_DIMENSION}
+                    THEN embedding::real[]::vector({EMBEDDING_DIMENSION})
+                END;
+                """
+            )
+        )
+        create_vector_index(connection)
+        logging.info("Memory embeddings migrated to pgvector.")
 
 
 def calculate_vector_similarity(query_embedding, stored_embedding):
@@ -866,40 +1269,266 @@ def calculate_vector_similarity(query_embedding, stored_embedding):
         return 0.0
 
 
-# Update the memory search query for both databases:
+def get_memory_signature(session, agent_id, conversation_id):
+    """Cheap fingerprint of a memory collection used to detect writes from other workers"""
+    count, latest = (
+        session.query(func.count(Memory.id), func.max(Memory.timestamp))
+        .filter(
+            Memory.agent_id == agent_id,
+            Memory.conversation_id == conversation_id,
+        )
+        .one()
+    )
+    return (count, str(latest))
+
+
+def get_memory_index(session, agent_id, conversation_id):
+    """Get the vector index for a memory collection, loading it from the memory table if cold"""
+    return memory_indexes.get(
+        agent_id,
+        conversation_id,
+        get_memory_signature(session, agent_id, conversation_id),
+        loader=lambda: session.query(Memory.id, Memory.embedding)
+        .filter(
+            Memory.agent_id == agent_id,
+            Memory.conversation_id == conversation_id,
+        )
+        .yield_per(1000),
+    )
+
+
+def index_memories(session, agent_id, conversation_id, ids, embeddings):
+    """Add committed memories to the collection's vector index"""
+
+    def signature(previous, added):
+        # Only this write is accounted for, rows other workers added since the index
+        # was loaded keep the signature behind the table's so the index reloads
+        count, latest = previous
+        inserted = None
+        for start in range(0, len(ids), 500):
+            batch_latest = (
+                session.query(func.max(Memory.timestamp))
+                .filter(Memory.id.in_(ids[start : start + 500]))
+                .scalar()
+            )
+            if batch_latest is not None and (
+                inserted is None or batch_latest > inserted
+            ):
+                inserted = batch_latest
+        if inserted is not None and (latest == "None" or str(inserted) > latest):
+            latest = str(inserted)
+        return (count + added, latest)
+
+    memory_indexes.add(agent_id, conversation_id, ids, embeddings, signature=signature)
+
+
+def unindex_memories(session, agent_id, rows):
+    """Remove deleted memories, given as (id, conversation_id) rows, from their vector indexes"""
+    by_collection = {}
+    for memory_id, conversation_id in rows:
+        by_collection.setdefault(conversation_id, []).append(memory_id)
+    for conversation_id, ids in by_collection.items():
+        # If the newest memory was deleted the table's latest timestamp moves back
+        # and the next search reloads the index, which is rare and always safe
+        memory_indexes.remove(
+            agent_id,
+            conversation_id,
+            ids,
+            signature=lambda previous, removed: (previous[0] - removed, previous[1]),
+        )
+
+
+MEMORY_COPY_COLUMNS = [
+    "id",
+    "agent_id",
+    "conversation_id",
+    "embedding",
+    "text",
+    "external_source",
+    "description",
+    "additional_metadata",
+]
+
+
+def format_copy_vector(vector):
+    """Render a vector in the text format COPY expects for the embedding column"""
+    if vector is None:
+        return None
+    values = ",".join(
+        map(str, np.asarray(vector, dtype=np.float32).reshape(-1).tolist())
+    )
+    return f"[{values}]" if USE_PGVECTOR else f"{{{values}}}"
+
+
+def bulk_insert_memories(session, rows):
+    """
+    Insert memory rows (dicts keyed by MEMORY_COPY_COLUMNS) in the session's transaction.
+
+    PostgreSQL streams the rows with COPY, other databases use a single executemany.
+    """
+    if not rows:
+        return
+    if DATABASE_TYPE != "sqlite":
+        cursor = session.connection().connection.cursor()
+        if hasattr(cursor, "copy_expert"):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+            for row in rows:
+                writer.writerow(
+                    [
+                        (
+                            format_copy_vector(row.get(column))
+                            if column == "embedding"
+                            else row.get(column)
+                        )
+                        for column in MEMORY_COPY_COLUMNS
+                    ]
+                )
+            buffer.seek(0)
+            columns = ", ".join(MEMORY_COPY_COLUMNS)
+            try:
+                # Every field is quoted, FORCE_NULL turns the empty nullable ones into NULL
+                cursor.copy_expert(
+                    f"COPY memory ({columns}) FROM STDIN WITH (FORMAT csv, "
+                    "FORCE_NULL (conversation_id, embedding, description, additional_metadata))",
+                    buffer,
+                )
+            finally:
+                cursor.close()
+            return
+        cursor.close()
+    session.execute(Memory.__table__.insert(), rows)
+
+
 def get_similar_memories(
     session, query_embedding, agent_id, conversation_id, limit, min_score
 ):
-    """Get similar memories using basic SQL and Python-based similarity calculation"""
-    try:
-        # Get all potentially relevant memories
-        memories = (
-            session.query(Memory)
-            .filter(
-                Memory.agent_id == agent_id,
-                or_(
-                    Memory.conversation_id == conversation_id,
-                    Memory.conversation_id == None,
-                ),
+    """Get similar memories from the core and conversation collections' vector indexes"""
+    return get_similar_memories_batch(
+        session, [query_embedding], agent_id, conversation_id, limit, min_score
+    )[0]
+
+
+def get_similar_memories_batch(
+    session, query_embeddings, agent_id, conversation_id, limit, min_score
+):
+    """Get similar memories for several query vectors, scored together per collection"""
+    if USE_PGVECTOR:
+        return [
+            get_similar_memories_pgvector(
+                session, query_embedding, agent_id, conversation_id, limit, min_score
             )
+            for query_embedding in query_embeddings
+        ]
+    try:
+        collections = [None]
+        if conversation_id:
+            collections.append(conversation_id)
+        candidates = [[] for _ in query_embeddings]
+        for collection_id in collections:
+            index = get_memory_index(session, agent_id, collection_id)
+            for query_candidates, results in zip(
+                candidates, index.search_many(query_embeddings, limit, min_score)
+            ):
+                query_candidates.extend(results)
+        for query_candidates in candidates:
+            query_candidates.sort(key=lambda x: x[1], reverse=True)
+            del query_candidates[limit:]
+        memory_ids = {
+            memory_id
+            for query_candidates in candidates
+            for memory_id, _ in query_candidates
+        }
+        if not memory_ids:
+            return [[] for _ in query_embeddings]
+
+        # Only the top results are loaded as full rows
+        memories = {
+            str(memory.id): memory
+            for memory in session.query(Memory)
+            .filter(Memory.id.in_(list(memory_ids)))
             .all()
-        )
-
-        # Calculate similarities
-        memory_scores = [
-            (mem, calculate_vector_similarity(query_embedding, mem.embedding))
-            for mem in memories
+        }
+        return [
+            [
+                (memories[str(memory_id)], score)
+                for memory_id, score in query_candidates
+                if str(memory_id) in memories
+            ]
+            for query_candidates in candidates
         ]
 
-        # Filter by minimum score and sort by similarity
-        filtered_memories = [
-            (mem, score) for mem, score in memory_scores if score >= min_score
-        ]
-        filtered_memories.sort(key=lambda x: x[1], reverse=True)
+    except Exception as e:
+        logging.error(f"Error in memory search: {e}")
+        return [[] for _ in query_embeddings]
+
 
-        # Return top N results
-        return filtered_memories[:limit]
+def configure_vector_search(session, limit):
+    """
+    Let the index look past candidates the agent and conversation filters discard.
 
+    Raises hnsw.ef_search for this transaction and, on pgvector 0.8 or newer, turns on
+    iterative scans so filtered searches keep scanning until `limit` rows match.
+    """
+    if str(getenv("PGVECTOR_INDEX", "hnsw")).lower() == "ivfflat":
+        settings = {"ivfflat.iterative_scan": "relaxed_order"}
+    else:
+        settings = {
+            "hnsw.ef_search": str(min(max(PGVECTOR_EF_SEARCH, limit), 1000)),
+            "hnsw.iterative_scan": "relaxed_order",
+        }
+    for name, value in settings.items():
+        try:
+            # Older pgvector versions reject unknown settings, keep the transaction usable
+            with session.begin_nested():
+                session.execute(
+                    text("SELECT set_config(:name, :value, true)"),
+                    {"name": name, "value": value},
+                )
+        except Exception as e:
+            logging.debug(f"Unable to set {name}: {e}")
+
+
+def get_similar_memories_pgvector(
+    session, query_embedding, agent_id, conversation_id, limit, min_score
+):
+    """Get similar memories with the cosine distance ordering and top-k done by PostgreSQL"""
+    try:
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        distance = Memory.embedding.cosine_distance(query_embedding)
+        collection_filter = (
+            or_(
+                Memory.conversation_id == conversation_id,
+                Memory.conversation_id == None,
+            )
+            if conversation_id
+            else Memory.conversation_id == None
+        )
+        rows = (
+            session.query(func.count(Memory.id))
+            .filter(Memory.agent_id == agent_id, collection_filter)
+            .scalar()
+        )
+        if rows <= PGVECTOR_EXACT_SEARCH_ROWS:
+            # Ordering by anything but the bare distance keeps the planner off the
+            # approximate index, so small collections are scored exactly
+            ordering = distance + 0
+        else:
+            configure_vector_search(session, limit)
+            ordering = distance
+        results = (
+            session.query(Memory, (1 - distance).label("similarity"))
+            .filter(
+                Memory.agent_id == agent_id,
+                collection_filter,
+                Memory.embedding != None,
+                distance <= 1 - min_score,
+            )
+            .order_by(ordering)
+            .limit(limit)
+            .all()
+        )
+        return [(memory, float(similarity)) for memory, similarity in results]
     except Exception as e:
         logging.error(f"Error in memory search: {e}")
         return []
@@ -934,6 +1563,11 @@ if __name__ == "__main__":
                 logging.error(f"Error connecting to database: {e}")
                 time.sleep(5)
     Base.metadata.create_all(engine)
+    migrate_memory_embeddings()
+    migrate_sqlite_embeddings()
+    migrate_message_activity_columns()
+    migrate_task_leases()
+    migrate_token_usage()
     setup_default_roles()
     seed_data = str(getenv("SEED_DATA")).lower() == "true"
     if seed_data:
@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import logging
+import threading
+import numpy as np
+from collections import deque, OrderedDict
+from typing import Dict, List, Union, Sequence, cast
+from onnxruntime import InferenceSession, SessionOptions, GraphOptimizationLevel
+from tokenizers import Tokenizer
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_MAX_LENGTH = 256
+# Queued requests drained per run, bucketed by length into EMBEDDING_BATCH_SIZE batches
+EMBEDDING_QUEUE_BATCHES = 8
+# How long the batching queue waits for more requests before running a partial batch
+EMBEDDING_BATCH_WAIT = float(getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000
+EMBEDDING_CACHE_MAX_BYTES = int(getenv("EMBEDDING_CACHE_MAX_MB", "64")) * 1024 * 1024
+# Optional SQLite file shared by all workers, disabled when empty
+EMBEDDING_CACHE_PATH = getenv("EMBEDDING_CACHE_PATH", "")
+
+
+class EmbeddingMetrics:
+    """Rolling throughput and latency statistics for the embedding engine"""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.vectors = 0
+        self.batches = 0
+        self.inference_seconds = 0.0
+
+    def record_batch(self, vectors: int, seconds: float):
+        with self.lock:
+            self.batches += 1
+            self.vectors += vectors
+            self.inference_seconds += seconds
+
+    def record_request(self, seconds: float):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else None
+            return {
+                "requests": self.requests,
+                "vectors": self.vectors,
+                "batches": self.batches,
+                "average_batch_size": (
+                    self.vectors / self.batches if self.batches else 0.0
+                ),
+                "vectors_per_second": (
+                    self.vectors / self.inference_seconds
+                    if self.inference_seconds
+                    else 0.0
+                ),
+                "p50_latency_ms": (
+                    float(np.percentile(latencies, 50) * 1000)
+                    if latencies is not None
+                    else 0.0
+                ),
+                "p99_latency_ms": (
+                    float(np.percentile(latencies, 99) * 1000)
+                    if latencies is not None
+                    else 0.0
+                ),
+            }
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache keyed by a hash of the model identity and text.
+
+    Vectors are kept in an in-memory LRU bounded by bytes, backed by an optional
+    SQLite file that uvicorn workers share so a text is only embedded once.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        path: str = EMBEDDING_CACHE_PATH,
+    ):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk = None
+        if path:
+            try:
+                self.disk = sqlite3.connect(path, check_same_thread=False, timeout=5)
+                self.disk.execute("PRAGMA journal_mode=WAL")
+                self.disk.execute(
+                    "CREATE TABLE IF NOT EXISTS embedding_cache (key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+                )
+                self.disk.commit()
+            except Exception as e:
+                logging.error(f"Error opening embedding cache at {path}: {e}")
+                self.disk = None
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode()).digest()
+
+    def get(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self.lock:
+            keys = {}
+            for text in set(texts):
+                key = self.key(text)
+                vector = self.entries.get(key)
+                if vector is None:
+                    keys[key] = text
+                    continue
+                self.entries.move_to_end(key)
+                found[text] = vector
+                self.memory_hits += 1
+            if keys and self.disk is not None:
+                try:
+                    placeholders = ",".join("?" * len(keys))
+                    rows = self.disk.execute(
+                        f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})",
+                        list(keys),
+                    ).fetchall()
+                except Exception as e:
+                    logging.error(f"Error reading embedding cache: {e}")
+                    rows = []
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[keys.pop(key)] = vector
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+            self.misses += len(keys)
+        return found
+
+    def put(self, vectors: Dict[str, np.ndarray]):
+        if not vectors:
+            return
+        with self.lock:
+            rows = []
+            for text, vector in vectors.items():
+                key = self.key(text)
+                # A copy, so a cached row doesn't keep the whole batch it came from alive
+                vector = np.array(vector, dtype=np.float32, copy=True)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes()))
+            if self.disk is not None:
+                try:
+                    self.disk.executemany(
+                        "INSERT OR IGNORE INTO embedding_cache (key, vector) VALUES (?, ?)",
+                        rows,
+                    )
+                    self.disk.commit()
+                except Exception as e:
+                    logging.error(f"Error writing embedding cache: {e}")
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+        if vector.nbytes > self.max_bytes:
+            return
+        self.entries[key] = vector
+        self.size += vector.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+
+def get_model_id(model_path: str) -> str:
+    """Identify the embedding model by the digest of its weights"""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return f"{digest.hexdigest()}:{EMBEDDING_MAX_LENGTH}"
+
+
+def get_embedding_dimension(model_directory: str = None) -> int:
+    """Width of the vectors the model in `model_directory` produces, read from its config"""
+    model_directory = model_directory or os.path.join(os.getcwd(), "onnx")
+    with open(os.path.join(model_directory, "config.json"), "r") as f:
+        return int(json.load(f)["hidden_size"])
+
+
+class EmbeddingEngine:
+    """
+    Process-wide ONNX MiniLM embedder.
+
+    The tokenizer and inference session are loaded once per worker. Async callers go
+    through a micro-batching queue that merges concurrent requests into full batches,
+    and texts that were embedded before are served from the EmbeddingCache.
+    """
+
+    def __init__(self, model_directory: str = None):
+        model_directory = model_directory or os.path.join(os.getcwd(), "onnx")
+        self.tokenizer = Tokenizer.from_file(
+            os.path.join(model_directory, "tokenizer.json")
+        )
+        # Padding is applied per batch to the longest input instead of a fixed length
+        self.tokenizer.enable_truncation(max_length=EMBEDDING_MAX_LENGTH)
+        self.tokenizer.no_padding()
+        options = SessionOptions()
+        options.intra_op_num_threads = int(getenv("EMBEDDING_INTRA_OP_THREADS", "0"))
+        options.inter_op_num_threads = int(getenv("EMBEDDING_INTER_OP_THREADS", "1"))
+        options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_path = os.path.join(model_directory, "model.onnx")
+        self.model = InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.cache = EmbeddingCache(get_model_id(model_path))
+        self.dimension = get_embedding_dimension(model_directory)
+        self.metrics = EmbeddingMetrics()
+        self.queues = {}
+        self.inflight = {}
+
+    def run_encodings(self, encoded) -> np.ndarray:
+        """Run one batch of tokenized inputs, padded to its longest input, through the model"""
+        start = time.perf_counter()
+        length = max(len(e.ids) for e in encoded)
+        input_ids = np.zeros((len(encoded), length), dtype=np.int64)
+        attention_mask = np.zeros((len(encoded), length), dtype=np.int64)
+        for row, e in enumerate(encoded):
+            input_ids[row, : len(e.ids)] = e.ids
+            attention_mask[row, : len(e.ids)] = e.attention_mask
+        onnx_input = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
+        }
+        model_output = self.model.run(None, onnx_input)
+        last_hidden_state = model_output[0]
+        input_mask_expanded = np.broadcast_to(
+            np.expand_dims(attention_mask, -1), last_hidden_state.shape
+        )
+        embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
+            input_mask_expanded.sum(1), a_min=1e-9, a_max=None
+        )
+        norm = np.linalg.norm(embeddings, axis=1)
+        norm[norm == 0] = 1e-12
+        embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
+        self.metrics.record_batch(len(encoded), time.perf_counter() - start)
+        return embeddings
+
+    def embed(self, input: List[str]) -> np.ndarray:
+        start = time.perf_counter()
+        if not input:
+            return np.zeros((0, 0), dtype=np.float32)
+        vectors = self.cache.get(input)
+        missing = list(dict.fromkeys(text for text in input if text not in vectors))
+        if missing:
+            computed = dict(zip(missing, self.embed_bucketed(missing)))
+            self.cache.put(computed)
+            vectors.update(computed)
+        embeddings = np.stack([vectors[text] for text in input])
+        self.metrics.record_request(time.perf_counter() - start)
+        return embeddings
+
+    def embed_bucketed(self, input: List[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(input)
+        # Batch inputs of similar length together so little compute goes to padding
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i].ids))
+        embeddings = None
+        for i in range(0, len(order), EMBEDDING_BATCH_SIZE):
+            rows = order[i : i + EMBEDDING_BATCH_SIZE]
+            batch = self.run_encodings([encoded[row] for row in rows])
+            if embeddings is None:
+                embeddings = np.empty((len(input), batch.shape[1]), dtype=np.float32)
+            embeddings[rows] = batch
+        return embeddings
+
+    async def embed_async(self, input: List[str]) -> np.ndarray:
+        """Embed through the micro-batching queue shared by all in-flight requests"""
+        if not input:
+            return np.zeros((0, 0), dtype=np.float32)
+        start = time.perf_counter()
+        vectors = self.cache.get(input)
+        missing = list(dict.fromkeys(text for text in input if text not in vectors))
+        if missing:
+            computed = dict(zip(missing, await self._queue_embed(missing)))
+            self.cache.put(computed)
+            vectors.update(computed)
+        embeddings = np.stack([vectors[text] for text in input])
+        self.metrics.record_request(time.perf_counter() - start)
+        return embeddings
+
+    async def _queue_embed(self, input: List[str]) -> List[np.ndarray]:
+        loop = asyncio.get_running_loop()
+        queue = self.queues.get(loop)
+        if queue is None:
+            self.queues = {
+                key: value for key, value in self.queues.items() if not key.is_closed()
+            }
+            queue = asyncio.Queue()
+            self.queues[loop] = queue
+            loop.create_task(self._batch_worker(queue))
+        futures = []
+        for text in input:
+            # Concurrent requests for the same text share one queued embedding
+            key = (loop, text)
+            future = self.inflight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self.inflight[key] = future
+                future.add_done_callback(
+                    lambda _, key=key: self.inflight.pop(key, None)
+                )
+                queue.put_nowait((text, future))
+            futures.append(asyncio.shield(future))
+        return await asyncio.gather(*futures)
+
+    async def _batch_worker(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await queue.get()]
+            deadline = loop.time() + EMBEDDING_BATCH_WAIT
+            while len(pending) < EMBEDDING_BATCH_SIZE or not queue.empty():
+                if len(pending) >= EMBEDDING_BATCH_SIZE * EMBEDDING_QUEUE_BATCHES:
+                    break
+                if queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    pending.append(queue.get_nowait())
+            pending = [item for item in pending if not item[1].cancelled()]
+            if not pending:
+                continue
+            try:
+                embeddings = await asyncio.to_thread(
+                    self.embed_bucketed, [text for text, _ in pending]
+                )
+                for (_, future), embedding in zip(pending, embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
+            except Exception as e:
+                logging.error(f"Error embedding batch: {e}")
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_embedding_engine() -> EmbeddingEngine:
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = EmbeddingEngine()
+    return _engine
+
+
+def get_embedding_metrics() -> dict:
+    if _engine is None:
+        return EmbeddingMetrics().snapshot()
+    return _engine.metrics.snapshot()
+
+
+def get_embedding_cache_metrics() -> dict:
+    if _engine is None:
+        return EmbeddingCache(model_id="", path="").snapshot()
+    return _engine.cache.snapshot()
+
+
+def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+    return cast(
+        List[Union[Sequence[float], Sequence[int]]],
+        get_embedding_engine().embed(input),
+    ).tolist()
+
+
+async def embed_async(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+    return cast(
+        List[Union[Sequence[float], Sequence[int]]],
+        await get_embedding_engine().embed_async(input),
+    ).tolist()
@@ -1,23 +1,27 @@
+import copy
 import importlib
 import os
 import glob
+import threading
+import time
 from inspect import signature, Parameter
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Optional, Tuple
 import logging
 import inspect
 from Globals import getenv, DEFAULT_USER
 from MagicalAuth import get_user_id, get_sso_credentials
+from IdentityCache import SharedCacheVersion, invalidate_on_commit
+from ChainPlans import get_chain_plan
 from agixtsdk import AGiXTSDK
 from Prompts import Prompts
 from DB import (
     get_session,
     Chain as ChainDB,
     ChainStep,
-    Agent,
     Argument,
     ChainStepArgument,
     Prompt,
-    Command,
-    User,
 )
 
 logging.basicConfig(
@@ -25,6 +29,219 @@ logging.basicConfig(
     format=getenv("LOG_FORMAT"),
 )
 DISABLED_EXTENSIONS = getenv("DISABLED_EXTENSIONS").replace(" ", "").split(",")
+# Seconds a user's chains are offered as commands before they are reloaded
+CHAIN_COMMANDS_CACHE_TTL = int(getenv("CHAIN_COMMANDS_CACHE_TTL", "300"))
+# Models whose changes alter the chains offered as commands or their arguments
+CHAIN_COMMAND_MODELS = (ChainDB, ChainStep, ChainStepArgument, Argument, Prompt)
+CHAIN_SKIP_ARGS = [
+    "command_list",
+    "context",
+    "COMMANDS",
+    "date",
+    "conversation_history",
+    "agent_name",
+    "working_directory",
+    "helper_agent_name",
+]
+
+
+def get_command_params(func):
+    params = {}
+    sig = signature(func)
+    for name, param in sig.parameters.items():
+        if name == "self":
+            continue
+        if param.default == Parameter.empty:
+            params[name] = ""
+        else:
+            params[name] = param.default
+    return params
+
+
+class ExtensionCommand(NamedTuple):
+    friendly_name: str
+    extension: type
+    function_name: str
+    params: dict
+    description: str
+
+
+class ExtensionInfo(NamedTuple):
+    module_name: str
+    extension_name: str
+    description: str
+    settings: Tuple[str, ...]
+    setting_params: dict
+    commands: Tuple[str, ...]
+
+
+class ExtensionRegistry:
+    """
+    Every extension and command this worker offers, built once.
+
+    Importing and instantiating all extensions is the expensive part of building an
+    agent, and what they offer only depends on the code and environment, so it is
+    done once per process. Per-agent enablement and chains are overlaid on top.
+    Parameter dicts are shared, callers copy them before changing them.
+    """
+
+    def __init__(self, extensions, commands):
+        self.extensions: Tuple[ExtensionInfo, ...] = tuple(extensions)
+        self.commands = MappingProxyType(commands)
+
+    @classmethod
+    def build(cls):
+        extensions = []
+        commands: Dict[str, ExtensionCommand] = {}
+        for command_file in sorted(glob.glob("extensions/*.py")):
+            module_name = os.path.splitext(os.path.basename(command_file))[0]
+            if module_name in DISABLED_EXTENSIONS:
+                continue
+            try:
+                module = importlib.import_module(f"extensions.{module_name}")
+                extension_class = getattr(module, module_name)
+                command_class = extension_class()
+            except Exception as e:
+                logging.error(f"Error loading extension {module_name}: {e}")
+                continue
+            extension_name = module_name.replace("_", " ").title()
+            if extension_name == "Agixt Actions":
+                extension_name = "AGiXT Actions"
+            try:
+                extension_description = inspect.getdoc(command_class)
+            except:
+                extension_description = extension_name
+            constructor = inspect.signature(command_class.__init__)
+            setting_params = get_command_params(command_class.__init__)
+            setting_params.pop("kwargs", None)
+            extension_commands = []
+            if issubclass(extension_class, Extensions) and hasattr(
+                command_class, "commands"
+            ):
+                for command_name, command_function in command_class.commands.items():
+                    try:
+                        command_description = inspect.getdoc(command_function)
+                    except:
+                        command_description = command_name
+                    commands[command_name] = ExtensionCommand(
+                        friendly_name=command_name,
+                        extension=extension_class,
+                        function_name=command_function.__name__,
+                        params=get_command_params(command_function),
+                        description=command_description,
+                    )
+                    extension_commands.append(command_name)
+            extensions.append(
+                ExtensionInfo(
+                    module_name=module_name,
+                    extension_name=extension_name,
+                    description=extension_description,
+                    settings=tuple(
+                        name
+                        for name in constructor.parameters
+                        if name != "self" and name != "kwargs"
+                    ),
+                    setting_params=(
+                        setting_params
+                        if issubclass(extension_class, Extensions)
+                        else {}
+                    ),
+                    commands=tuple(extension_commands),
+                )
+            )
+        logging.info(
+            f"Registered {len(commands)} commands from {len(extensions)} extensions."
+        )
+        return cls(extensions, commands)
+
+
+_registry: Optional[ExtensionRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_extension_registry() -> ExtensionRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ExtensionRegistry.build()
+    return _registry
+
+
+class ChainCommandCache:
+    """
+    Chains each user can run as commands, with the arguments they take.
+
+    Resolving a chain's arguments walks every step, prompt and command it uses, so the
+    result is kept per user. Any committed change to chains, steps, arguments or
+    prompts clears every user's entry, because users also see the default user's
+    chains, and bumps the shared "chain_commands" version for other workers.
+    """
+
+    def __init__(self, ttl: int = CHAIN_COMMANDS_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[str, tuple] = {}
+        self.generation = 0
+        self.version = SharedCacheVersion("chain_commands")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, loader):
+        """(chain names, chains with args) of a user, loading them on a miss"""
+        if self.version.changed():
+            self.clear()
+        key = str(user_id)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            generation = self.generation
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                entry = None
+            else:
+                self.hits += 1
+        if entry is None:
+            value = loader()
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (copy.deepcopy(value), now + self.ttl)
+            return value
+        return copy.deepcopy(entry[0])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def invalidate(self):
+        self.clear()
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+chain_commands = ChainCommandCache()
+
+
+def get_extension_registry_metrics() -> dict:
+    registry = get_extension_registry()
+    return {
+        "extensions": len(registry.extensions),
+        "commands": len(registry.commands),
+        "chain_commands": chain_commands.metrics(),
+    }
+
+
+invalidate_on_commit(CHAIN_COMMAND_MODELS, chain_commands.invalidate)
 
 
 class Extensions:
@@ -53,8 +270,9 @@ class Extensions:
         self.user = user
         self.user_id = get_user_id(self.user)
         self.prompts = Prompts(user=self.user)
-        self.chains = self.get_chains()
-        self.chains_with_args = self.get_chains_with_args()
+        self.chains, self.chains_with_args = chain_commands.get(
+            self.user_id, self.load_chains
+        )
         if agent_config != None:
             if "commands" not in self.agent_config:
                 self.agent_config["commands"] = {}
@@ -104,13 +322,23 @@ class Extensions:
         return enabled_commands
 
     def get_command_args(self, command_name: str):
-        extensions = self.get_extensions()
-        for extension in extensions:
-            for command in extension["commands"]:
-                if command["friendly_name"] == command_name:
-                    return command["command_args"]
+        command = get_extension_registry().commands.get(command_name)
+        if command:
+            return dict(command.params)
+        for chain in self.chains_with_args or []:
+            if chain["chain_name"] == command_name:
+                return {
+                    "chain_name": command_name,
+                    "user_input": "",
+                    **{arg: "" for arg in chain["args"]},
+                }
         return {}
 
+    def load_chains(self):
+        self.chains = self.get_chains()
+        self.chains_with_args = None
+        return self.chains, self.get_chains_with_args()
+
     def get_chains(self):
         session = get_session()
         chains = session.query(ChainDB).filter(ChainDB.user_id == self.user_id).all()
@@ -121,91 +349,13 @@ class Extensions:
         return chain_list
 
     def get_chain(self, chain_name):
-        session = get_session()
-        chain_name = chain_name.replace("%20", " ")
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        chain_db = (
-            session.query(ChainDB)
-            .filter(ChainDB.user_id == user_data.id, ChainDB.name == chain_name)
-            .first()
-        )
-        if chain_db is None:
-            chain_db = (
-                session.query(ChainDB)
-                .filter(
-                    ChainDB.name == chain_name,
-                    ChainDB.user_id == self.user_id,
-                )
-                .first()
-            )
-        if chain_db is None:
-            session.close()
+        plan = get_chain_plan(self.user_id, chain_name)
+        if plan is None:
             return []
-        chain_steps = (
-            session.query(ChainStep)
-            .filter(ChainStep.chain_id == chain_db.id)
-            .order_by(ChainStep.step_number)
-            .all()
-        )
-
-        steps = []
-        for step in chain_steps:
-            agent_name = session.query(Agent).get(step.agent_id).name
-            prompt = {}
-            if step.target_chain_id:
-                prompt["chain_name"] = (
-                    session.query(ChainDB).get(step.target_chain_id).name
-                )
-            elif step.target_command_id:
-                prompt["command_name"] = (
-                    session.query(Command).get(step.target_command_id).name
-                )
-            elif step.target_prompt_id:
-                prompt["prompt_name"] = (
-                    session.query(Prompt).get(step.target_prompt_id).name
-                )
-
-            # Retrieve argument data for the step
-            arguments = (
-                session.query(Argument, ChainStepArgument)
-                .join(ChainStepArgument, ChainStepArgument.argument_id == Argument.id)
-                .filter(ChainStepArgument.chain_step_id == step.id)
-                .all()
-            )
-
-            prompt_args = {}
-            for argument, chain_step_argument in arguments:
-                prompt_args[argument.name] = chain_step_argument.value
-
-            prompt.update(prompt_args)
-
-            step_data = {
-                "step": step.step_number,
-                "agent_name": agent_name,
-                "prompt_type": step.prompt_type,
-                "prompt": prompt,
-            }
-            steps.append(step_data)
-
-        chain_data = {
-            "id": chain_db.id,
-            "chain_name": chain_db.name,
-            "steps": steps,
-        }
-        session.close()
-        return chain_data
+        return plan.to_dict()
 
     def get_chains_with_args(self):
-        skip_args = [
-            "command_list",
-            "context",
-            "COMMANDS",
-            "date",
-            "conversation_history",
-            "agent_name",
-            "working_directory",
-            "helper_agent_name",
-        ]
+        skip_args = CHAIN_SKIP_ARGS
         chains = []
         for chain_name in self.chains:
             chain_data = self.get_chain(chain_name=chain_name)
@@ -243,33 +393,15 @@ class Extensions:
         return chains
 
     def load_commands(self):
-        try:
-            settings = self.agent_config["settings"]
-        except:
-            settings = {}
-        commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)(**settings)
-                if hasattr(command_class, "commands"):
-                    for (
-                        command_name,
-                        command_function,
-                    ) in command_class.commands.items():
-                        params = self.get_command_params(command_function)
-                        commands.append(
-                            (
-                                command_name,
-                                getattr(module, module_name),
-                                command_function.__name__,
-                                params,
-                            )
-                        )
+        commands = [
+            (
+                command.friendly_name,
+                command.extension,
+                command.function_name,
+                dict(command.params),
+            )
+            for command in get_extension_registry().commands.values()
+        ]
 
         # Add chains as commands
         if hasattr(self, "chains_with_args") and self.chains_with_args:
@@ -303,22 +435,9 @@ class Extensions:
 
     def get_extension_settings(self):
         settings = {}
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)()
-                params = self.get_command_params(command_class.__init__)
-                # Remove self and kwargs from params
-                if "self" in params:
-                    del params["self"]
-                if "kwargs" in params:
-                    del params["kwargs"]
-                if params != {}:
-                    settings[module_name] = params
+        for extension in get_extension_registry().extensions:
+            if extension.setting_params:
+                settings[extension.module_name] = dict(extension.setting_params)
 
         # Use self.chains_with_args instead of iterating over self.chains
         if self.chains_with_args:
@@ -390,66 +509,28 @@ class Extensions:
             )(**args)
 
     def get_command_params(self, func):
-        params = {}
-        sig = signature(func)
-        for name, param in sig.parameters.items():
-            if name == "self":
-                continue
-            if param.default == Parameter.empty:
-                params[name] = ""
-            else:
-                params[name] = param.default
-        return params
+        return get_command_params(func)
 
     def get_extensions(self):
+        registry = get_extension_registry()
         commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            command_class = getattr(module, module_name.lower())()
-            extension_name = command_file.split("/")[-1].split(".")[0]
-            extension_name = extension_name.replace("_", " ").title()
-            try:
-                extension_description = inspect.getdoc(command_class)
-            except:
-                extension_description = extension_name
-            constructor = inspect.signature(command_class.__init__)
-            params = constructor.parameters
-            extension_settings = [
-                name for name in params if name != "self" and name != "kwargs"
-            ]
+        for extension in registry.extensions:
             extension_commands = []
-            if hasattr(command_class, "commands"):
-                try:
-                    for (
-                        command_name,
-                        command_function,
-                    ) in command_class.commands.items():
-                        params = self.get_command_params(command_function)
-                        try:
-                            command_description = inspect.getdoc(command_function)
-                        except:
-                            command_description = command_name
-                        extension_commands.append(
-                            {
-                                "friendly_name": command_name,
-                                "description": command_description,
-                                "command_name": command_function.__name__,
-                                "command_args": params,
-                            }
-                        )
-                except Exception as e:
-                    logging.error(f"Error getting commands: {e}")
-            if extension_name == "Agixt Actions":
-                extension_name = "AGiXT Actions"
+            for command_name in extension.commands:
+                command = registry.commands[command_name]
+                extension_commands.append(
+                    {
+                        "friendly_name": command.friendly_name,
+                        "description": command.description,
+                        "command_name": command.function_name,
+                        "command_args": dict(command.params),
+                    }
+                )
             commands.append(
                 {
-                    "extension_name": extension_name,
-                    "description": extension_description,
-                    "settings": extension_settings,
+                    "extension_name": extension.extension_name,
+                    "description": extension.description,
+                    "settings": list(extension.settings),
                     "commands": extension_commands,
                 }
             )
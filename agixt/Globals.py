@@ -1,6 +1,8 @@
 import os
 import json
+import threading
 import tiktoken
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -69,12 +71,91 @@ def getenv(var_name: str, default_value: str = "") -> str:
     return os.getenv(var_name, default_value)
 
 
+# Strings at least this long have their token counts memoized
+TOKEN_COUNT_CACHE_MIN_LENGTH = int(getenv("TOKEN_COUNT_CACHE_MIN_LENGTH", "1024"))
+# Number of memoized token counts kept per worker
+TOKEN_COUNT_CACHE_SIZE = int(getenv("TOKEN_COUNT_CACHE_SIZE", "2048"))
+_encoding = None
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def get_encoding():
+    """The process-wide cl100k_base encoder"""
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
 def get_tokens(text: str) -> int:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(text))
+    """
+    Number of cl100k_base tokens in text.
+
+    Counts of long strings such as context blocks, personas and command prompts are
+    memoized by (length, hash), so counting the same block again costs one hash.
+    """
+    text = str(text) if text is not None else ""
+    if len(text) < TOKEN_COUNT_CACHE_MIN_LENGTH:
+        return len(get_encoding().encode_ordinary(text))
+    key = (len(text), hash(text))
+    with _token_counts_lock:
+        num_tokens = _token_counts.get(key)
+        if num_tokens is not None:
+            _token_counts.move_to_end(key)
+            return num_tokens
+    num_tokens = len(get_encoding().encode_ordinary(text))
+    with _token_counts_lock:
+        _token_counts[key] = num_tokens
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
     return num_tokens
 
 
+def estimate_tokens(text: str) -> int:
+    """
+    Upper bound on get_tokens(text) without tokenizing.
+
+    Every cl100k_base token covers at least one UTF-8 byte, so the byte length is a
+    safe bound for checks that only need to know a text fits under a limit.
+    """
+    if not text:
+        return 0
+    text = str(text)
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-8"))
+
+
+class TokenCounter:
+    """
+    Running token total of a prompt assembled section by section.
+
+    Each section is counted once when it is added, so checking the budget after every
+    append doesn't re-tokenize what came before. The total can differ from counting
+    the joined text by about one token per section boundary.
+    """
+
+    def __init__(self, *sections: str):
+        self.total = 0
+        for section in sections:
+            self.add(section)
+
+    def add(self, text: str) -> int:
+        tokens = get_tokens(text) if text else 0
+        self.total += tokens
+        return tokens
+
+    def fits(self, text: str, limit: int) -> bool:
+        """Whether text can be added without the total going over limit"""
+        if self.total + estimate_tokens(text) <= limit:
+            return True
+        return self.total + get_tokens(text) <= limit
+
+    def __int__(self):
+        return self.total
+
+
 def get_default_agent_settings():
     if os.path.exists("default_agent.json"):
         with open("default_agent.json", "r") as f:
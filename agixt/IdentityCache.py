@@ -0,0 +1,334 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from typing import Callable, Dict, Hashable, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from DB import Agent, CacheVersion, Conversation, User, UserCompany, get_session
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Seconds a resolved id is reused before it is looked up again
+IDENTITY_CACHE_TTL = int(getenv("IDENTITY_CACHE_TTL", "300"))
+# Resolutions each identity cache keeps per worker, least recently used are evicted first
+IDENTITY_CACHE_SIZE = int(getenv("IDENTITY_CACHE_SIZE", "10000"))
+# Seconds between checks of the shared version row for invalidations by other workers
+IDENTITY_CACHE_VERSION_CHECK = float(getenv("IDENTITY_CACHE_VERSION_CHECK", "5"))
+IDENTITY_CACHE_VERSION_NAME = "identity"
+
+
+class IdentityCache:
+    """
+    LRU of one kind of name to id resolution with a TTL, and hit and miss counters.
+
+    Expired entries are dropped when they are read or reach the front of the LRU.
+    Every invalidation starts a new generation, and a lookup only stores what it
+    loaded if no invalidation happened meanwhile, so a rename or delete can't be
+    undone by a load that read the old row.
+    """
+
+    def __init__(self, ttl: int = IDENTITY_CACHE_TTL, size: int = IDENTITY_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Optional[object]]):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            generation = self.generation
+        value = loader()
+        # Missing identities aren't cached so they resolve as soon as they're created
+        if value is not None:
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (value, now + self.ttl)
+                    self.entries.move_to_end(key)
+                    self.evict(now)
+        return value
+
+    def evict(self, now: float):
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if len(self.entries) <= self.size and oldest[1] > now:
+                break
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable = None):
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SharedCacheVersion:
+    """
+    Counter row in `cache_version` that tells every worker to drop a local cache.
+
+    changed() reads the row at most once every `interval` seconds and reports whether
+    it moved since the last read. bump() moves it.
+    """
+
+    def __init__(self, name: str, interval: float = IDENTITY_CACHE_VERSION_CHECK):
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0.0
+
+    def changed(self) -> bool:
+        now = time.monotonic()
+        if now - self.checked_at < self.interval:
+            return False
+        with self.lock:
+            if now - self.checked_at < self.interval:
+                return False
+            self.checked_at = now
+            session = get_session()
+            try:
+                version = (
+                    session.query(CacheVersion.version)
+                    .filter(CacheVersion.name == self.name)
+                    .scalar()
+                ) or 0
+            except Exception as e:
+                logging.warning(f"Unable to check {self.name} cache version: {e}")
+                return False
+            finally:
+                session.close()
+            changed = self.version is not None and version != self.version
+            self.version = version
+            return changed
+
+    def bump(self):
+        session = get_session()
+        try:
+            updated = (
+                session.query(CacheVersion)
+                .filter(CacheVersion.name == self.name)
+                .update({CacheVersion.version: CacheVersion.version + 1})
+            )
+            if not updated:
+                session.add(CacheVersion(name=self.name, version=1))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.warning(f"Unable to bump {self.name} cache version: {e}")
+        finally:
+            session.close()
+
+
+def invalidate_on_commit(models: tuple, invalidate: Callable[[], None]):
+    """
+    Call `invalidate` once after every commit that wrote any of `models`.
+
+    Writes are noticed both through the unit of work and through bulk update and
+    delete statements, and forgotten if the transaction is rolled back instead.
+    """
+
+    def track_flush(session, flush_context):
+        if any(
+            isinstance(instance, models)
+            for instance in chain(session.new, session.dirty, session.deleted)
+        ):
+            session.info.setdefault("pending_invalidations", []).append(invalidate)
+
+    def track_bulk(orm_execute_state):
+        if (orm_execute_state.is_update or orm_execute_state.is_delete) and any(
+            issubclass(mapper.class_, models)
+            for mapper in orm_execute_state.all_mappers
+        ):
+            orm_execute_state.session.info.setdefault(
+                "pending_invalidations", []
+            ).append(invalidate)
+
+    event.listen(Session, "after_flush", track_flush)
+    event.listen(Session, "do_orm_execute", track_bulk)
+
+
+@event.listens_for(Session, "after_commit")
+def run_pending_invalidations(session):
+    pending = session.info.pop("pending_invalidations", [])
+    for invalidate in dict.fromkeys(pending):
+        try:
+            invalidate()
+        except Exception as e:
+            logging.warning(f"Error invalidating cache after commit: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_pending_invalidations(session):
+    session.info.pop("pending_invalidations", None)
+
+
+class IdentityRegistry:
+    """
+    Process-wide identity caches for users, conversations, agents and the company
+    each user belongs to.
+
+    Renames and deletes invalidate locally and bump the shared "identity" version,
+    which every worker checks at most once every IDENTITY_CACHE_VERSION_CHECK seconds
+    and clears its caches when it moved.
+    """
+
+    def __init__(self):
+        self.users = IdentityCache()
+        self.conversations = IdentityCache()
+        self.agents = IdentityCache()
+        self.companies = IdentityCache()
+        self.version = SharedCacheVersion(IDENTITY_CACHE_VERSION_NAME)
+
+    def caches(self) -> Dict[str, IdentityCache]:
+        return {
+            "users": self.users,
+            "conversations": self.conversations,
+            "agents": self.agents,
+            "companies": self.companies,
+        }
+
+    def clear(self):
+        for cache in self.caches().values():
+            cache.invalidate()
+
+    def get(self, cache: IdentityCache, key: Hashable, loader: Callable):
+        if self.version.changed():
+            self.clear()
+        return cache.get(key, loader)
+
+    def invalidate(self, cache: IdentityCache, key: Hashable):
+        cache.invalidate(key)
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        return {name: cache.metrics() for name, cache in self.caches().items()}
+
+
+identities = IdentityRegistry()
+
+
+def load_user_id(email: str):
+    session = get_session()
+    try:
+        return session.query(User.id).filter(User.email == email).scalar()
+    finally:
+        session.close()
+
+
+def load_conversation_id(user_id, conversation_name: str):
+    session = get_session()
+    try:
+        return (
+            session.query(Conversation.id)
+            .filter(
+                Conversation.name == conversation_name,
+                Conversation.user_id == user_id,
+            )
+            .limit(1)
+            .scalar()
+        )
+    finally:
+        session.close()
+
+
+def load_agent_id(user_id, agent_name: str):
+    session = get_session()
+    try:
+        return (
+            session.query(Agent.id)
+            .filter(Agent.name == agent_name, Agent.user_id == user_id)
+            .limit(1)
+            .scalar()
+        )
+    finally:
+        session.close()
+
+
+def load_user_company_id(user_id):
+    session = get_session()
+    try:
+        company_id = (
+            session.query(UserCompany.company_id)
+            .filter(UserCompany.user_id == user_id)
+            .limit(1)
+            .scalar()
+        )
+        return str(company_id) if company_id else None
+    finally:
+        session.close()
+
+
+def resolve_user_id(email: str):
+    """User id for an email, or None if there is no such user"""
+    return identities.get(identities.users, email, lambda: load_user_id(email))
+
+
+def resolve_conversation_id(user_id, conversation_name: str):
+    """Id of the user's conversation with this name, or None if it doesn't exist"""
+    return identities.get(
+        identities.conversations,
+        (str(user_id), conversation_name),
+        lambda: load_conversation_id(user_id, conversation_name),
+    )
+
+
+def resolve_agent_id(user_id, agent_name: str):
+    """Id of the user's agent with this name, or None if it doesn't exist"""
+    return identities.get(
+        identities.agents,
+        (str(user_id), agent_name),
+        lambda: load_agent_id(user_id, agent_name),
+    )
+
+
+def resolve_user_company_id(user_id):
+    """Id of a company the user belongs to, or None if they have none"""
+    return identities.get(
+        identities.companies,
+        str(user_id),
+        lambda: load_user_company_id(user_id),
+    )
+
+
+def invalidate_conversation(user_id, conversation_name: str):
+    identities.invalidate(identities.conversations, (str(user_id), conversation_name))
+
+
+def invalidate_agent(user_id, agent_name: str):
+    identities.invalidate(identities.agents, (str(user_id), agent_name))
+
+
+def invalidate_user_company(user_id):
+    identities.invalidate(identities.companies, str(user_id))
+
+
+def get_identity_cache_metrics() -> dict:
+    return identities.metrics()
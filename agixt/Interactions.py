@@ -20,7 +20,8 @@ from ApiClient import (
     AGIXT_URI,
 )
 from MagicalAuth import MagicalAuth, impersonate_user
-from Globals import getenv, DEFAULT_USER, get_tokens
+from Globals import getenv, DEFAULT_USER, TokenCounter, get_tokens
+from PromptTemplates import format_prompt_text
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -70,20 +71,7 @@ class Interactions:
         self._processed_commands = set()
 
     def custom_format(self, string, **kwargs):
-        if isinstance(string, list):
-            string = "".join(str(x) for x in string)
-
-        def replace(match):
-            key = match.group(1)
-            value = kwargs.get(key, match.group(0))
-            if isinstance(value, list):
-                return "".join(str(x) for x in value)
-            else:
-                return str(value)
-
-        pattern = r"(?<!{){([^{}\n]+)}(?!})"
-        result = re.sub(pattern, replace, string)
-        return result
+        return format_prompt_text(string, **kwargs)
 
     async def format_prompt(
         self,
@@ -101,10 +89,11 @@ class Interactions:
             "Default" if "prompt_category" not in kwargs else kwargs["prompt_category"]
         )
         try:
-            prompt = self.cp.get_prompt(
+            template = self.cp.get_prompt_template(
                 prompt_name=prompt_name, prompt_category=prompt_category
             )
-            prompt_args = self.cp.get_prompt_args(prompt_text=prompt)
+            prompt = template.content
+            prompt_args = list(template.arguments)
         except Exception as e:
             logging.error(
                 f"Error: {self.agent_name} failed to get prompt {prompt_name} from prompt category {prompt_category}. {e}"
@@ -225,44 +214,9 @@ class Interactions:
         agent_tasks = self.agent.get_conversation_tasks(conversation_id=conversation_id)
         if agent_tasks != "":
             context.append(agent_tasks)
-        conversation_history = ""
-        conversation = c.get_conversation()
-        if "interactions" in conversation:
-            if conversation["interactions"] != []:
-                activity_history = [
-                    interaction
-                    for interaction in conversation["interactions"]
-                    if str(interaction["message"]).startswith("[ACTIVITY]")
-                ]
-                activities = []
-                for activity in activity_history:
-                    if "audio response" not in activity["message"]:
-                        activities.append(activity)
-                if len(activity_history) > 5:
-                    activity_history = activity_history[-5:]
-                interactions = []
-                for interaction in conversation["interactions"]:
-                    if (
-                        not str(interaction["message"]).startswith("<audio controls>")
-                        and not str(interaction["message"]).startswith("[ACTIVITY]")
-                        and not str(interaction["message"]).startswith("[SUBACTIVITY]")
-                    ):
-                        timestamp = (
-                            interaction["timestamp"]
-                            if "timestamp" in interaction
-                            else ""
-                        )
-                        role = interaction["role"] if "role" in interaction else ""
-                        message = (
-                            interaction["message"] if "message" in interaction else ""
-                        )
-                        message = regex.sub(r"(```.*?```)", "", message)
-                        interactions.append(f"{timestamp} {role}: {message} \n ")
-                if len(interactions) > 0:
-                    interactions = interactions[-conversation_results:]
-                    conversation_history = "\n".join(interactions)
-                conversation_history += "\n## The assistant's recent activities:\n"
-                conversation_history += c.get_activities_with_subactivities()
+        conversation_history = c.get_conversation_context(
+            conversation_results=conversation_results
+        )
         if conversation_history != "":
             context.append(
                 f"### Recent Activities and Conversation History\n{conversation_history}\n"
@@ -370,9 +324,9 @@ class Interactions:
                 )
             else:
                 the_files = "files."
-            tokens_used = get_tokens(
-                f"{prompt}{user_input}{all_files_content}{context}"
-            )
+            tokens_used = TokenCounter(
+                prompt, user_input, all_files_content, f"{context}"
+            ).total
             agent_max_tokens = int(
                 self.agent.AGENT_CONFIG["settings"]["MAX_TOKENS"]
                 if "MAX_TOKENS" in self.agent.AGENT_CONFIG["settings"]
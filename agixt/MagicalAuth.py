@@ -25,7 +25,16 @@ from Models import (
 from typing import List, Optional
 from fastapi import Header, HTTPException
 from Globals import getenv, get_default_agent
+from AgentConfigCache import invalidate_agent_configs
+from IdentityCache import (
+    SharedCacheVersion,
+    invalidate_user_company,
+    resolve_user_company_id,
+    resolve_user_id,
+)
+from UsageCounters import token_usage
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from fastapi import HTTPException
 from agixtsdk import AGiXTSDK
 from sso.amazon import amazon_sso
@@ -39,6 +48,8 @@ import logging
 import traceback
 import requests
 import pytz
+import time
+import threading
 import jwt
 import json
 import uuid
@@ -225,17 +236,9 @@ def verify_api_key(authorization: str = Header(None)):
 
 
 def get_user_id(user: str):
-    session = get_session()
-    user_data = session.query(User).filter(User.email == user).first()
-    if user_data is None:
-        session.close()
+    user_id = resolve_user_id(user)
+    if user_id is None:
         raise HTTPException(status_code=404, detail=f"User {user} not found.")
-    try:
-        user_id = user_data.id
-    except Exception as e:
-        session.close()
-        raise HTTPException(status_code=404, detail=f"User {user} not found.")
-    session.close()
     return user_id
 
 
@@ -315,6 +318,7 @@ def get_agents(email, company=None):
             )
             session.add(agent_setting)
             session.commit()
+            invalidate_agent_configs()
         output.append(
             {
                 "name": agent.name,
@@ -758,6 +762,7 @@ class MagicalAuth:
                 )
                 session.add(user_company)
                 session.commit()
+                invalidate_user_company(new_user_db.id)
                 agixt = AGiXTSDK(base_uri=getenv("AGIXT_URI"))
                 agixt.login(email=new_user.email, otp=pyotp.TOTP(mfa_token).now())
                 default_agent = get_default_agent()
@@ -794,8 +799,6 @@ class MagicalAuth:
             # Add default user preferences
             default_preferences = [
                 ("timezone", getenv("TZ")),
-                ("input_tokens", "0"),
-                ("output_tokens", "0"),
                 ("verify_email", "true" if verify_email else "false"),
             ]
             for pref_key, pref_value in default_preferences:
@@ -864,6 +867,11 @@ class MagicalAuth:
                     user_preference.pref_value = str(value)
         session.commit()
         session.close()
+        if "timezone" in kwargs:
+            invalidate_user_timezone(self.user_id)
+        # Registration requirement preferences are part of the user's agent configs
+        if any(key in self.registration_requirements() for key in kwargs):
+            invalidate_agent_configs()
         return "User updated successfully."
 
     def delete_company(self, company_id):
@@ -875,9 +883,12 @@ class MagicalAuth:
             .filter(UserCompany.company_id == company.id)
             .all()
         )
+        member_ids = [user_company.user_id for user_company in user_companies]
         for user_company in user_companies:
             session.delete(user_company)
         session.commit()
+        for member_id in member_ids:
+            invalidate_user_company(member_id)
         # Delete the company
         session.delete(company)
         session.commit()
@@ -1016,10 +1027,7 @@ class MagicalAuth:
         user_requirements = self.registration_requirements()
         if not user_preferences:
             user_preferences = {}
-        if "input_tokens" not in user_preferences:
-            user_preferences["input_tokens"] = 0
-        if "output_tokens" not in user_preferences:
-            user_preferences["output_tokens"] = 0
+        user_preferences.update(self.get_token_counts())
         if user.email != getenv("DEFAULT_USER"):
             api_key = getenv("STRIPE_API_KEY")
             if api_key != "" and api_key is not None and str(api_key).lower() != "none":
@@ -1538,96 +1546,29 @@ class MagicalAuth:
         return decrypted_preferences
 
     def get_token_counts(self):
-        session = get_session()
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
+        return token_usage.get_totals(self.user_id)
+
+    def get_token_usage(self, start_date=None, end_date=None):
+        """Token usage per day, agent and provider"""
+        return token_usage.get_breakdown(
+            self.user_id, start_date=start_date, end_date=end_date
         )
-        input_tokens = 0
-        output_tokens = 0
-        found_input_tokens = False
-        found_output_tokens = False
-        for preference in user_preferences:
-            if preference.pref_key == "input_tokens":
-                input_tokens = int(preference.pref_value)
-                found_input_tokens = True
-            if preference.pref_key == "output_tokens":
-                output_tokens = int(preference.pref_value)
-                found_output_tokens = True
-        if not found_input_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(input_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
-        if not found_output_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(output_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
-        session.close()
-        return {"input_tokens": input_tokens, "output_tokens": output_tokens}
 
-    def increase_token_counts(self, input_tokens: int = 0, output_tokens: int = 0):
+    def increase_token_counts(
+        self,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        agent_id=None,
+        provider: str = None,
+    ):
         self.validate_user()
-        session = get_session()
-        counts = self.get_token_counts()
-        current_input_tokens = int(counts["input_tokens"])
-        current_output_tokens = int(counts["output_tokens"])
-        updated_input_tokens = current_input_tokens + input_tokens
-        updated_output_tokens = current_output_tokens + output_tokens
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
+        token_usage.record(
+            user_id=self.user_id,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            agent_id=agent_id,
+            provider=provider,
         )
-        if not user_preferences:
-            user_input_tokens = None
-            user_output_tokens = None
-        else:
-            user_input_tokens = next(
-                (x for x in user_preferences if x.pref_key == "input_tokens"),
-                None,
-            )
-            user_output_tokens = next(
-                (x for x in user_preferences if x.pref_key == "output_tokens"),
-                None,
-            )
-        # Update input tokens
-        if user_input_tokens is None:
-            user_input_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(updated_input_tokens),
-            )
-            session.add(user_input_tokens)
-            session.commit()
-        else:
-            user_input_tokens.pref_value = str(updated_input_tokens)
-            session.commit()
-        # Update output tokens
-        if user_output_tokens is None:
-            user_output_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(updated_output_tokens),
-            )
-            session.add(user_output_tokens)
-            session.commit()
-        else:
-            user_output_tokens.pref_value = str(updated_output_tokens)
-            session.commit()
-        session.close()
-        return {
-            "input_tokens": updated_input_tokens,
-            "output_tokens": updated_output_tokens,
-        }
 
     def get_user_companies(self) -> List[str]:
         """Get list of company IDs that the user has access to"""
@@ -1751,6 +1692,7 @@ class MagicalAuth:
                     )
                     db.add(user_company)
                     db.commit()
+                    invalidate_user_company(user.id)
                     # send an email letting the user know they have been added to the company
                     company = (
                         db.query(Company)
@@ -1945,6 +1887,7 @@ class MagicalAuth:
                 )
                 db.add(user_company)
                 db.commit()
+                invalidate_user_company(self.user_id)
                 return True
             except SQLAlchemyError as e:
                 db.rollback()
@@ -1952,13 +1895,7 @@ class MagicalAuth:
 
     def get_user_company_id(self):
         try:
-            with get_session() as db:
-                user_company = (
-                    db.query(UserCompany)
-                    .filter(UserCompany.user_id == self.user_id)
-                    .first()
-                )
-                return str(user_company.company_id) if user_company else None
+            return resolve_user_company_id(self.user_id)
         except Exception as e:
             return None
 
@@ -2178,6 +2115,7 @@ class MagicalAuth:
                 )
                 db.add(user_company)
                 db.commit()
+                invalidate_user_company(self.user_id)
                 agixt = AGiXTSDK(base_uri=getenv("AGIXT_URI"))
                 company_email = f"{str(new_company.id)}@{str(new_company.id)}.xt"
                 auth = MagicalAuth()
@@ -2719,7 +2657,88 @@ class MagicalAuth:
             )
 
 
+# Seconds a resolved user timezone is reused before it is read again
+TIMEZONE_CACHE_TTL = int(getenv("TIMEZONE_CACHE_TTL", "300"))
+# Users whose timezone each worker keeps, least recently used are evicted first
+TIMEZONE_CACHE_SIZE = int(getenv("TIMEZONE_CACHE_SIZE", "10000"))
+
+
+class TimezoneCache:
+    """
+    LRU of user id to timezone name, bounded to `size` users.
+
+    Expired entries are dropped when they are read or reach the front of the LRU.
+    A timezone change clears every worker's cache through the shared "timezone"
+    version, since each worker only learns of another's writes on its next check.
+    """
+
+    def __init__(self, ttl: int = TIMEZONE_CACHE_TTL, size: int = TIMEZONE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.version = SharedCacheVersion("timezone")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id) -> tuple:
+        """The cached timezone or None, and the generation to store a loaded one in"""
+        if self.version.changed():
+            self.clear()
+        key = str(user_id)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], self.generation
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None, self.generation
+
+    def set(self, user_id, timezone: str, generation: int):
+        now = time.monotonic()
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[str(user_id)] = (timezone, now + self.ttl)
+            self.entries.move_to_end(str(user_id))
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if len(self.entries) <= self.size and oldest[1] > now:
+                    break
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def invalidate(self):
+        self.clear()
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+user_timezones = TimezoneCache()
+
+
 def get_user_timezone(user_id):
+    timezone, generation = user_timezones.get(user_id)
+    if timezone is not None:
+        return timezone
     session = get_session()
     user_preferences = (
         session.query(UserPreferences)
@@ -2737,10 +2756,27 @@ def get_user_timezone(user_id):
         session.commit()
     timezone = user_preferences.pref_value
     session.close()
+    user_timezones.set(user_id, timezone, generation)
     return timezone
 
 
+def invalidate_user_timezone(user_id):
+    user_timezones.invalidate()
+
+
+def get_timezone_cache_metrics() -> dict:
+    return user_timezones.metrics()
+
+
+def get_local_timezone(user_id):
+    return pytz.timezone(get_user_timezone(user_id))
+
+
+def to_local_time(utc_time, local_tz):
+    if utc_time is None:
+        return None
+    return pytz.timezone("GMT").localize(utc_time).astimezone(local_tz)
+
+
 def convert_time(utc_time, user_id):
-    gmt = pytz.timezone("GMT")
-    local_tz = pytz.timezone(get_user_timezone(user_id))
-    return gmt.localize(utc_time).astimezone(local_tz)
+    return to_local_time(utc_time, get_local_timezone(user_id))
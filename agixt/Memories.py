@@ -2,28 +2,35 @@ import logging
 import os
 import asyncio
 import sys
+import threading
 from DB import (
     Memory,
     Agent,
-    User,
     get_session,
+    get_new_id,
     get_similar_memories,
+    get_similar_memories_batch,
     process_embedding_for_storage,
+    bulk_insert_memories,
+    index_memories,
+    unindex_memories,
+    memory_indexes,
+    DATABASE_TYPE,
 )
 import spacy
 from numpy import array, linalg, ndarray
 from collections import Counter
-from typing import List
+from typing import Iterable, List
 from Globals import getenv, DEFAULT_USER
 from textacy.extract.keyterms import textrank  # type: ignore
 from youtube_transcript_api import YouTubeTranscriptApi
-from onnxruntime import InferenceSession
-from tokenizers import Tokenizer
-from typing import List, cast, Union, Sequence
+from Embeddings import embed, embed_async, get_embedding_engine
+from VectorIndex import normalize_vectors
+from IdentityCache import resolve_agent_id, resolve_user_id
 from numpy import array, linalg, ndarray
 import numpy as np
 from datetime import datetime
-from uuid import UUID
+from uuid import UUID, uuid4
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -33,50 +40,59 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 
+# Texts are parsed in segments of at most this many characters to bound memory use
+NLP_SEGMENT_CHARS = 100000
+# Chunks are embedded and inserted this many at a time when writing documents
+MEMORY_INGEST_BATCH_SIZE = int(getenv("MEMORY_INGEST_BATCH_SIZE", "256"))
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """Shared spaCy pipeline, loaded once with only what chunking and keywords need"""
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                # NER is never used and the parser is only needed for sentences,
+                # which the much cheaper senter component provides.
+                try:
+                    sp = spacy.load(
+                        "en_core_web_sm", exclude=["ner"], disable=["parser"]
+                    )
+                except OSError:
+                    spacy.cli.download("en_core_web_sm")
+                    sp = spacy.load(
+                        "en_core_web_sm", exclude=["ner"], disable=["parser"]
+                    )
+                if "senter" in sp.component_names:
+                    sp.enable_pipe("senter")
+                else:
+                    sp.add_pipe("sentencizer")
+                # Callers like extract_keywords(text=...) pass whole documents, which
+                # spaCy would otherwise reject past 1,000,000 characters
+                sp.max_length = 99999999999999999999999
+                _nlp = sp
+    return _nlp
+
+
 def nlp(text):
-    try:
-        sp = spacy.load("en_core_web_sm")
-    except:
-        spacy.cli.download("en_core_web_sm")
-        sp = spacy.load("en_core_web_sm")
-    sp.max_length = 99999999999999999999999
-    return sp(text)
-
-
-def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
-    tokenizer = Tokenizer.from_file(os.path.join(os.getcwd(), "onnx", "tokenizer.json"))
-    tokenizer.enable_truncation(max_length=256)
-    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=256)
-    model = InferenceSession(os.path.join(os.getcwd(), "onnx", "model.onnx"))
-    all_embeddings = []
-    for i in range(0, len(input), 32):
-        batch = input[i : i + 32]
-        encoded = [tokenizer.encode(d) for d in batch]
-        input_ids = np.array([e.ids for e in encoded])
-        attention_mask = np.array([e.attention_mask for e in encoded])
-        onnx_input = {
-            "input_ids": np.array(input_ids, dtype=np.int64),
-            "attention_mask": np.array(attention_mask, dtype=np.int64),
-            "token_type_ids": np.array(
-                [np.zeros(len(e), dtype=np.int64) for e in input_ids],
-                dtype=np.int64,
-            ),
-        }
-        model_output = model.run(None, onnx_input)
-        last_hidden_state = model_output[0]
-        input_mask_expanded = np.broadcast_to(
-            np.expand_dims(attention_mask, -1), last_hidden_state.shape
-        )
-        embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
-            input_mask_expanded.sum(1), a_min=1e-9, a_max=None
-        )
-        norm = np.linalg.norm(embeddings, axis=1)
-        norm[norm == 0] = 1e-12
-        embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
-        all_embeddings.append(embeddings)
-    return cast(
-        List[Union[Sequence[float], Sequence[int]]], np.concatenate(all_embeddings)
-    ).tolist()
+    return get_nlp()(text)
+
+
+def iter_text_segments(text: str, max_chars: int = NLP_SEGMENT_CHARS):
+    """Split text into segments of at most max_chars, preferring paragraph breaks"""
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        if end < len(text):
+            for separator in ("\n\n", "\n", ". ", " "):
+                split = text.rfind(separator, start, end)
+                if split > start:
+                    end = split + len(separator)
+                    break
+        yield text[start:end]
+        start = end
 
 
 def extract_keywords(doc=None, text="", limit=10):
@@ -109,17 +125,16 @@ def snake(old_str: str = ""):
 
 
 def compute_similarity_scores(embedding: ndarray, embedding_array: ndarray) -> ndarray:
-    query_norm = linalg.norm(embedding)
+    embedding_array = np.asarray(embedding_array, dtype=np.float32)
     collection_norm = linalg.norm(embedding_array, axis=1)
-    valid_indices = (query_norm != 0) & (collection_norm != 0)
-    similarity_scores = array([-1.0] * embedding_array.shape[0])
-
-    if valid_indices.any():
-        similarity_scores[valid_indices] = embedding.dot(
-            embedding_array[valid_indices].T
-        ) / (query_norm * collection_norm[valid_indices])
-    else:
+    valid_indices = collection_norm != 0
+    if linalg.norm(embedding) == 0 or not valid_indices.any():
         raise ValueError(f"Invalid vectors: {embedding_array} or {embedding}")
+    similarity_scores = (
+        normalize_vectors(embedding) @ normalize_vectors(embedding_array).T
+    )
+    similarity_scores = similarity_scores[0].astype(np.float64)
+    similarity_scores[~valid_indices] = -1.0
     return similarity_scores
 
 
@@ -246,22 +261,26 @@ def get_base_collection_name(user: str, agent_name: str) -> str:
     return snake(f"{user}_{agent_name}")
 
 
+def new_memory_id():
+    # Assigned client-side so new rows can be added to the vector index after commit
+    return get_new_id() if DATABASE_TYPE == "sqlite" else uuid4()
+
+
 def get_agent_id(agent_name: str, email: str) -> str:
     """
     Gets the agent ID for the given agent name and user.
     """
+    user_id = resolve_user_id(email)
+    agent_id = resolve_agent_id(user_id, agent_name)
+    if agent_id:
+        return str(agent_id)
     session = get_session()
     try:
-        user = session.query(User).filter_by(email=email).first()
-        agent = session.query(Agent).filter_by(name=agent_name, user_id=user.id).first()
+        agent = session.query(Agent).filter_by(user_id=user_id).first()
         if agent:
             return str(agent.id)
         else:
-            agent = session.query(Agent).filter_by(user_id=user.id).first()
-            if agent:
-                return str(agent.id)
-            else:
-                return None
+            return None
     finally:
         session.close()
 
@@ -277,9 +296,10 @@ class SQLCollection:
             if isinstance(query_embeddings, np.ndarray):
                 query_embeddings = query_embeddings.tolist()
 
-            memory_results = get_similar_memories(
+            # All query vectors are scored against the collection in one pass
+            batch_results = get_similar_memories_batch(
                 self.session,
-                query_embeddings[0],  # Assuming single query
+                query_embeddings,
                 self.memories.agent_id,
                 (
                     None
@@ -290,19 +310,20 @@ class SQLCollection:
                 0.0,  # No minimum score for ChromaDB-style queries
             )
 
-            if not memory_results:
-                return {
-                    "ids": [[]],
-                    "documents": [[]],
-                    "embeddings": [[]],
-                    "metadatas": [[]],
-                }
-
             # Format results to match ChromaDB's expected structure
-            formatted_results = {
-                "ids": [[str(mem.id) for mem, _ in memory_results]],
-                "documents": [[mem.text for mem, _ in memory_results]],
-                "embeddings": [[mem.embedding for mem, _ in memory_results]],
+            return {
+                "ids": [
+                    [str(mem.id) for mem, _ in memory_results]
+                    for memory_results in batch_results
+                ],
+                "documents": [
+                    [mem.text for mem, _ in memory_results]
+                    for memory_results in batch_results
+                ],
+                "embeddings": [
+                    [mem.embedding for mem, _ in memory_results]
+                    for memory_results in batch_results
+                ],
                 "metadatas": [
                     [
                         {
@@ -315,11 +336,10 @@ class SQLCollection:
                         }
                         for mem, sim in memory_results
                     ]
+                    for memory_results in batch_results
                 ],
             }
 
-            return formatted_results
-
         except Exception as e:
             logging.error(f"Error in query: {e}")
             return {
@@ -374,10 +394,16 @@ class SQLCollection:
         if isinstance(ids, str):
             ids = [ids]
         try:
+            deleted = (
+                self.session.query(Memory.id, Memory.conversation_id)
+                .filter(Memory.id.in_(ids))
+                .all()
+            )
             self.session.query(Memory).filter(Memory.id.in_(ids)).delete(
                 synchronize_session="fetch"
             )
             self.session.commit()
+            unindex_memories(self.session, self.memories.agent_id, deleted)
             return True
         except Exception as e:
             self.session.rollback()
@@ -385,7 +411,13 @@ class SQLCollection:
             return False
 
     def add(self, ids, metadatas, documents):
+        conversation_id = (
+            None
+            if self.memories.collection_number == "0"
+            else self.memories.collection_number
+        )
         try:
+            added_ids, added_embeddings = [], []
             for id, metadata, document in zip(ids, metadatas, documents):
                 embedding = embed([document])
                 memory = Memory(
@@ -403,7 +435,16 @@ class SQLCollection:
                     additional_metadata=metadata.get("additional_metadata", ""),
                 )
                 self.session.add(memory)
+                added_ids.append(id)
+                added_embeddings.append(embedding)
             self.session.commit()
+            index_memories(
+                self.session,
+                self.memories.agent_id,
+                conversation_id,
+                added_ids,
+                added_embeddings,
+            )
             return True
         except Exception as e:
             self.session.rollback()
@@ -485,6 +526,9 @@ class Memories:
                 query = query.filter_by(conversation_id=conversation_id)
             query.delete()
             session.commit()
+            memory_indexes.invalidate(
+                self.agent_id, conversation_id, all_collections=not conversation_id
+            )
             return True
         except Exception as e:
             session.rollback()
@@ -642,84 +686,141 @@ class Memories:
         self, user_input: str, text: str, external_source: str = "user input"
     ):
         """Write text to memory with proper validation"""
+        try:
+            written = await self.write_documents(
+                [
+                    {
+                        "user_input": user_input,
+                        "text": text,
+                        "external_source": external_source,
+                    }
+                ]
+            )
+        except Exception:
+            return False
+        return written > 0
+
+    async def write_documents(
+        self, documents: Iterable[dict], batch_size: int = MEMORY_INGEST_BATCH_SIZE
+    ) -> int:
+        """
+        Stream documents into memory, returning the number of memories written.
+
+        Each document is a dict with `text` and optional `user_input` and
+        `external_source` keys. Chunks from all documents are embedded and inserted
+        `batch_size` at a time, so memory use is bounded by the batch rather than the
+        input. Previous memories of a file or URL source are replaced once per call,
+        and that replacement is committed on its own before new chunks are written.
+
+        Raises if a batch can't be embedded or written, after logging how many
+        memories were written before it, so callers don't report a partial write as
+        success.
+        """
         if not self.agent_id:
             logging.error(
                 f"No agent_id found for agent {self.agent_name} and user {self.user}"
             )
-            return False
+            return 0
 
         session = get_session()
+        written = 0
         try:
             # Validate agent exists
             agent = session.query(Agent).filter_by(id=self.agent_id).first()
             if not agent:
                 logging.error(f"Agent not found with id {self.agent_id}")
-                return False
-
-            chunks = await self.chunk_content(text=text, chunk_size=self.chunk_size)
+                return 0
 
             # Handle core memories vs conversation memories
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
-
-            # If replacing external source content, delete old entries
-            if external_source.startswith(("file", "http://", "https://")):
-                session.query(Memory).filter_by(
-                    agent_id=self.agent_id,
-                    conversation_id=conversation_id,
-                    external_source=external_source,
-                ).delete()
-
-            # Process all chunks first to ensure they're valid
-            memories_to_add = []
-            for chunk in chunks:
-                # Get embedding and ensure proper shape
-                try:
-                    chunk_embedding = embed([chunk])
-                    if not chunk_embedding or len(chunk_embedding) == 0:
-                        logging.warning(
-                            f"Failed to generate embedding for chunk: {chunk[:100]}..."
-                        )
-                        continue
-
-                    embedding = process_embedding_for_storage(chunk_embedding[0])
-
-                    memory = Memory(
-                        agent_id=self.agent_id,  # Explicitly set agent_id
+            replaced_sources = set()
+            pending = []
+            for document in documents:
+                text = document.get("text")
+                if not text:
+                    continue
+                external_source = document.get("external_source") or "user input"
+                user_input = document.get("user_input", "")
+
+                # If replacing external source content, delete old entries
+                if (
+                    external_source.startswith(("file", "http://", "https://"))
+                    and external_source not in replaced_sources
+                ):
+                    replaced_sources.add(external_source)
+                    replaced_query = session.query(Memory).filter_by(
+                        agent_id=self.agent_id,
                         conversation_id=conversation_id,
-                        embedding=embedding,
-                        text=chunk,
                         external_source=external_source,
-                        description=user_input,
-                        additional_metadata=chunk,
                     )
-                    # Validate memory object
-                    if not memory.agent_id:
-                        logging.error("Memory created with null agent_id")
-                        continue
-
-                    memories_to_add.append(memory)
-                except Exception as e:
-                    logging.error(f"Error processing chunk: {str(e)}")
-                    continue
-
-            # Add all valid memories
-            if memories_to_add:
-                session.bulk_save_objects(memories_to_add)
-                session.commit()
-                logging.info(f"Successfully added {len(memories_to_add)} memories")
-                return True
+                    replaced = [
+                        (memory_id, conversation_id)
+                        for (memory_id,) in replaced_query.with_entities(
+                            Memory.id
+                        ).all()
+                    ]
+                    replaced_query.delete()
+                    session.commit()
+                    unindex_memories(session, self.agent_id, replaced)
+
+                chunks = await self.chunk_content(text=text, chunk_size=self.chunk_size)
+                for chunk in chunks:
+                    pending.append((chunk, external_source, user_input))
+                    if len(pending) >= batch_size:
+                        written += await self.insert_memory_batch(
+                            session, conversation_id, pending
+                        )
+            if pending:
+                written += await self.insert_memory_batch(
+                    session, conversation_id, pending
+                )
+            if written:
+                logging.info(f"Successfully added {written} memories")
             else:
                 logging.warning("No valid memories to add")
-                return False
-
         except Exception as e:
             session.rollback()
-            logging.error(f"Error writing to memory: {e}")
-            return False
+            logging.error(
+                f"Error writing to memory after {written} memories were written: {e}"
+            )
+            raise
         finally:
             session.close()
+        return written
+
+    async def insert_memory_batch(self, session, conversation_id, pending):
+        """Embed a batch of (chunk, external_source, user_input) and insert it in one statement"""
+        embeddings = await get_embedding_engine().embed_async(
+            [chunk for chunk, _, _ in pending]
+        )
+        rows = [
+            {
+                "id": new_memory_id(),
+                "agent_id": self.agent_id,
+                "conversation_id": conversation_id,
+                "embedding": process_embedding_for_storage(embedding),
+                "text": chunk,
+                "external_source": external_source,
+                "description": user_input,
+                "additional_metadata": chunk,
+            }
+            for (chunk, external_source, user_input), embedding in zip(
+                pending, embeddings
+            )
+        ]
+        pending.clear()
+        bulk_insert_memories(session, rows)
+        session.commit()
+        index_memories(
+            session,
+            self.agent_id,
+            conversation_id,
+            [row["id"] for row in rows],
+            [row["embedding"] for row in rows],
+        )
+        return len(rows)
 
     # Update the get_memories_data method:
     async def get_memories_data(
@@ -733,7 +834,7 @@ class Memories:
 
         session = get_session()
         try:
-            query_embedding = embed([user_input])[0]
+            query_embedding = (await embed_async([user_input]))[0]
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
@@ -783,7 +884,7 @@ class Memories:
     ) -> List[str]:
         session = get_session()
         try:
-            query_embedding = embed([user_input])[0]
+            query_embedding = (await embed_async([user_input]))[0]
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
@@ -846,13 +947,14 @@ class Memories:
                     except Exception as e:
                         logging.error(f"Error deleting file: {str(e)}")
 
-            result = (
-                session.query(Memory)
-                .filter_by(agent_id=self.agent_id, external_source=external_source)
-                .delete()
+            query = session.query(Memory).filter_by(
+                agent_id=self.agent_id, external_source=external_source
             )
+            deleted = query.with_entities(Memory.id, Memory.conversation_id).all()
+            result = query.delete()
 
             session.commit()
+            unindex_memories(session, self.agent_id, deleted)
             return bool(result)
         except Exception as e:
             session.rollback()
@@ -868,29 +970,32 @@ class Memories:
         return score
 
     async def chunk_content(self, text: str, chunk_size: int) -> List[str]:
-        doc = nlp(text)
-        sentences = list(doc.sents)
         content_chunks = []
+        keyword_scores = Counter()
         chunk = []
         chunk_len = 0
-        keywords = set(extract_keywords(doc=doc, limit=10))
-        for sentence in sentences:
-            sentence_tokens = len(sentence)
-            if chunk_len + sentence_tokens > chunk_size and chunk:
-                chunk_text = " ".join(token.text for token in chunk)
-                content_chunks.append(
-                    (self.score_chunk(chunk_text, keywords), chunk_text)
-                )
-                chunk = []
-                chunk_len = 0
-
-            chunk.extend(sentence)
-            chunk_len += sentence_tokens
+        # Stream bounded segments through the pipeline instead of parsing everything at once
+        for doc in get_nlp().pipe(iter_text_segments(text), batch_size=4):
+            for keyword, score in textrank(doc, topn=10):
+                keyword_scores[keyword] += score
+            for sentence in doc.sents:
+                sentence_tokens = len(sentence)
+                if chunk_len + sentence_tokens > chunk_size and chunk:
+                    content_chunks.append(" ".join(chunk))
+                    chunk = []
+                    chunk_len = 0
+
+                chunk.extend(token.text for token in sentence)
+                chunk_len += sentence_tokens
 
         if chunk:
-            chunk_text = " ".join(token.text for token in chunk)
-            content_chunks.append((self.score_chunk(chunk_text, keywords), chunk_text))
+            content_chunks.append(" ".join(chunk))
 
+        keywords = {keyword for keyword, _ in keyword_scores.most_common(10)}
+        content_chunks = [
+            (self.score_chunk(chunk_text, keywords), chunk_text)
+            for chunk_text in content_chunks
+        ]
         # Sort the chunks by their score in descending order before returning them
         content_chunks.sort(key=lambda x: x[0], reverse=True)
         return [chunk_text for score, chunk_text in content_chunks]
@@ -0,0 +1,335 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+from sqlalchemy import bindparam, event
+from sqlalchemy.exc import (
+    DBAPIError,
+    DisconnectionError,
+    InterfaceError,
+    OperationalError,
+    TimeoutError,
+)
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from DB import Conversation, Message, DATABASE_TYPE, get_new_id, get_session
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Queue messages and insert them from a background thread instead of on the request path
+MESSAGE_LOG_WRITE_BEHIND = (
+    str(getenv("MESSAGE_LOG_WRITE_BEHIND", "true")).lower() == "true"
+)
+# Longest a queued message waits before it is written
+MESSAGE_LOG_FLUSH_MS = float(getenv("MESSAGE_LOG_FLUSH_MS", "200"))
+# Queue length that triggers a write without waiting for the interval
+MESSAGE_LOG_BATCH_SIZE = int(getenv("MESSAGE_LOG_BATCH_SIZE", "100"))
+# Milliseconds before a failed write is retried, doubling with each failed flush
+MESSAGE_LOG_RETRY_MS = float(getenv("MESSAGE_LOG_RETRY_MS", "500"))
+# Longest wait between retries of a failed write
+MESSAGE_LOG_MAX_RETRY_MS = float(getenv("MESSAGE_LOG_MAX_RETRY_MS", "30000"))
+# Writes a message the database rejects gets before it is dropped
+MESSAGE_LOG_MAX_ATTEMPTS = 3
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a write failed because the database was unreachable, not because of the rows"""
+    if isinstance(
+        error, (DisconnectionError, TimeoutError, OperationalError, InterfaceError)
+    ):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def split_rows(rows: List[dict]) -> List[List[dict]]:
+    """A rejected batch split by conversation, or into single rows if it has only one"""
+    conversations: Dict[str, List[dict]] = {}
+    for row in rows:
+        conversations.setdefault(str(row["conversation_id"]), []).append(row)
+    if len(conversations) > 1:
+        return list(conversations.values())
+    return [[row] for row in rows]
+
+
+def new_message_id():
+    # Assigned client-side so log_interaction can return before the row is written
+    return get_new_id() if DATABASE_TYPE == "sqlite" else uuid.uuid4()
+
+
+class MessageLog:
+    """
+    Write-behind log of conversation messages.
+
+    Messages get their id and timestamp when they are queued, so callers can return
+    immediately. A daemon thread inserts queued messages with one executemany and
+    bumps each conversation's updated_at, either every MESSAGE_LOG_FLUSH_MS or as
+    soon as MESSAGE_LOG_BATCH_SIZE messages are waiting.
+
+    Any ORM statement on Message in this process flushes the queue first, so readers
+    always see messages logged before them, unless the reading session has already
+    written in its open transaction.
+
+    A batch the database rejects is retried by conversation and then row by row, so
+    only the rejected rows are held back, and those are dropped after
+    MESSAGE_LOG_MAX_ATTEMPTS writes. Rows that failed because the database was
+    unreachable stay queued however long that lasts. The writer backs off
+    exponentially from MESSAGE_LOG_RETRY_MS while writes keep failing.
+    """
+
+    def __init__(self, write_behind: bool = MESSAGE_LOG_WRITE_BEHIND):
+        self.write_behind = write_behind
+        self.pending: List[dict] = []
+        self.attempts: Dict[str, int] = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = None
+        self.closed = False
+        self.failures = 0
+        self.retry_at = 0.0
+        self.flush_listeners: List[Callable] = []
+
+    def add_flush_listener(self, listener: Callable[[List[dict], Dict], None]):
+        """Call listener(rows, previous_updated_at) after each committed flush"""
+        self.flush_listeners.append(listener)
+
+    def enqueue(self, row: dict):
+        with self.condition:
+            self.pending.append(row)
+            if self.write_behind and not self.closed:
+                self.start()
+                self.condition.notify()
+                return
+        self.flush()
+
+    def has_unflushed(self) -> bool:
+        return bool(self.pending) or self.flush_lock.locked()
+
+    def is_flushing(self) -> bool:
+        return getattr(self.local, "flushing", False)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.run, name="message-log", daemon=True
+            )
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    return
+                # Give the batch a chance to fill up before writing it
+                self.condition.wait_for(
+                    lambda: len(self.pending) >= MESSAGE_LOG_BATCH_SIZE or self.closed,
+                    timeout=MESSAGE_LOG_FLUSH_MS / 1000,
+                )
+                # Back off while writes are failing
+                backoff = self.retry_at - time.monotonic()
+                if backoff > 0:
+                    self.condition.wait_for(lambda: self.closed, timeout=backoff)
+            self.flush()
+
+    def flush(self):
+        """Write every queued message, blocking until any in-progress flush is done"""
+        with self.flush_lock:
+            with self.condition:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return
+            self.local.flushing = True
+            try:
+                self.write_isolated(rows)
+            finally:
+                self.local.flushing = False
+
+    def write_isolated(self, rows: List[dict]):
+        """
+        Write rows, narrowing any batch the database rejects to its conversations and
+        then to single rows, and requeue whatever couldn't be written.
+        """
+        batches = [rows]
+        unwritten: List[dict] = []
+        rejected: List[dict] = []
+        error = None
+        while batches:
+            batch = batches.pop(0)
+            if unwritten:
+                # The database is unreachable, keep everything for the next flush
+                unwritten.extend(batch)
+                continue
+            try:
+                previous = self.write(batch)
+            except Exception as e:
+                error = e
+                if is_transient_error(e):
+                    unwritten.extend(batch)
+                elif len(batch) > 1:
+                    batches = split_rows(batch) + batches
+                else:
+                    rejected.extend(batch)
+                continue
+            self.committed(batch, previous)
+        if not unwritten and not rejected:
+            self.failures = 0
+            self.retry_at = 0.0
+            return
+        self.failures += 1
+        delay = min(
+            MESSAGE_LOG_RETRY_MS * 2 ** (self.failures - 1), MESSAGE_LOG_MAX_RETRY_MS
+        )
+        self.retry_at = time.monotonic() + delay / 1000
+        if unwritten:
+            logging.error(
+                f"Unable to write {len(unwritten)} queued messages, keeping them queued and retrying in {delay:.0f} ms: {error}"
+            )
+        if rejected:
+            logging.error(f"Database rejected {len(rejected)} queued messages: {error}")
+        self.retry(unwritten, rejected, error)
+
+    def committed(self, rows: List[dict], previous: Dict[str, datetime]):
+        for row in rows:
+            self.attempts.pop(str(row["id"]), None)
+        for listener in self.flush_listeners:
+            try:
+                listener(rows, previous)
+            except Exception as e:
+                logging.error(f"Error in message log flush listener: {e}")
+
+    def write(self, rows: List[dict]) -> Dict[str, datetime]:
+        updates = {}
+        for row in rows:
+            key = str(row["conversation_id"])
+            if key not in updates or updates[key][1] < row["timestamp"]:
+                updates[key] = (row["conversation_id"], row["timestamp"])
+        session = get_session()
+        try:
+            previous = {
+                str(conversation_id): updated_at
+                for conversation_id, updated_at in session.query(
+                    Conversation.id, Conversation.updated_at
+                )
+                .filter(
+                    Conversation.id.in_(
+                        [conversation_id for conversation_id, _ in updates.values()]
+                    )
+                )
+                .all()
+            }
+            session.execute(Message.__table__.insert(), rows)
+            conversation_table = Conversation.__table__
+            session.execute(
+                conversation_table.update()
+                .where(conversation_table.c.id == bindparam("conversation_key"))
+                .values(updated_at=bindparam("latest_message")),
+                [
+                    {"conversation_key": conversation_id, "latest_message": timestamp}
+                    for conversation_id, timestamp in updates.values()
+                ],
+            )
+            session.commit()
+            return previous
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def retry(self, unwritten: List[dict], rejected: List[dict], error: Exception):
+        """Put rows back at the front of the queue, dropping rejected rows out of attempts"""
+        retry = list(unwritten)
+        for row in rejected:
+            key = str(row["id"])
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] < MESSAGE_LOG_MAX_ATTEMPTS:
+                retry.append(row)
+            else:
+                self.attempts.pop(key, None)
+                logging.error(
+                    f"Dropping message {key} after {MESSAGE_LOG_MAX_ATTEMPTS} rejected writes: {error}"
+                )
+        with self.condition:
+            self.pending = retry + self.pending
+
+    def close(self):
+        """Stop the background writer and write everything still queued"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.flush()
+
+
+message_log = MessageLog()
+atexit.register(message_log.close)
+
+
+def touches_messages(orm_execute_state) -> bool:
+    """Whether a statement reads or writes Message, including through joins and subqueries"""
+    if any(mapper.class_ is Message for mapper in orm_execute_state.all_mappers):
+        return True
+    # all_mappers only lists the statement's primary entities
+    return Message.__table__ in find_tables(
+        orm_execute_state.statement,
+        check_columns=True,
+        include_joins=True,
+        include_crud=True,
+    )
+
+
+def has_writes(session) -> bool:
+    """
+    Whether the session wrote in its open transaction. Objects still waiting for
+    autoflush don't count, this hook runs before the statement autoflushes them.
+    """
+    return bool(session.info.get("message_log_wrote"))
+
+
+@event.listens_for(Session, "after_flush")
+def track_session_writes(session, flush_context):
+    session.info["message_log_wrote"] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def forget_session_writes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("message_log_wrote", None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def flush_message_log(orm_execute_state):
+    """
+    Read-your-writes: flush queued messages before any statement that touches Message.
+
+    The flush runs on its own session, so it's skipped when the caller's transaction
+    has written. That transaction may hold the SQLite write lock or row locks the
+    flush needs, and the caller would wait on its own locks until the flush times out.
+    """
+    session = orm_execute_state.session
+    if (
+        message_log.has_unflushed()
+        and not message_log.is_flushing()
+        and not has_writes(session)
+        and touches_messages(orm_execute_state)
+    ):
+        message_log.flush()
+    if (
+        orm_execute_state.is_insert
+        or orm_execute_state.is_update
+        or orm_execute_state.is_delete
+    ):
+        session.info["message_log_wrote"] = True
@@ -258,6 +258,7 @@ class HistoryModel(BaseModel):
     conversation_name: Optional[str] = None
     limit: Optional[int] = 100
     page: Optional[int] = 1
+    cursor: Optional[str] = None
 
 
 class FeedbackInput(BaseModel):
@@ -538,6 +539,7 @@ class ConversationDetailResponse(BaseModel):
 
 class ConversationHistoryResponse(BaseModel):
     conversation_history: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
 
 
 class NotificationResponse(BaseModel):
@@ -0,0 +1,275 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Tuple
+from DB import Prompt, PromptCategory, Argument, get_session
+from Globals import getenv, DEFAULT_USER
+from IdentityCache import SharedCacheVersion, invalidate_on_commit, resolve_user_id
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Seconds a resolved prompt template is reused before it is loaded again
+PROMPT_TEMPLATE_CACHE_TTL = int(getenv("PROMPT_TEMPLATE_CACHE_TTL", "300"))
+# User prompt names whose templates each worker keeps, least recently used are evicted
+PROMPT_TEMPLATE_CACHE_SIZE = int(getenv("PROMPT_TEMPLATE_CACHE_SIZE", "10000"))
+# Distinct prompt texts whose compiled form and arguments are kept per worker
+PROMPT_TEMPLATE_COMPILE_CACHE_SIZE = int(
+    getenv("PROMPT_TEMPLATE_COMPILE_CACHE_SIZE", "1024")
+)
+# Models whose changes alter a template: the prompt, its category and its arguments
+PROMPT_TEMPLATE_MODELS = (Prompt, PromptCategory, Argument)
+# What Interactions.custom_format substitutes: {name}, but not {{escaped}} braces
+PLACEHOLDER = re.compile(r"(?<!{){([^{}\n]+)}(?!})")
+
+
+@lru_cache(maxsize=PROMPT_TEMPLATE_COMPILE_CACHE_SIZE)
+def compile_template(text: str) -> Tuple[str, ...]:
+    """
+    Split a prompt into literal text and placeholder names.
+
+    Even positions hold text and odd positions hold the name of the placeholder
+    between them, so rendering never runs the placeholder regex again.
+    """
+    return tuple(PLACEHOLDER.split(text))
+
+
+@lru_cache(maxsize=PROMPT_TEMPLATE_COMPILE_CACHE_SIZE)
+def parse_prompt_args(text: str) -> Tuple[str, ...]:
+    """Names between each `{` and the next `}`, as Prompts.get_prompt_args lists them"""
+    prompt_args = []
+    start_index = text.find("{")
+    while start_index != -1:
+        end_index = text.find("}", start_index)
+        if end_index == -1:
+            break
+        prompt_args.append(text[start_index + 1 : end_index])
+        start_index = text.find("{", end_index)
+    return tuple(prompt_args)
+
+
+def render_template(parts: Tuple[str, ...], values: dict) -> str:
+    """Fill compiled placeholders from `values`, leaving unknown ones as they are"""
+    rendered = []
+    for index, part in enumerate(parts):
+        if index % 2 == 0:
+            rendered.append(part)
+            continue
+        if part not in values:
+            rendered.append("{" + part + "}")
+            continue
+        value = values[part]
+        if isinstance(value, list):
+            rendered.append("".join(str(x) for x in value))
+        else:
+            rendered.append(str(value))
+    return "".join(rendered)
+
+
+def format_prompt_text(text, **kwargs) -> str:
+    """Interactions.custom_format over a compiled, cached form of the text"""
+    if isinstance(text, list):
+        text = "".join(str(x) for x in text)
+    return render_template(compile_template(text), kwargs)
+
+
+class PromptTemplate(NamedTuple):
+    """A stored prompt with its placeholder list and compiled renderer"""
+
+    name: str
+    category: str
+    user_id: object
+    content: str
+    arguments: Tuple[str, ...]
+    parts: Tuple[str, ...]
+
+    @classmethod
+    def build(cls, name: str, category: str, user_id, content: str):
+        return cls(
+            name=name,
+            category=category,
+            user_id=user_id,
+            content=content,
+            arguments=parse_prompt_args(content),
+            parts=compile_template(content),
+        )
+
+    def render(self, **kwargs) -> str:
+        return render_template(self.parts, kwargs)
+
+
+def load_prompt_templates(user_id, prompt_name: str = None) -> list:
+    """Every prompt of a user, or only those named `prompt_name`, in one query"""
+    session = get_session()
+    try:
+        query = (
+            session.query(Prompt.name, PromptCategory.name, Prompt.content)
+            .join(PromptCategory, PromptCategory.id == Prompt.prompt_category_id)
+            .filter(Prompt.user_id == user_id)
+        )
+        if prompt_name is not None:
+            query = query.filter(Prompt.name == prompt_name)
+        rows = query.all()
+    finally:
+        session.close()
+    return [
+        PromptTemplate.build(name, category, user_id, content)
+        for name, category, content in rows
+    ]
+
+
+class PromptTemplateCache:
+    """
+    Prompt templates as Prompts.get_prompt resolves them, keyed by (user id, name)
+    with one template per category.
+
+    The default user's prompts are loaded together, so a global prompt resolves for
+    every user without a query. A user's own prompts are loaded one name at a time
+    into an LRU of `size` names, misses included, whose expired entries are dropped
+    when they are read or reach its front. Entries belong to the cache generation they were loaded in: any committed change
+    to prompts, categories or arguments starts a new generation and bumps the shared
+    "prompt_templates" version so other workers start one on their next check.
+    """
+
+    def __init__(
+        self,
+        ttl: int = PROMPT_TEMPLATE_CACHE_TTL,
+        size: int = PROMPT_TEMPLATE_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.global_templates: Optional[Dict[tuple, PromptTemplate]] = None
+        self.global_expires = 0.0
+        self.generation = 0
+        self.version = SharedCacheVersion("prompt_templates")
+        self.hits = 0
+        self.misses = 0
+
+    def get_global_templates(self) -> Dict[tuple, PromptTemplate]:
+        """The default user's templates keyed by (category, name)"""
+        now = time.monotonic()
+        with self.lock:
+            if self.global_templates is not None and self.global_expires > now:
+                return self.global_templates
+            generation = self.generation
+        default_user_id = resolve_user_id(DEFAULT_USER)
+        templates = {
+            (template.category, template.name): template
+            for template in (
+                load_prompt_templates(default_user_id) if default_user_id else []
+            )
+        }
+        with self.lock:
+            if generation == self.generation:
+                self.global_templates = templates
+                self.global_expires = now + self.ttl
+        return templates
+
+    def get_user_templates(
+        self, user_id, prompt_name: str
+    ) -> Dict[str, PromptTemplate]:
+        """The user's templates named `prompt_name` keyed by category"""
+        key = (str(user_id), prompt_name)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            generation = self.generation
+        templates = {
+            template.category: template
+            for template in load_prompt_templates(user_id, prompt_name)
+        }
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (templates, now + self.ttl)
+                self.entries.move_to_end(key)
+                while self.entries:
+                    oldest = next(iter(self.entries.values()))
+                    if len(self.entries) <= self.size and oldest[1] > now:
+                        break
+                    self.entries.popitem(last=False)
+        return templates
+
+    def get(
+        self, user_id, prompt_name: str, prompt_category: str = "Default"
+    ) -> Optional[PromptTemplate]:
+        """
+        The default user's Default prompt of that name, else the user's prompt in
+        `prompt_category`, else the user's Default prompt, or None.
+        """
+        if self.version.changed():
+            self.clear()
+        global_templates = self.get_global_templates()
+        template = global_templates.get(("Default", prompt_name))
+        if template is not None:
+            with self.lock:
+                self.hits += 1
+            return template
+        if str(user_id) == str(resolve_user_id(DEFAULT_USER)):
+            templates = {
+                category: template
+                for (category, name), template in global_templates.items()
+                if name == prompt_name
+            }
+        else:
+            templates = self.get_user_templates(user_id, prompt_name)
+        return templates.get(prompt_category) or templates.get("Default")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.global_templates = None
+            self.generation += 1
+
+    def invalidate(self):
+        self.clear()
+        self.version.bump()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "global_templates": len(self.global_templates or {}),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "compiled": compile_template.cache_info().currsize,
+            }
+
+
+prompt_templates = PromptTemplateCache()
+invalidate_on_commit(PROMPT_TEMPLATE_MODELS, prompt_templates.invalidate)
+
+
+def get_prompt_template(
+    user_id, prompt_name: str, prompt_category: str = "Default"
+) -> Optional[PromptTemplate]:
+    """Template of the prompt the user runs by this name, or None if there is none"""
+    return prompt_templates.get(user_id, prompt_name, prompt_category or "Default")
+
+
+def preload_global_prompts() -> int:
+    """Load the default user's prompts so the first requests don't query for them"""
+    try:
+        return len(prompt_templates.get_global_templates())
+    except Exception as e:
+        logging.warning(f"Unable to preload global prompts: {e}")
+        return 0
+
+
+def get_prompt_template_cache_metrics() -> dict:
+    return prompt_templates.metrics()
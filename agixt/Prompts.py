@@ -1,6 +1,8 @@
-from DB import Prompt, PromptCategory, Argument, User, get_session
+from DB import Prompt, PromptCategory, Argument, get_session
 from Globals import DEFAULT_USER
 from MagicalAuth import get_user_id
+from PromptTemplates import PromptTemplate, get_prompt_template, parse_prompt_args
+from typing import Optional
 import os
 
 
@@ -50,91 +52,40 @@ class Prompts:
         session.commit()
         session.close()
 
+    def get_prompt_template(
+        self, prompt_name: str, prompt_category: str = "Default"
+    ) -> Optional[PromptTemplate]:
+        template = get_prompt_template(self.user_id, prompt_name, prompt_category)
+        if template:
+            return template
+        prompt_file = os.path.normpath(
+            os.path.join(os.getcwd(), "prompts", "Default", f"{prompt_name}.txt")
+        )
+        base_path = os.path.join(os.getcwd(), "prompts")
+        if not prompt_file.startswith(base_path):
+            return None
+        if not os.path.exists(prompt_file):
+            return None
+        with open(prompt_file, "r") as f:
+            prompt_content = f.read()
+        self.add_prompt(
+            prompt_name=prompt_name,
+            prompt=prompt_content,
+            prompt_category="Default",
+        )
+        return get_prompt_template(self.user_id, prompt_name, "Default")
+
     def get_prompt(self, prompt_name: str, prompt_category: str = "Default"):
-        session = get_session()
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        prompt = (
-            session.query(Prompt)
-            .filter(
-                Prompt.name == prompt_name,
-                Prompt.user_id == user_data.id,
-                Prompt.prompt_category.has(name="Default"),
-            )
-            .join(PromptCategory)
-            .filter(PromptCategory.name == "Default", Prompt.user_id == user_data.id)
-            .first()
+        template = self.get_prompt_template(
+            prompt_name=prompt_name, prompt_category=prompt_category
         )
-        if not prompt:
-            prompt = (
-                session.query(Prompt)
-                .filter(
-                    Prompt.name == prompt_name,
-                    Prompt.user_id == self.user_id,
-                    Prompt.prompt_category.has(name=prompt_category),
-                )
-                .join(PromptCategory)
-                .filter(
-                    PromptCategory.name == prompt_category,
-                    Prompt.user_id == self.user_id,
-                )
-                .first()
-            )
-        if not prompt and prompt_category != "Default":
-            # Prompt not found in specified category, try the default category
-            prompt = (
-                session.query(Prompt)
-                .filter(
-                    Prompt.name == prompt_name,
-                    Prompt.user_id == self.user_id,
-                    Prompt.prompt_category.has(name="Default"),
-                )
-                .join(PromptCategory)
-                .filter(
-                    PromptCategory.name == "Default", Prompt.user_id == self.user_id
-                )
-                .first()
-            )
-        if not prompt:
-            prompt_file = os.path.normpath(
-                os.path.join(os.getcwd(), "prompts", "Default", f"{prompt_name}.txt")
-            )
-            base_path = os.path.join(os.getcwd(), "prompts")
-            if not prompt_file.startswith(base_path):
-                return None
-            if os.path.exists(prompt_file):
-                with open(prompt_file, "r") as f:
-                    prompt_content = f.read()
-                self.add_prompt(
-                    prompt_name=prompt_name,
-                    prompt=prompt_content,
-                    prompt_category="Default",
-                )
-                prompt = (
-                    session.query(Prompt)
-                    .filter(
-                        Prompt.name == prompt_name,
-                        Prompt.user_id == self.user_id,
-                        Prompt.prompt_category.has(name="Default"),
-                    )
-                    .join(PromptCategory)
-                    .filter(
-                        PromptCategory.name == "Default",
-                        Prompt.user_id == self.user_id,
-                    )
-                    .first()
-                )
-        if prompt:
-            prompt_content = prompt.content
-            session.close()
-            return prompt_content
-        session.close()
-        return None
+        return template.content if template else None
 
     def get_global_prompts(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
+        default_user_id = get_user_id(DEFAULT_USER)
         global_prompts = (
-            session.query(Prompt).filter(Prompt.user_id == user_data.id).all()
+            session.query(Prompt).filter(Prompt.user_id == default_user_id).all()
         )
         prompts = []
         for prompt in global_prompts:
@@ -196,16 +147,17 @@ class Prompts:
         if not prompt_category:
             prompt_category = "Default"
         session = get_session()
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
+        default_user_id = get_user_id(DEFAULT_USER)
         global_prompts = (
             session.query(Prompt)
             .filter(
-                Prompt.user_id == user_data.id,
+                Prompt.user_id == default_user_id,
                 Prompt.prompt_category.has(name=prompt_category),
             )
             .join(PromptCategory)
             .filter(
-                PromptCategory.name == prompt_category, Prompt.user_id == user_data.id
+                PromptCategory.name == prompt_category,
+                Prompt.user_id == default_user_id,
             )
             .all()
         )
@@ -226,16 +178,7 @@ class Prompts:
         return prompts
 
     def get_prompt_args(self, prompt_text):
-        prompt_args = []
-        start_index = prompt_text.find("{")
-        while start_index != -1:
-            end_index = prompt_text.find("}", start_index)
-            if end_index != -1:
-                prompt_args.append(prompt_text[start_index + 1 : end_index])
-                start_index = prompt_text.find("{", end_index)
-            else:
-                break
-        return prompt_args
+        return list(parse_prompt_args(prompt_text))
 
     def delete_prompt(self, prompt_name, prompt_category="Default"):
         if not prompt_category:
@@ -334,10 +277,10 @@ class Prompts:
 
     def get_prompt_categories(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
+        default_user_id = get_user_id(DEFAULT_USER)
         global_prompt_categories = (
             session.query(PromptCategory)
-            .filter(PromptCategory.user_id == user_data.id)
+            .filter(PromptCategory.user_id == default_user_id)
             .all()
         )
         user_prompt_categories = (
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import random
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+import httpx
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Requests a single provider endpoint may have in flight per worker
+PROVIDER_MAX_CONCURRENCY = int(getenv("PROVIDER_MAX_CONCURRENCY", "32"))
+# Pooled connections each provider client keeps per worker
+PROVIDER_MAX_CONNECTIONS = int(getenv("PROVIDER_MAX_CONNECTIONS", "64"))
+# Seconds a provider request may take before it is abandoned
+PROVIDER_TIMEOUT = float(getenv("PROVIDER_TIMEOUT", "600"))
+# Longest single backoff between retries of a failed provider request
+PROVIDER_MAX_BACKOFF = float(getenv("PROVIDER_MAX_BACKOFF", "120"))
+
+T = TypeVar("T")
+
+
+class LoopClients:
+    """Clients and concurrency limits that belong to one event loop"""
+
+    def __init__(self):
+        self.clients: Dict[Hashable, object] = {}
+        self.limits: Dict[Hashable, asyncio.Semaphore] = {}
+
+
+# httpx pools and asyncio semaphores are bound to the loop that first uses them
+_loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, LoopClients]" = (
+    weakref.WeakKeyDictionary()
+)
+_loops_lock = threading.Lock()
+
+
+def loop_clients() -> LoopClients:
+    loop = asyncio.get_running_loop()
+    with _loops_lock:
+        clients = _loops.get(loop)
+        if clients is None:
+            clients = _loops[loop] = LoopClients()
+        return clients
+
+
+def new_http_client(**kwargs) -> httpx.AsyncClient:
+    # requests and the provider SDKs' own clients follow redirects, httpx does not
+    kwargs.setdefault("follow_redirects", True)
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=PROVIDER_MAX_CONNECTIONS,
+            max_keepalive_connections=PROVIDER_MAX_CONNECTIONS,
+        ),
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10),
+        **kwargs,
+    )
+
+
+def get_client(key: Hashable, factory: Callable[[], T]) -> T:
+    """
+    Pooled client for `key` on the running loop, created by `factory` on first use.
+
+    Keys should include everything the client is configured with, usually the
+    provider, base URL and API key, so callers never reconfigure a shared client.
+    """
+    clients = loop_clients().clients
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = factory()
+    return client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared pooled httpx client for plain HTTP providers on the running loop"""
+    return get_client(("http",), new_http_client)
+
+
+@asynccontextmanager
+async def provider_slot(key: Hashable, limit: int = PROVIDER_MAX_CONCURRENCY):
+    """Hold one of the `limit` concurrent request slots of a provider endpoint"""
+    limits = loop_clients().limits
+    semaphore = limits.get(key)
+    if semaphore is None:
+        semaphore = limits[key] = asyncio.Semaphore(max(int(limit), 1))
+    async with semaphore:
+        yield
+
+
+def retry_after(error) -> Optional[float]:
+    """Seconds a rate limited provider asked us to wait, from an SDK error or response"""
+    response = getattr(error, "response", error)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, wait: float) -> float:
+    """Exponential backoff from `wait` seconds with jitter, so retries don't align"""
+    delay = min(float(wait) * 2 ** (attempt - 1), PROVIDER_MAX_BACKOFF)
+    return random.uniform(delay / 2, delay)
+
+
+async def request_with_retries(
+    name: str,
+    key: Hashable,
+    request: Callable[[], Awaitable[T]],
+    wait_between_requests: float = 0,
+    wait_after_failure: float = 3,
+    max_attempts: int = 4,
+    limit: int = PROVIDER_MAX_CONCURRENCY,
+) -> T:
+    """
+    Run a provider request without blocking the event loop.
+
+    Each attempt waits `wait_between_requests` seconds and then takes a slot of the
+    provider endpoint `key`, so at most `limit` requests are in flight per worker.
+    Failed attempts back off exponentially from `wait_after_failure` seconds with
+    jitter, or for as long as the provider's Retry-After header asks. Failures are
+    not retried when `wait_after_failure` is 0.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        if float(wait_between_requests) > 0:
+            await asyncio.sleep(float(wait_between_requests))
+        try:
+            async with provider_slot(key, limit):
+                return await request()
+        except Exception as e:
+            if attempt >= max_attempts or float(wait_after_failure) <= 0:
+                raise Exception(f"{name} API Error: Too many failures. {e}") from e
+            delay = retry_after(e) or backoff(attempt, wait_after_failure)
+            logging.info(
+                f"{name} API Error: {e}. Retrying in {delay:.1f} seconds (attempt {attempt}/{max_attempts})."
+            )
+            await asyncio.sleep(delay)
+
+
+async def close_provider_clients():
+    """Close the pooled clients of the running loop"""
+    loop = asyncio.get_running_loop()
+    with _loops_lock:
+        clients = _loops.pop(loop, None)
+    if clients is None:
+        return
+    for client in clients.clients.values():
+        close = getattr(client, "aclose", None) or getattr(client, "close", None)
+        try:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logging.warning(f"Error closing provider client: {e}")
@@ -17,6 +17,7 @@ from DB import (
 from Providers import get_providers, get_provider_options
 from Agent import add_agent
 from Globals import getenv, DEFAULT_USER
+from PromptTemplates import preload_global_prompts
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -605,6 +606,7 @@ def import_all_data():
     import_extensions()
     logging.info("Importing prompts...")
     import_prompts()
+    preload_global_prompts()
     logging.info("Importing agents...")
     import_agents()
     logging.info("Importing chains...")
@@ -125,64 +125,68 @@ class Task:
         if task and task.user_id == self.user_id:
             task.completed = True
             task.completed_at = datetime.datetime.now()
+            task.lease_owner = None
+            task.lease_expires_at = None
             session.commit()
         session.close()
 
-    async def execute_pending_tasks(self):
-        """Check and execute all pending tasks"""
-        tasks = await self.get_pending_tasks()
-        for task in tasks:
+    async def execute_task(self, task: TaskItem):
+        """Run one due task and mark it completed, raising if it fails"""
+        if task.category and task.category.name == "Follow-ups" and task.agent_id:
+            session = get_session()
             try:
-                session = get_session()
-                if task.category.name == "Follow-ups" and task.agent_id:
-                    agent = session.query(Agent).get(task.agent_id)
-                    if agent:
-                        conversation_name = get_conversation_name_by_id(
-                            conversation_id=task.memory_collection,
-                            user_id=self.user_id,
-                        )
-                        prompt = f"## Notes about scheduled follow-up task\n{task.description}\n\nThe assistant {agent.name} is doing a scheduled follow up with the user."
+                agent = session.query(Agent).get(task.agent_id)
+                agent_name = agent.name if agent else None
+            finally:
+                session.close()
+            if agent_name:
+                conversation_name = get_conversation_name_by_id(
+                    conversation_id=task.memory_collection,
+                    user_id=self.user_id,
+                )
+                prompt = f"## Notes about scheduled follow-up task\n{task.description}\n\nThe assistant {agent_name} is doing a scheduled follow up with the user."
 
-                        def execute_prompt():
-                            return self.ApiClient.prompt_agent(
-                                agent_name=agent.name,
-                                prompt_name="Think About It",
-                                prompt_args={
-                                    "user_input": prompt,
-                                    "conversation_name": conversation_name,
-                                    "websearch": False,
-                                    "analyze_user_input": False,
-                                    "log_user_input": False,
-                                    "log_output": True,
-                                    "tts": False,
-                                },
-                            )
+                def execute_prompt():
+                    return self.ApiClient.prompt_agent(
+                        agent_name=agent_name,
+                        prompt_name="Think About It",
+                        prompt_args={
+                            "user_input": prompt,
+                            "conversation_name": conversation_name,
+                            "websearch": False,
+                            "analyze_user_input": False,
+                            "log_user_input": False,
+                            "log_output": True,
+                            "tts": False,
+                        },
+                    )
 
-                        # Run the non-async prompt_agent in a thread pool
-                        loop = asyncio.get_running_loop()
-                        with ThreadPoolExecutor() as pool:
-                            try:
-                                response = await asyncio.wait_for(
-                                    loop.run_in_executor(pool, execute_prompt),
-                                    timeout=300,  # 5 minute timeout
-                                )
-                                logging.info(
-                                    f"Follow-up task {task.id} executed: {response[:100]}..."
-                                )
-                            except asyncio.TimeoutError:
-                                logging.error(
-                                    f"Task {task.id} timed out after 5 minutes"
-                                )
-                                raise
+                # Run the non-async prompt_agent in a thread pool
+                loop = asyncio.get_running_loop()
+                with ThreadPoolExecutor() as pool:
+                    try:
+                        response = await asyncio.wait_for(
+                            loop.run_in_executor(pool, execute_prompt),
+                            timeout=300,  # 5 minute timeout
+                        )
+                        logging.info(
+                            f"Follow-up task {task.id} executed: {response[:100]}..."
+                        )
+                    except asyncio.TimeoutError:
+                        logging.error(f"Task {task.id} timed out after 5 minutes")
+                        raise
 
-                # Mark the current task as completed
-                await self.mark_task_completed(str(task.id))
+        # Mark the current task as completed
+        await self.mark_task_completed(str(task.id))
 
+    async def execute_pending_tasks(self):
+        """Check and execute all pending tasks"""
+        tasks = await self.get_pending_tasks()
+        for task in tasks:
+            try:
+                await self.execute_task(task)
             except Exception as e:
                 logging.error(f"Error executing task {task.id}: {str(e)}")
-            finally:
-                if session:
-                    session.close()
 
     async def get_tasks_by_category(self, category_name: str) -> list:
         """Get all tasks in a category"""
@@ -1,20 +1,37 @@
 import asyncio
 import logging
-from DB import get_session, TaskItem, User
+import weakref
+from DB import get_session, TaskItem, User, DATABASE_TYPE
 from Globals import getenv
+from IdentityCache import invalidate_on_commit
 from Task import Task
 from datetime import datetime, timedelta
 from fastapi import HTTPException
-from hashlib import sha256
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import joinedload
+from typing import List, Optional
 import jwt
-import random
 import socket
+import uuid
 import os
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Due tasks a worker runs at the same time
+TASK_CONCURRENCY = int(getenv("TASK_CONCURRENCY", "4"))
+# Seconds a task may run before it is abandoned and retried
+TASK_TIMEOUT = float(getenv("TASK_TIMEOUT", "300"))
+# Seconds a claimed task stays leased to its worker, so a crashed worker's tasks are retried
+TASK_LEASE_SECONDS = float(getenv("TASK_LEASE_SECONDS", "600"))
+# Seconds before a failed task is retried, doubling with each attempt
+TASK_RETRY_SECONDS = float(getenv("TASK_RETRY_SECONDS", "60"))
+# Longest wait before a failed task is retried
+TASK_MAX_RETRY_SECONDS = float(getenv("TASK_MAX_RETRY_SECONDS", "3600"))
+# Longest the scheduler sleeps before looking for tasks scheduled by other workers
+TASK_MAX_SLEEP_SECONDS = float(getenv("TASK_MAX_SLEEP_SECONDS", "60"))
+
 
 def impersonate_user(user_id: str):
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
@@ -39,122 +56,255 @@ def impersonate_user(user_id: str):
     return token
 
 
+def claimable(now: datetime):
+    """Tasks that are due and not leased to a running worker"""
+    return (
+        TaskItem.completed == False,
+        TaskItem.scheduled == True,
+        TaskItem.due_date <= now,
+        or_(TaskItem.lease_expires_at == None, TaskItem.lease_expires_at <= now),
+    )
+
+
+def claim_due_tasks(owner: str, limit: int) -> List[TaskItem]:
+    """
+    Lease up to `limit` of the earliest due tasks to `owner`.
+
+    PostgreSQL skips rows another worker is claiming with FOR UPDATE SKIP LOCKED.
+    SQLite has no row locks, so the lease condition is repeated in the update and a
+    task another worker leased first is simply not taken.
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        query = (
+            session.query(TaskItem.id)
+            .filter(*claimable(now))
+            .order_by(TaskItem.due_date)
+            .limit(limit)
+        )
+        if DATABASE_TYPE != "sqlite":
+            query = query.with_for_update(skip_locked=True)
+        task_ids = [row[0] for row in query.all()]
+        if not task_ids:
+            session.rollback()
+            return []
+        session.query(TaskItem).filter(
+            TaskItem.id.in_(task_ids), *claimable(now)
+        ).update(
+            {
+                TaskItem.lease_owner: owner,
+                TaskItem.lease_expires_at: now + timedelta(seconds=TASK_LEASE_SECONDS),
+                TaskItem.attempts: func.coalesce(TaskItem.attempts, 0) + 1,
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+        return (
+            session.query(TaskItem)
+            .options(joinedload(TaskItem.category))
+            .filter(TaskItem.id.in_(task_ids), TaskItem.lease_owner == owner)
+            .order_by(TaskItem.due_date)
+            .all()
+        )
+    finally:
+        session.close()
+
+
+def next_task_ready_at() -> Optional[datetime]:
+    """When the next scheduled task becomes due or its lease lapses, if there is one"""
+    ready_at = case(
+        (TaskItem.lease_expires_at > TaskItem.due_date, TaskItem.lease_expires_at),
+        else_=TaskItem.due_date,
+    )
+    session = get_session()
+    try:
+        return (
+            session.query(func.min(ready_at))
+            .filter(
+                TaskItem.completed == False,
+                TaskItem.scheduled == True,
+                TaskItem.due_date != None,
+            )
+            .scalar()
+        )
+    finally:
+        session.close()
+
+
+def retry_task_later(task_id, owner: str, attempts: int):
+    """Give up a failed task's lease and keep it from being claimed until its backoff ends"""
+    delay = min(
+        TASK_RETRY_SECONDS * 2 ** max((attempts or 1) - 1, 0), TASK_MAX_RETRY_SECONDS
+    )
+    session = get_session()
+    try:
+        session.query(TaskItem).filter(
+            TaskItem.id == task_id, TaskItem.lease_owner == owner
+        ).update(
+            {
+                TaskItem.lease_owner: None,
+                TaskItem.lease_expires_at: datetime.now() + timedelta(seconds=delay),
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def release_task_leases(owner: str):
+    """Hand every unfinished task leased to `owner` back to the other workers"""
+    session = get_session()
+    try:
+        session.query(TaskItem).filter(
+            TaskItem.lease_owner == owner, TaskItem.completed == False
+        ).update(
+            {TaskItem.lease_owner: None, TaskItem.lease_expires_at: None},
+            synchronize_session=False,
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def delete_task_item(task_id):
+    session = get_session()
+    try:
+        session.query(TaskItem).filter(TaskItem.id == task_id).delete(
+            synchronize_session=False
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+# Monitors of this process, woken whenever a commit here writes a task
+_monitors: "weakref.WeakSet[TaskMonitor]" = weakref.WeakSet()
+
+
+def wake_task_monitors():
+    for monitor in list(_monitors):
+        monitor.wake()
+
+
+invalidate_on_commit((TaskItem,), wake_task_monitors)
+
+
 class TaskMonitor:
-    def __init__(self):
+    """
+    Runs due tasks across every worker and host.
+
+    Each worker leases the earliest due tasks it has room for, up to
+    TASK_CONCURRENCY at a time, then sleeps until the next task is due, a lease
+    lapses, one of its tasks finishes or a commit in this process writes a task.
+    Tasks scheduled by other processes are picked up within TASK_MAX_SLEEP_SECONDS.
+    A task whose worker dies is claimed again once its lease lapses.
+    """
+
+    def __init__(self, concurrency: int = TASK_CONCURRENCY):
         self.running = False
         self.tasks = []
-        self._process_lock = asyncio.Lock()
-        self.worker_id = None
-        self.total_workers = int(getenv("UVICORN_WORKERS"))
-        self._initialize_worker_id()
-
-    def _initialize_worker_id(self):
-        """Generate a unique worker ID based on process information"""
-        # Combine multiple sources of uniqueness
-        pid = os.getpid()
-        hostname = socket.gethostname()
-        # Create a hash of process-specific information
-        unique_str = f"{hostname}:{pid}:{os.getppid()}"
-        hash_obj = sha256(unique_str.encode())
-        # Use last 4 bits of hash for 0-15 worker ID range
-        self.worker_id = int(hash_obj.hexdigest()[-1], 16) % self.total_workers
-        logging.info(
-            f"Initialized worker {self.worker_id} of {self.total_workers} (PID: {pid})"
-        )
+        self.concurrency = max(int(concurrency), 1)
+        self.running_tasks = set()
+        self.loop = None
+        self.wakeup = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.claimed = 0
+        self.completed = 0
+        self.failed = 0
 
-    def _should_process_task(self, task_id: str) -> bool:
-        """Determine if this worker should process the given task"""
-        # Use consistent hashing to determine task ownership
-        hash_obj = sha256(task_id.encode())
-        task_num = int(hash_obj.hexdigest()[-1], 16)
-        return task_num % self.total_workers == self.worker_id
-
-    async def get_all_pending_tasks(self) -> list:
-        """Get pending tasks assigned to this worker"""
-        if self.worker_id is None:
-            logging.error("Worker ID not initialized!")
-            return []
+    def wake(self):
+        """Make the scheduler look for due tasks now; safe from any thread"""
+        if self.loop is None or self.wakeup is None or self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            pass
 
-        session = get_session()
+    async def run_task(self, task: TaskItem):
         try:
-            now = datetime.now()
-            all_tasks = (
-                session.query(TaskItem)
-                .filter(
-                    TaskItem.completed == False,
-                    TaskItem.scheduled == True,
-                    TaskItem.due_date <= now,
-                )
-                .all()
+            if not task.user_id:
+                logging.error(f"Task {task.id} has no associated user")
+                await asyncio.to_thread(delete_task_item, task.id)
+                return
+            logging.info(f"Worker {self.worker_id} processing task {task.id}")
+            token = await asyncio.to_thread(impersonate_user, task.user_id)
+            task_manager = await asyncio.to_thread(Task, token)
+            await asyncio.wait_for(
+                task_manager.execute_task(task), timeout=TASK_TIMEOUT
             )
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            if isinstance(e, asyncio.TimeoutError):
+                logging.error(f"Task {task.id} timed out")
+            else:
+                logging.error(f"Error processing task {task.id}: {str(e)}")
+            try:
+                await asyncio.to_thread(
+                    retry_task_later, task.id, self.worker_id, task.attempts
+                )
+            except Exception as e:
+                logging.error(f"Error rescheduling task {task.id}: {str(e)}")
 
-            # Filter tasks for this worker
-            my_tasks = [
-                task for task in all_tasks if self._should_process_task(str(task.id))
-            ]
+    def spawn(self, task: TaskItem):
+        job = asyncio.create_task(self.run_task(task))
+        self.running_tasks.add(job)
+        job.add_done_callback(self.finished)
 
-            return my_tasks
-        finally:
-            session.close()
+    def finished(self, job):
+        self.running_tasks.discard(job)
+        self.wakeup.set()
 
     async def process_tasks(self):
-        """Process tasks assigned to this worker"""
+        """Claim and run due tasks until stopped"""
         while self.running:
             try:
-                # Add initial delay based on worker ID
-                if not hasattr(self, "_initial_delay_done"):
-                    delay = self.worker_id * 5  # 5 second stagger
-                    await asyncio.sleep(delay)
-                    self._initial_delay_done = True
-
-                async with self._process_lock:
-                    pending_tasks = await self.get_all_pending_tasks()
-
-                    for pending_task in pending_tasks:
-                        try:
-                            session = get_session()
-                            try:
-                                if not pending_task.user_id:
-                                    logging.error(
-                                        f"Task {pending_task.id} has no associated user"
-                                    )
-                                    session.delete(pending_task)
-                                    session.commit()
-                                    continue
-
-                                logging.info(
-                                    f"Worker {self.worker_id} processing task {pending_task.id}"
-                                )
-                                task_manager = Task(
-                                    token=impersonate_user(user_id=pending_task.user_id)
-                                )
-
-                                try:
-                                    await asyncio.wait_for(
-                                        task_manager.execute_pending_tasks(),
-                                        timeout=300,
-                                    )
-                                except asyncio.TimeoutError:
-                                    logging.error(f"Task {pending_task.id} timed out")
-                                    continue
-                            finally:
-                                session.close()
-
-                        except Exception as e:
-                            logging.error(
-                                f"Error processing task {pending_task.id}: {str(e)}"
-                            )
-                            continue
-
-                # Add randomized delay between checks (55-65 seconds)
-                check_interval = 60 + random.uniform(-5, 5)
-                await asyncio.sleep(check_interval)
-
+                running = len(self.running_tasks)
+                capacity = self.concurrency - running
+                claimed = []
+                if capacity > 0:
+                    claimed = await asyncio.to_thread(
+                        claim_due_tasks, self.worker_id, capacity
+                    )
+                    self.claimed += len(claimed)
+                    for task in claimed:
+                        self.spawn(task)
+                    if len(claimed) == capacity:
+                        # More may be due, claim them as soon as there is room
+                        continue
+                # Our own claim woke us, anything written after this is new
+                self.wakeup.clear()
+                if len(self.running_tasks) < running + len(claimed):
+                    # A task finished while we were claiming, so there is room again
+                    continue
+                delay = TASK_MAX_SLEEP_SECONDS
+                # While full, only a finishing task (which sets wakeup) makes room, so
+                # don't poll for the next due task every second during a backlog
+                ready_at = (
+                    await asyncio.to_thread(next_task_ready_at)
+                    if len(self.running_tasks) < self.concurrency
+                    else None
+                )
+                if ready_at is not None:
+                    until_ready = (ready_at - datetime.now()).total_seconds()
+                    # A task that is already due is being claimed by another worker
+                    delay = min(delay, until_ready if until_ready > 0 else 1)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logging.error(
                     f"Error in main task loop (Worker {self.worker_id}): {str(e)}"
                 )
-                await asyncio.sleep(60)
+                await asyncio.sleep(TASK_MAX_SLEEP_SECONDS)
 
     async def start(self):
         """Start the task monitoring service"""
@@ -162,13 +312,17 @@ class TaskMonitor:
             return
 
         self.running = True
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        _monitors.add(self)
         task = asyncio.create_task(self.process_tasks())
         self.tasks.append(task)
 
     async def stop(self):
         """Stop the task monitoring service"""
         self.running = False
-        for task in self.tasks:
+        _monitors.discard(self)
+        for task in self.tasks + list(self.running_tasks):
             if not task.done():
                 task.cancel()
                 try:
@@ -176,4 +330,23 @@ class TaskMonitor:
                 except asyncio.CancelledError:
                     pass
         self.tasks.clear()
+        self.running_tasks.clear()
+        try:
+            await asyncio.to_thread(release_task_leases, self.worker_id)
+        except Exception as e:
+            logging.error(f"Error releasing task leases: {str(e)}")
         logger.info(f"Task monitor service stopped on worker {self.worker_id}.")
+
+    def metrics(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "running": len(self.running_tasks),
+            "concurrency": self.concurrency,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+def get_task_scheduler_metrics() -> list:
+    return [monitor.metrics() for monitor in list(_monitors)]
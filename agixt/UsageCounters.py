@@ -0,0 +1,243 @@
+import atexit
+import logging
+import threading
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from DB import TokenUsage, DATABASE_TYPE, get_session
+from Globals import getenv
+from MessageLog import is_transient_error
+
+if DATABASE_TYPE == "sqlite":
+    from sqlalchemy.dialects.sqlite import insert
+else:
+    from sqlalchemy.dialects.postgresql import insert
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Seconds token usage deltas are coalesced in memory before they are written
+TOKEN_USAGE_FLUSH_SECONDS = float(getenv("TOKEN_USAGE_FLUSH_SECONDS", "5"))
+
+UsageKey = Tuple[str, date, str, str]
+
+
+def usage_upsert():
+    """INSERT ... ON CONFLICT DO UPDATE that adds the row's deltas to the counters"""
+    statement = insert(TokenUsage.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", "usage_date", "agent_id", "provider"],
+        set_={
+            "input_tokens": TokenUsage.__table__.c.input_tokens
+            + statement.excluded.input_tokens,
+            "output_tokens": TokenUsage.__table__.c.output_tokens
+            + statement.excluded.output_tokens,
+        },
+    )
+
+
+class UsageCounters:
+    """
+    In-process aggregator of token usage.
+
+    record() only adds to an in-memory delta keyed by (user, UTC day, agent,
+    provider). A daemon thread writes the coalesced deltas every
+    TOKEN_USAGE_FLUSH_SECONDS with one atomic upsert per key, so concurrent requests
+    and workers never lose increments and an inference costs no commits.
+    """
+
+    def __init__(self, flush_seconds: float = TOKEN_USAGE_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.pending: Dict[UsageKey, List[int]] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(
+        self,
+        user_id,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        agent_id=None,
+        provider: Optional[str] = None,
+    ):
+        if not input_tokens and not output_tokens:
+            return
+        key = (
+            str(user_id),
+            datetime.now(timezone.utc).date(),
+            str(agent_id) if agent_id else "",
+            str(provider) if provider else "",
+        )
+        with self.lock:
+            delta = self.pending.setdefault(key, [0, 0])
+            delta[0] += int(input_tokens)
+            delta[1] += int(output_tokens)
+        self.start()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            if self.stopped.is_set():
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="token-usage", daemon=True
+            )
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """
+        Write every pending delta. If the batch fails, keys are retried one at a time
+        so a key the database rejects, like one whose user was deleted, is dropped
+        alone. Deltas are only put back when the database can't be reached.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                self.write(pending)
+                return
+            except Exception as e:
+                if is_transient_error(e):
+                    logging.error(
+                        f"Unable to write token usage for {len(pending)} keys, retrying later: {e}"
+                    )
+                    self.restore(pending)
+                    return
+            for number, (key, delta) in enumerate(pending.items()):
+                try:
+                    self.write({key: delta})
+                except Exception as e:
+                    if is_transient_error(e):
+                        logging.error(
+                            f"Unable to write token usage, retrying later: {e}"
+                        )
+                        self.restore(dict(list(pending.items())[number:]))
+                        return
+                    logging.error(
+                        f"Dropping token usage the database rejected for user {key[0]} on {key[1]}, agent {key[2] or None}, provider {key[3] or None}: {delta[0]} input and {delta[1]} output tokens: {e}"
+                    )
+
+    def write(self, pending: Dict[UsageKey, List[int]]):
+        rows = [
+            {
+                "user_id": user_id,
+                "usage_date": usage_date,
+                "agent_id": agent_id,
+                "provider": provider,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+            }
+            for (user_id, usage_date, agent_id, provider), (
+                input_tokens,
+                output_tokens,
+            ) in pending.items()
+        ]
+        session = get_session()
+        try:
+            session.execute(usage_upsert(), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def restore(self, pending: Dict[UsageKey, List[int]]):
+        """Put unwritten deltas back, adding to any recorded since they were taken"""
+        with self.lock:
+            for key, (input_tokens, output_tokens) in pending.items():
+                delta = self.pending.setdefault(key, [0, 0])
+                delta[0] += input_tokens
+                delta[1] += output_tokens
+
+    def close(self):
+        """Stop the background writer and write what is still pending"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.flush()
+
+    def pending_for(self, user_id) -> Dict[UsageKey, List[int]]:
+        user_id = str(user_id)
+        with self.lock:
+            return {
+                key: list(delta)
+                for key, delta in self.pending.items()
+                if key[0] == user_id
+            }
+
+    def get_totals(self, user_id) -> dict:
+        """Lifetime input and output tokens of a user, including unwritten deltas"""
+        session = get_session()
+        try:
+            input_tokens, output_tokens = (
+                session.query(
+                    func.coalesce(func.sum(TokenUsage.input_tokens), 0),
+                    func.coalesce(func.sum(TokenUsage.output_tokens), 0),
+                )
+                .filter(TokenUsage.user_id == user_id)
+                .one()
+            )
+        finally:
+            session.close()
+        for pending_input, pending_output in self.pending_for(user_id).values():
+            input_tokens += pending_input
+            output_tokens += pending_output
+        return {"input_tokens": int(input_tokens), "output_tokens": int(output_tokens)}
+
+    def get_breakdown(
+        self, user_id, start_date: date = None, end_date: date = None
+    ) -> List[dict]:
+        """Usage of a user per day, agent and provider, oldest day first"""
+        session = get_session()
+        try:
+            query = session.query(TokenUsage).filter(TokenUsage.user_id == user_id)
+            if start_date:
+                query = query.filter(TokenUsage.usage_date >= start_date)
+            if end_date:
+                query = query.filter(TokenUsage.usage_date <= end_date)
+            usage = {
+                (row.usage_date, row.agent_id, row.provider): [
+                    row.input_tokens,
+                    row.output_tokens,
+                ]
+                for row in query.all()
+            }
+        finally:
+            session.close()
+        for (_, usage_date, agent_id, provider), delta in self.pending_for(
+            user_id
+        ).items():
+            if (start_date and usage_date < start_date) or (
+                end_date and usage_date > end_date
+            ):
+                continue
+            counters = usage.setdefault((usage_date, agent_id, provider), [0, 0])
+            counters[0] += delta[0]
+            counters[1] += delta[1]
+        return [
+            {
+                "date": usage_date.isoformat(),
+                "agent_id": agent_id or None,
+                "provider": provider or None,
+                "input_tokens": int(input_tokens),
+                "output_tokens": int(output_tokens),
+            }
+            for (usage_date, agent_id, provider), (
+                input_tokens,
+                output_tokens,
+            ) in sorted(usage.items())
+        ]
+
+
+token_usage = UsageCounters()
+atexit.register(token_usage.close)
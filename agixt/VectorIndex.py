@@ -0,0 +1,426 @@
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Collections smaller than this are searched exhaustively, larger ones are partitioned
+IVF_MIN_SIZE = int(getenv("VECTOR_INDEX_IVF_MIN_SIZE", "4096"))
+# Number of inverted lists probed per query once a collection is partitioned
+IVF_NPROBE = int(getenv("VECTOR_INDEX_NPROBE", "8"))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+# Vectors assigned to lists per matrix product, bounding the score matrix to ~256 MB
+ASSIGN_BATCH_SIZE = 65536
+# Memory the vector indexes of one worker may hold, least recently searched are evicted
+VECTOR_INDEX_MAX_BYTES = int(getenv("VECTOR_INDEX_MAX_MB", "1024")) * 1024 * 1024
+# Collections that can be loading at once, each key always maps to the same lock
+VECTOR_INDEX_LOAD_LOCKS = 64
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Scale each row to unit length, leaving zero vectors untouched"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over a sample of unit vectors"""
+    rng = np.random.default_rng(seed)
+    sample_size = nlist * KMEANS_SAMPLES_PER_LIST
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for list_number in range(nlist):
+            members = vectors[assignments == list_number]
+            if len(members):
+                centroids[list_number] = members.mean(axis=0)
+        centroids = normalize_vectors(centroids)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Nearest centroid of each unit vector, scored a batch of rows at a time"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start : start + ASSIGN_BATCH_SIZE]
+        assignments[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def top_k_similarities(
+    queries: np.ndarray, vectors: np.ndarray, limit: int, min_score: float = -1.0
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Score unit-length queries against unit-length rows with a single matrix product.
+
+    Returns (row indices, scores) per query, best first. Only the `limit` best rows of
+    each query are sorted, the rest are discarded with argpartition.
+    """
+    scores = queries @ vectors.T
+    results = []
+    for query_scores in np.atleast_2d(scores):
+        matches = np.flatnonzero(query_scores >= min_score)
+        if len(matches) > limit:
+            matches = matches[
+                np.argpartition(-query_scores[matches], limit - 1)[:limit]
+            ]
+        matches = matches[np.argsort(-query_scores[matches])]
+        results.append((matches, query_scores[matches]))
+    return results
+
+
+class MemoryVectorIndex:
+    """
+    IVF-flat index over the embeddings of one memory collection.
+
+    Small collections live in a single list and are searched exhaustively. Once a
+    collection reaches IVF_MIN_SIZE it is partitioned with k-means into ~sqrt(n)
+    lists and queries only score the IVF_NPROBE lists closest to the query, so
+    search cost grows sub-linearly with the collection size.
+
+    Vectors are normalized when written and each list keeps them in one contiguous,
+    over-allocated matrix, so a query is a single matrix product per probed list.
+    """
+
+    def __init__(self, use_ivf: bool = True):
+        self.use_ivf = use_ivf
+        self.lock = threading.RLock()
+        self.signature = None
+        self.dimension = None
+        self.centroids = None
+        self.trained_size = 0
+        self.list_ids: List[list] = [[]]
+        self.list_vectors: List[Optional[np.ndarray]] = [None]
+        self.locations: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.locations)
+
+    def nbytes(self) -> int:
+        """
+        Bytes held by the vector buffers and centroids, read without the lock since
+        eviction only needs an estimate and shouldn't wait for a search or training.
+        """
+        centroids = self.centroids
+        size = sum(buffer.nbytes for buffer in self.list_vectors if buffer is not None)
+        return size + (centroids.nbytes if centroids is not None else 0)
+
+    def load(self, rows: Iterable[Tuple[object, object]]):
+        """Bulk load (id, embedding) rows, typically straight from the memory table"""
+        ids, embeddings = [], []
+        for memory_id, embedding in rows:
+            if embedding is not None:
+                ids.append(memory_id)
+                embeddings.append(embedding)
+        self.add(ids, embeddings)
+
+    def add(self, ids: List[object], embeddings: List[object], train: bool = True):
+        with self.lock:
+            valid_ids, valid_vectors = [], []
+            for memory_id, embedding in zip(ids, embeddings):
+                if embedding is None:
+                    continue
+                vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+                if self.dimension is None:
+                    self.dimension = vector.shape[0]
+                if vector.shape[0] != self.dimension:
+                    logging.warning(
+                        f"Vector shape mismatch: ({vector.shape[0]},) vs ({self.dimension},)"
+                    )
+                    continue
+                valid_ids.append(memory_id)
+                valid_vectors.append(vector)
+            if not valid_ids:
+                return
+            self.remove(valid_ids)
+            vectors = normalize_vectors(np.stack(valid_vectors))
+            if self.centroids is None:
+                assignments = np.zeros(len(valid_ids), dtype=np.int64)
+            else:
+                assignments = assign_lists(vectors, self.centroids)
+            for list_number in np.unique(assignments):
+                rows = np.flatnonzero(assignments == list_number)
+                self._append(
+                    int(list_number), [valid_ids[row] for row in rows], vectors[rows]
+                )
+            if train:
+                self._maybe_train()
+
+    def remove(self, ids: List[object]):
+        with self.lock:
+            by_list: Dict[int, set] = {}
+            for memory_id in ids:
+                key = str(memory_id)
+                list_number = self.locations.pop(key, None)
+                if list_number is not None:
+                    by_list.setdefault(list_number, set()).add(key)
+            for list_number, removed in by_list.items():
+                keep = [
+                    row
+                    for row, memory_id in enumerate(self.list_ids[list_number])
+                    if str(memory_id) not in removed
+                ]
+                self.list_ids[list_number] = [
+                    self.list_ids[list_number][row] for row in keep
+                ]
+                buffer = self.list_vectors[list_number]
+                self.list_vectors[list_number] = buffer[keep] if keep else None
+
+    def search(
+        self, query_embedding, limit: int, min_score: float = 0.0
+    ) -> List[Tuple[object, float]]:
+        """Return up to `limit` (id, cosine similarity) pairs, best first"""
+        if query_embedding is None:
+            return []
+        return self.search_many([query_embedding], limit, min_score)[0]
+
+    def search_many(
+        self, query_embeddings, limit: int, min_score: float = 0.0
+    ) -> List[List[Tuple[object, float]]]:
+        """Search several queries at once, scoring each probed list with one matrix product"""
+        results = [[] for _ in query_embeddings]
+        if limit <= 0 or not len(query_embeddings):
+            return results
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries.reshape(len(query_embeddings), -1)
+        with self.lock:
+            if not self.locations:
+                return results
+            if queries.shape[1] != self.dimension:
+                logging.warning(
+                    f"Vector shape mismatch: ({queries.shape[1]},) vs ({self.dimension},)"
+                )
+                return results
+            queries = normalize_vectors(queries)
+            if self.centroids is None:
+                probes = {0: list(range(len(queries)))}
+            else:
+                nprobe = min(IVF_NPROBE, len(self.centroids))
+                centroid_scores = queries @ self.centroids.T
+                nearest = np.argpartition(-centroid_scores, nprobe - 1, axis=1)
+                probes = {}
+                for query_number, lists in enumerate(nearest[:, :nprobe]):
+                    for list_number in lists:
+                        probes.setdefault(int(list_number), []).append(query_number)
+            for list_number, query_numbers in probes.items():
+                size = len(self.list_ids[list_number])
+                if not size:
+                    continue
+                vectors = self.list_vectors[list_number][:size]
+                ids = self.list_ids[list_number]
+                matches = top_k_similarities(
+                    queries[query_numbers], vectors, limit, min_score
+                )
+                for query_number, (rows, scores) in zip(query_numbers, matches):
+                    results[query_number].extend(
+                        (ids[row], float(score)) for row, score in zip(rows, scores)
+                    )
+        for query_results in results:
+            query_results.sort(key=lambda x: x[1], reverse=True)
+            del query_results[limit:]
+        return results
+
+    def _append(self, list_number: int, ids: List[object], vectors: np.ndarray):
+        size = len(self.list_ids[list_number])
+        buffer = self.list_vectors[list_number]
+        if buffer is None or len(buffer) < size + len(vectors):
+            # Grow geometrically so appends are amortized O(1) per vector
+            capacity = max(
+                size + len(vectors), 2 * (len(buffer) if buffer is not None else 0)
+            )
+            grown = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            if size:
+                grown[:size] = buffer[:size]
+            buffer = grown
+            self.list_vectors[list_number] = buffer
+        buffer[size : size + len(vectors)] = vectors
+        self.list_ids[list_number].extend(ids)
+        for memory_id in ids:
+            self.locations[str(memory_id)] = list_number
+
+    def _maybe_train(self):
+        # Retrain whenever the collection has doubled since the last partitioning
+        if (
+            self.use_ivf
+            and len(self) >= IVF_MIN_SIZE
+            and len(self) >= 2 * self.trained_size
+        ):
+            self._train()
+
+    def _train(self):
+        ids = [memory_id for list_ids in self.list_ids for memory_id in list_ids]
+        vectors = np.concatenate(
+            [
+                buffer[: len(list_ids)]
+                for list_ids, buffer in zip(self.list_ids, self.list_vectors)
+                if list_ids
+            ]
+        )
+        nlist = max(1, int(np.sqrt(len(ids))))
+        self.centroids = train_centroids(vectors, nlist)
+        self.trained_size = len(ids)
+        self.list_ids = [[] for _ in range(nlist)]
+        self.list_vectors = [None] * nlist
+        self.locations = {}
+        assignments = assign_lists(vectors, self.centroids)
+        for list_number in np.unique(assignments):
+            rows = np.flatnonzero(assignments == list_number)
+            self._append(int(list_number), [ids[row] for row in rows], vectors[rows])
+        logging.info(
+            f"Partitioned vector index of {len(ids)} memories into {nlist} lists"
+        )
+
+
+class VectorIndexRegistry:
+    """
+    Process-wide LRU of vector indexes keyed by (agent_id, conversation_id).
+
+    Indexes are built lazily from a loader on first use and rebuilt whenever the
+    caller's signature of the underlying collection no longer matches, which is how
+    writes made by other workers are picked up. Loading happens outside the registry
+    lock under a lock of its key, so a cold collection only delays searches of that
+    collection. Least recently used indexes are evicted past `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        index_factory: Callable[[], MemoryVectorIndex] = None,
+        max_bytes: int = VECTOR_INDEX_MAX_BYTES,
+    ):
+        self.index_factory = index_factory or (
+            lambda: MemoryVectorIndex(
+                use_ivf=getenv("VECTOR_INDEX", "ivf").lower() == "ivf"
+            )
+        )
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.load_locks = [threading.Lock() for _ in range(VECTOR_INDEX_LOAD_LOCKS)]
+        self.indexes: "OrderedDict[Tuple[str, Optional[str]], MemoryVectorIndex]" = (
+            OrderedDict()
+        )
+        self.evictions = 0
+
+    @staticmethod
+    def key(agent_id, conversation_id) -> Tuple[str, Optional[str]]:
+        return (str(agent_id), str(conversation_id) if conversation_id else None)
+
+    def load_lock(self, key) -> threading.Lock:
+        return self.load_locks[hash(key) % len(self.load_locks)]
+
+    def cached(self, key, signature=None) -> Optional[MemoryVectorIndex]:
+        """The loaded index of `key` if its signature matches, marked as recently used"""
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None or (
+                signature is not None and index.signature != signature
+            ):
+                return None
+            self.indexes.move_to_end(key)
+            return index
+
+    def get(
+        self, agent_id, conversation_id, signature, loader: Callable[[], Iterable]
+    ) -> MemoryVectorIndex:
+        key = self.key(agent_id, conversation_id)
+        index = self.cached(key, signature)
+        if index is not None:
+            return index
+        with self.load_lock(key):
+            # Another thread may have loaded it while this one waited
+            index = self.cached(key, signature)
+            if index is not None:
+                return index
+            index = self.index_factory()
+            index.load(loader())
+            index.signature = signature
+            with self.lock:
+                self.indexes[key] = index
+                self.indexes.move_to_end(key)
+            self.evict()
+            return index
+
+    def add(self, agent_id, conversation_id, ids, embeddings, signature=None):
+        """
+        Apply local writes to an already loaded index, cold indexes load later.
+
+        `signature(previous, added)` derives the collection's signature after the write
+        from the one the index was loaded or last updated with, so writes committed by
+        other workers in the meantime still show up as a mismatch and force a reload.
+        """
+        key = self.key(agent_id, conversation_id)
+        with self.load_lock(key):
+            index = self.cached(key)
+            if index is None:
+                return
+            before = len(index)
+            index.add(ids, embeddings)
+            if callable(signature):
+                index.signature = signature(index.signature, len(index) - before)
+            else:
+                index.signature = signature
+        self.evict()
+
+    def remove(self, agent_id, conversation_id, ids, signature=None):
+        """Drop deleted ids from a loaded index, see add() for `signature`"""
+        key = self.key(agent_id, conversation_id)
+        with self.load_lock(key):
+            index = self.cached(key)
+            if index is None:
+                return
+            before = len(index)
+            index.remove(ids)
+            if callable(signature):
+                index.signature = signature(index.signature, before - len(index))
+            else:
+                index.signature = signature
+
+    def evict(self):
+        """Drop least recently used indexes until the rest fit in `max_bytes`"""
+        with self.lock:
+            indexes = list(self.indexes.items())
+        sizes = {key: index.nbytes() for key, index in indexes}
+        total = sum(sizes.values())
+        with self.lock:
+            while total > self.max_bytes and len(self.indexes) > 1:
+                key, _ = self.indexes.popitem(last=False)
+                total -= sizes.get(key, 0)
+                self.evictions += 1
+
+    def invalidate(self, agent_id, conversation_id=None, all_collections=False):
+        with self.lock:
+            if all_collections:
+                for key in [k for k in self.indexes if k[0] == str(agent_id)]:
+                    del self.indexes[key]
+            else:
+                self.indexes.pop(self.key(agent_id, conversation_id), None)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            indexes = list(self.indexes.values())
+            evictions = self.evictions
+        return {
+            "indexes": len(indexes),
+            "vectors": sum(len(index) for index in indexes),
+            "bytes": sum(index.nbytes() for index in indexes),
+            "evictions": evictions,
+        }
+
+
+memory_indexes = VectorIndexRegistry()
+
+
+def get_vector_index_metrics() -> dict:
+    return memory_indexes.metrics()
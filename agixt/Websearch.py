@@ -11,7 +11,7 @@ from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup  # type: ignore
 from typing import List
 from ApiClient import Agent, Conversations
-from Globals import getenv, get_tokens
+from Globals import getenv, estimate_tokens, get_tokens
 from Memories import Memories
 from datetime import datetime
 from googleapiclient.discovery import build
@@ -121,7 +121,9 @@ class Websearch:
             # It is unlikely to reduce the content by more than half.
             # We don't want to hit the max tokens limit and risk losing content.
             max_tokens = 8000
-        if get_tokens(text=content) < int(max_tokens):
+        # The byte length bounds the token count, so short pages skip tokenizing
+        fits = estimate_tokens(content) < int(max_tokens)
+        if fits or get_tokens(text=content) < int(max_tokens):
             return self.ApiClient.prompt_agent(
                 agent_name=self.agent_name,
                 prompt_name="Web Summary",
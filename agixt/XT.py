@@ -3,8 +3,9 @@ from ApiClient import get_api_client, Conversations, Prompts, Chain
 from Conversations import get_conversation_name_by_id, get_conversation_id_by_name
 from Memories import Memories
 from Extensions import Extensions
+from Chain import ChainRunContext, get_step_graph, run_step_graph
 from pydub import AudioSegment
-from Globals import getenv, get_tokens, DEFAULT_SETTINGS
+from Globals import getenv, get_tokens, DEFAULT_SETTINGS, TokenCounter
 from Models import ChatCompletions, TasksToDo, ChainCommandName, TranslationRequest
 from datetime import datetime
 from typing import (
@@ -449,9 +450,15 @@ class AGiXT:
         user_input="",
         agent_override="",
         chain_args={},
+        run_context: ChainRunContext = None,
     ):
         if not chain_run_id:
             chain_run_id = await self.chain.get_chain_run_id(chain_name=chain_name)
+        standalone_step = run_context is None
+        if standalone_step:
+            run_context = ChainRunContext(
+                chain=self.chain, chain_name=chain_name, chain_run_id=chain_run_id
+            )
         if step:
             if "prompt_type" in step:
                 if agent_override != "":
@@ -466,9 +473,7 @@ class AGiXT:
                     prompt_name = step["prompt"]["prompt_name"]
                 else:
                     prompt_name = ""
-                args = self.chain.get_step_content(
-                    chain_run_id=chain_run_id,
-                    chain_name=chain_name,
+                args = run_context.substitute(
                     prompt_content=step["prompt"],
                     user_input=user_input,
                     agent_name=agent_name,
@@ -507,7 +512,9 @@ class AGiXT:
                         args["voice_response"] = False
                         args["log_output"] = False
                         args["user_input"] = user_input
-                        result = self.ApiClient.prompt_agent(
+                        # The SDK call blocks, run it in a thread so parallel steps overlap
+                        result = await asyncio.to_thread(
+                            self.ApiClient.prompt_agent,
                             agent_name=agent_name,
                             prompt_name=prompt_name,
                             prompt_args=args,
@@ -543,12 +550,9 @@ class AGiXT:
                 result = json.dumps(result)
             if not isinstance(result, str):
                 result = str(result)
-            await self.chain.update_step_response(
-                chain_run_id=chain_run_id,
-                chain_name=chain_name,
-                step_number=step_number,
-                response=result,
-            )
+            run_context.record(step_number=step_number, response=result)
+            if standalone_step:
+                await run_context.flush()
             return result
         else:
             return None
@@ -585,34 +589,62 @@ class AGiXT:
             return f"Chain `{chain_name}` has no steps."
         if len(chain_data["steps"]) == 0:
             return f"Chain `{chain_name}` has no steps."
-        for step_data in chain_data["steps"]:
-            if int(step_data["step"]) >= int(from_step):
-                if "prompt" in step_data and "step" in step_data:
-                    step = {}
-                    if "agent_name" not in step_data:
-                        step_data["agent_name"] = self.agent_name
-                    step["agent_name"] = (
-                        agent_override
-                        if agent_override != ""
-                        else step_data["agent_name"]
-                    )
-                    step["prompt_type"] = step_data["prompt_type"]
-                    step["prompt"] = step_data["prompt"]
-                    step["step"] = step_data["step"]
-                    task = await self.run_chain_step(
-                        chain_run_id=chain_run_id,
-                        step=step,
-                        chain_name=chain_name,
-                        user_input=user_input,
-                        agent_override=agent_override,
-                        chain_args=chain_args,
-                    )
-                    step_responses.append(task)
+        steps = {
+            int(step_data["step"]): step_data
+            for step_data in chain_data["steps"]
+            if int(step_data["step"]) >= int(from_step)
+            and "prompt" in step_data
+            and "step" in step_data
+        }
+
+        run_context = ChainRunContext(
+            chain=self.chain, chain_name=chain_name, chain_run_id=chain_run_id
+        )
+
+        async def run_step(step_number):
+            step_data = steps[step_number]
+            step = {}
+            if "agent_name" not in step_data:
+                step_data["agent_name"] = self.agent_name
+            step["agent_name"] = (
+                agent_override if agent_override != "" else step_data["agent_name"]
+            )
+            step["prompt_type"] = step_data["prompt_type"]
+            step["prompt"] = step_data["prompt"]
+            step["step"] = step_data["step"]
+            return await self.run_chain_step(
+                chain_run_id=chain_run_id,
+                step=step,
+                chain_name=chain_name,
+                user_input=user_input,
+                agent_override=agent_override,
+                chain_args=chain_args,
+                run_context=run_context,
+            )
+
+        # Steps only wait for the {STEPn} responses they use, independent steps overlap
+        graph = get_step_graph(
+            step_numbers=steps.keys(),
+            dependencies=self.chain.get_chain_step_dependencies(chain_name=chain_name),
+        )
+        try:
+            results = await run_step_graph(graph=graph, run_step=run_step)
+        finally:
+            await run_context.flush()
+        step_responses = [results[step_number] for step_number in sorted(results)]
         logging.info(f"Step responses: {step_responses}")
         if step_responses:
             response = step_responses[-1]
         if response == None:
-            return f"Chain failed to complete, it failed on step {step_data['step']}. You can resume by starting the chain from the step that failed with chain ID {chain_run_id}."
+            failed_step = next(
+                (
+                    step_number
+                    for step_number in sorted(results)
+                    if results[step_number] is None
+                ),
+                max(steps, default=from_step),
+            )
+            return f"Chain failed to complete, it failed on step {failed_step}. You can resume by starting the chain from the step that failed with chain ID {chain_run_id}."
         self.conversation.log_interaction(role=self.agent_name, message=response)
         if "tts_provider" in self.agent_settings and voice_response:
             if (
@@ -651,20 +683,20 @@ class AGiXT:
         )
         return "I have read the information from the websites into my memory."
 
-    async def learn_spreadsheet(self, user_input, file_path):
+    async def learn_spreadsheet(self, user_input, file_path, write_to_memory=True):
         file_name = os.path.basename(file_path)
         file_type = str(file_name).split(".")[-1]
         string_file_content = ""
+        # Each sheet is written as its own document in a single bulk write
+        sheet_contents = []
         thinking_id = self.conversation.get_thinking_id(agent_name=self.agent_name)
         try:
             if file_type.lower() == "csv":
                 df = pd.read_csv(file_path)
                 csv = df.to_csv(index=False)
                 string_file_content += f"Content from file uploaded named `{file_name}`:\n```csv\n{csv}```\n"
-                return (
-                    f"Read [{file_name}]({file_path}) into memory.",
-                    string_file_content,
-                )
+                sheet_contents.append(string_file_content)
+                message = f"Read [{file_name}]({file_path}) into memory."
             else:  # Excel file
                 try:
                     xl = pd.ExcelFile(file_path)
@@ -684,23 +716,20 @@ class AGiXT:
                             message, file_content = await self.learn_spreadsheet(
                                 user_input=user_input,
                                 file_path=csv_file_path,
+                                write_to_memory=False,
                             )
                             self.conversation.log_interaction(
                                 role=self.agent_name, message=f"[ACTIVITY] {message}"
                             )
                             string_file_content += file_content
-                        return (
-                            f"Processed all sheets in [{file_name}]({file_path}).",
-                            string_file_content,
-                        )
+                            sheet_contents.append(file_content)
+                        message = f"Processed all sheets in [{file_name}]({file_path})."
                     else:
                         df = pd.read_excel(file_path)
                         csv = df.to_csv(index=False)
                         string_file_content += f"Content from file uploaded named `{file_name}`:\n```csv\n{csv}```\n"
-                        return (
-                            f"Read [{file_name}]({file_path}) into memory.",
-                            string_file_content,
-                        )
+                        sheet_contents.append(string_file_content)
+                        message = f"Read [{file_name}]({file_path}) into memory."
                 except Exception as e:
                     self.conversation.log_interaction(
                         role=self.agent_name,
@@ -710,6 +739,16 @@ class AGiXT:
                         f"Failed to read [{file_name}]({file_path}). Error: {str(e)}",
                         "",
                     )
+            if write_to_memory:
+                await self.file_reader.write_documents(
+                    {
+                        "user_input": user_input,
+                        "text": sheet_content,
+                        "external_source": f"file {file_path}",
+                    }
+                    for sheet_content in sheet_contents
+                )
+            return message, string_file_content
         except Exception as e:
             logging.error(f"Unexpected error processing spreadsheet: {e}")
             return f"Failed to process [{file_name}]({file_path}). Unexpected error: {str(e)}"
@@ -889,11 +928,6 @@ class AGiXT:
                 file_path=file_path,
             )
             file_content += content
-            await self.file_reader.write_text_to_memory(
-                user_input=user_input,
-                text=content,
-                external_source=f"file {file_path}",
-            )
         elif (
             file_type == "wav"
             or file_type == "mp3"
@@ -986,19 +1020,30 @@ class AGiXT:
                 # Check how many lines are in the file content
                 lines = content.split("\n")
                 if len(lines) > 1:
-                    for line_number, line in enumerate(lines):
-                        await self.file_reader.write_text_to_memory(
-                            user_input=user_input,
-                            text=f"Content from file uploaded named `{file_name}` at {timestamp} on line number {line_number + 1}:\n{line}",
-                            external_source=f"file {fp}",
+                    try:
+                        learned = (
+                            await self.file_reader.write_documents(
+                                {
+                                    "user_input": user_input,
+                                    "text": f"Content from file uploaded named `{file_name}` at {timestamp} on line number {line_number + 1}:\n{line}",
+                                    "external_source": f"file {fp}",
+                                }
+                                for line_number, line in enumerate(lines)
+                            )
+                            > 0
                         )
+                    except Exception:
+                        learned = False
                 else:
-                    await self.file_reader.write_text_to_memory(
+                    learned = await self.file_reader.write_text_to_memory(
                         user_input=user_input,
                         text=f"Content from file uploaded named `{file_name}` at {timestamp}:\n{content}",
                         external_source=f"file {fp}",
                     )
-                response = f"Read [{file_name}]({file_url}) into memory."
+                if learned:
+                    response = f"Read [{file_name}]({file_url}) into memory."
+                else:
+                    response = f"[ERROR] I was unable to read the file called `{file_name}` into memory."
             else:
                 response = (
                     f"[ERROR] I was unable to read the file called `{file_name}`."
@@ -1658,7 +1703,7 @@ class AGiXT:
         if log_output:
             thinking_id = c.get_thinking_id(agent_name=self.agent_name)
         file_contents = []
-        current_input_tokens = get_tokens(new_prompt)
+        token_counter = TokenCounter(new_prompt)
         for file in files:
             content = await self.learn_from_file(
                 file_url=file["file_url"],
@@ -1669,8 +1714,8 @@ class AGiXT:
             file_contents.append(content)
         if file_contents:
             file_content = "\n".join(file_contents)
-            file_tokens = get_tokens(file_content)
-            current_input_tokens = file_tokens + current_input_tokens
+            token_counter.add(file_content)
+            current_input_tokens = token_counter.total
         else:
             file_content = ""
             current_input_tokens = self.input_tokens
@@ -23,6 +23,11 @@ from contextlib import asynccontextmanager
 from Workspaces import WorkspaceManager
 from typing import Optional
 from TaskMonitor import TaskMonitor
+from MessageLog import message_log
+from UsageCounters import token_usage
+from Extensions import get_extension_registry
+from ProviderClients import close_provider_clients
+from PromptTemplates import preload_global_prompts
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -42,6 +47,9 @@ task_monitor = TaskMonitor()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     workspace_manager.start_file_watcher()
+    # Import and register every extension once before the first request needs them
+    await asyncio.to_thread(get_extension_registry)
+    await asyncio.to_thread(preload_global_prompts)
     await task_monitor.start()
 
     try:
@@ -50,12 +58,17 @@ async def lifespan(app: FastAPI):
         # Shutdown
         workspace_manager.stop_file_watcher()
         await task_monitor.stop()
+        await close_provider_clients()
+        message_log.close()
+        token_usage.close()
 
 
 # Register signal handlers for unexpected shutdowns
 async def cleanup():
     workspace_manager.stop_file_watcher()
     await task_monitor.stop()
+    message_log.close()
+    token_usage.close()
 
 
 def signal_handler(signum, frame):
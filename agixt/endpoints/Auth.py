@@ -16,6 +16,7 @@ from fastapi import APIRouter, Request, Header, Depends, HTTPException
 from MagicalAuth import MagicalAuth, verify_api_key, impersonate_user  # type: ignore
 from Agent import Agent  # type: ignore
 from typing import List, Optional
+from datetime import date
 from Globals import getenv  # type: ignore
 import logging
 import pyotp
@@ -160,6 +161,24 @@ def get_user(
     }
 
 
+@app.get(
+    "/v1/user/usage",
+    dependencies=[Depends(verify_api_key)],
+    summary="Get token usage per day, agent and provider",
+    tags=["Auth"],
+)
+def get_user_usage(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    authorization: str = Header(None),
+):
+    auth = MagicalAuth(token=authorization)
+    return {
+        **auth.get_token_counts(),
+        "usage": auth.get_token_usage(start_date=start_date, end_date=end_date),
+    }
+
+
 @app.post(
     "/v1/login",
     response_model=Detail,
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, Header
-from typing import Dict
+from fastapi.responses import StreamingResponse
+from typing import Dict, Optional
 from ApiClient import verify_api_key, get_api_client, Agent
 from Conversations import (
     Conversations,
@@ -75,12 +76,14 @@ async def get_conversations(user=Depends(verify_api_key)):
     "/v1/conversation/{conversation_id}",
     response_model=ConversationHistoryResponse,
     summary="Get Conversation History by ID",
-    description="Retrieves the complete history of a specific conversation using its ID.",
+    description="Retrieves the history of a specific conversation using its ID, `limit` messages at a time. Pass the previous page's next_cursor as cursor for the next page.",
     tags=["Conversation"],
     dependencies=[Depends(verify_api_key)],
 )
 async def get_conversation_history(
     conversation_id: str,
+    limit: int = 100,
+    cursor: Optional[str] = None,
     user=Depends(verify_api_key),
     authorization: str = Header(None),
 ):
@@ -94,19 +97,47 @@ async def get_conversation_history(
     )
     conversation_history = Conversations(
         conversation_name=conversation_name, user=user
-    ).get_conversation()
+    ).get_conversation(limit=limit, cursor=cursor)
     if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+        conversation_history = {}
+    return {
+        "conversation_history": conversation_history.get("interactions", []),
+        "next_cursor": conversation_history.get("next_cursor"),
+    }
+
+
+@app.get(
+    "/v1/conversation/{conversation_id}/export",
+    summary="Export Conversation as NDJSON",
+    description="Streams every message of the conversation, oldest first, as newline-delimited JSON objects with role, message and timestamp.",
+    tags=["Conversation"],
+    dependencies=[Depends(verify_api_key)],
+)
+async def export_conversation(
+    conversation_id: str,
+    user=Depends(verify_api_key),
+    authorization: str = Header(None),
+):
+    auth = MagicalAuth(token=authorization)
+    conversation_name = get_conversation_name_by_id(
+        conversation_id=conversation_id, user_id=auth.user_id
+    )
+    return StreamingResponse(
+        Conversations(
+            conversation_name=conversation_name, user=user
+        ).export_conversation_ndjson(),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{conversation_id}.ndjson"'
+        },
+    )
 
 
 @app.get(
     "/api/conversation",
     response_model=ConversationHistoryResponse,
     summary="Get Paginated Conversation History",
-    description="Retrieves conversation history with pagination support using limit and page parameters.",
+    description="Retrieves conversation history with pagination support using limit and page parameters, or a cursor from the previous page's next_cursor.",
     tags=["Conversation"],
     dependencies=[Depends(verify_api_key)],
 )
@@ -128,19 +159,21 @@ async def get_conversation_history(
     ).get_conversation(
         limit=history.limit,
         page=history.page,
+        cursor=history.cursor,
     )
     if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+        conversation_history = {}
+    return {
+        "conversation_history": conversation_history.get("interactions", []),
+        "next_cursor": conversation_history.get("next_cursor"),
+    }
 
 
 @app.get(
     "/api/conversation/{conversation_name}",
     response_model=ConversationHistoryResponse,
     summary="Get Conversation History by Name",
-    description="Retrieves conversation history using the conversation name with optional pagination.",
+    description="Retrieves conversation history using the conversation name with optional pagination. Pass the previous page's next_cursor as cursor to page by keyset instead of page number.",
     tags=["Conversation"],
     dependencies=[Depends(verify_api_key)],
 )
@@ -148,6 +181,7 @@ async def get_conversation_data(
     conversation_name: str,
     limit: int = 100,
     page: int = 1,
+    cursor: Optional[str] = None,
     user=Depends(verify_api_key),
     authorization: str = Header(None),
 ):
@@ -161,12 +195,13 @@ async def get_conversation_data(
         conversation_id = None
     conversation_history = Conversations(
         conversation_name=conversation_name, user=user
-    ).get_conversation(limit=limit, page=page)
+    ).get_conversation(limit=limit, page=page, cursor=cursor)
     if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+        conversation_history = {}
+    return {
+        "conversation_history": conversation_history.get("interactions", []),
+        "next_cursor": conversation_history.get("next_cursor"),
+    }
 
 
 @app.post(
@@ -236,6 +236,7 @@ class ConversationForkInput:
 class PaginationInput:
     page: int = 1
     limit: int = 100
+    cursor: Optional[str] = None
 
 
 # Pagination Info
@@ -253,6 +254,7 @@ class PageInfo:
 class ConversationDetail:
     metadata: ConversationMetadata
     messages: List[ConversationMessage]
+    next_cursor: Optional[str] = None
 
 
 @strawberry.type
@@ -1779,7 +1781,11 @@ class Query:
 
         # Get messages with pagination
         c = Conversations(user=user, conversation_name=metadata.name)
-        history_result = c.get_conversation()
+        history_result = c.get_conversation(
+            limit=pagination.limit if pagination else 100,
+            page=pagination.page if pagination else 1,
+            cursor=pagination.cursor if pagination else None,
+        )
 
         messages = [
             ConversationMessage(
@@ -1794,13 +1800,11 @@ class Query:
             for msg in history_result["interactions"]
         ]
 
-        # Apply pagination if provided
-        if pagination:
-            start_idx = (pagination.page - 1) * pagination.limit
-            end_idx = start_idx + pagination.limit
-            messages = messages[start_idx:end_idx]
-
-        return ConversationDetail(metadata=metadata, messages=messages)
+        return ConversationDetail(
+            metadata=metadata,
+            messages=messages,
+            next_cursor=history_result["next_cursor"],
+        )
 
     @strawberry.field
     async def notifications(
@@ -1,4 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+from ApiClient import verify_api_key
+from Embeddings import get_embedding_metrics, get_embedding_cache_metrics
+from IdentityCache import get_identity_cache_metrics
+from AgentConfigCache import get_agent_config_cache_metrics
+from Extensions import get_extension_registry_metrics
+from ChainPlans import get_chain_plan_cache_metrics
+from PromptTemplates import get_prompt_template_cache_metrics
+from TaskMonitor import get_task_scheduler_metrics
+from MagicalAuth import get_timezone_cache_metrics
+from VectorIndex import get_vector_index_metrics
 
 app = APIRouter()
 
@@ -6,3 +16,24 @@ app = APIRouter()
 @app.get("/health", tags=["Health"])
 async def health():
     return {"status": "UP"}
+
+
+@app.get(
+    "/health/metrics",
+    tags=["Health"],
+    dependencies=[Depends(verify_api_key)],
+    summary="Get performance metrics for this worker",
+)
+async def metrics():
+    return {
+        "embeddings": get_embedding_metrics(),
+        "embedding_cache": get_embedding_cache_metrics(),
+        "identity_cache": get_identity_cache_metrics(),
+        "agent_config_cache": get_agent_config_cache_metrics(),
+        "extension_registry": get_extension_registry_metrics(),
+        "chain_plan_cache": get_chain_plan_cache_metrics(),
+        "prompt_template_cache": get_prompt_template_cache_metrics(),
+        "task_scheduler": get_task_scheduler_metrics(),
+        "timezone_cache": get_timezone_cache_metrics(),
+        "vector_indexes": get_vector_index_metrics(),
+    }
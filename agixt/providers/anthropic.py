@@ -6,10 +6,13 @@ except ImportError:
 
     subprocess.check_call([sys.executable, "-m", "pip", "install", "anthropic"])
     import anthropic
-import httpx
 import base64
-import logging
-import time
+from ProviderClients import (
+    get_client,
+    get_http_client,
+    new_http_client,
+    request_with_retries,
+)
 
 
 # List of models available at https://docs.anthropic.com/claude/docs/models-overview
@@ -42,12 +45,37 @@ class AnthropicProvider:
         self.WAIT_BETWEEN_REQUESTS = (
             ANTHROPIC_WAIT_BETWEEN_REQUESTS if ANTHROPIC_WAIT_BETWEEN_REQUESTS else 1
         )
-        self.failures = 0
 
     @staticmethod
     def services():
         return ["llm", "vision"]
 
+    def client(self):
+        if self.GOOGLE_VERTEX_PROJECT_ID != "":
+            return get_client(
+                (
+                    "anthropic-vertex",
+                    self.GOOGLE_VERTEX_REGION,
+                    self.GOOGLE_VERTEX_PROJECT_ID,
+                    self.ANTHROPIC_API_KEY,
+                ),
+                lambda: anthropic.AsyncAnthropicVertex(
+                    access_token=self.ANTHROPIC_API_KEY,
+                    region=self.GOOGLE_VERTEX_REGION,
+                    project_id=self.GOOGLE_VERTEX_PROJECT_ID,
+                    max_retries=0,
+                    http_client=new_http_client(),
+                ),
+            )
+        return get_client(
+            ("anthropic", self.ANTHROPIC_API_KEY),
+            lambda: anthropic.AsyncAnthropic(
+                api_key=self.ANTHROPIC_API_KEY,
+                max_retries=0,
+                http_client=new_http_client(),
+            ),
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if (
             self.ANTHROPIC_API_KEY == ""
@@ -62,7 +90,8 @@ class AnthropicProvider:
             for image in images:
                 # If the image is a url, download it
                 if image.startswith("http"):
-                    image_base64 = base64.b64encode(httpx.get(image).content).decode(
+                    image_response = await get_http_client().get(image)
+                    image_base64 = base64.b64encode(image_response.content).decode(
                         "utf-8"
                     )
                 else:
@@ -92,32 +121,22 @@ class AnthropicProvider:
         else:
             messages.append({"role": "user", "content": prompt})
 
-        if self.GOOGLE_VERTEX_PROJECT_ID != "":
-            c = anthropic.AnthropicVertex(
-                access_token=self.ANTHROPIC_API_KEY,
-                region=self.GOOGLE_VERTEX_REGION,
-                project_id=self.GOOGLE_VERTEX_PROJECT_ID,
-            )
-        else:
-            c = anthropic.Client(api_key=self.ANTHROPIC_API_KEY)
-        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = c.messages.create(
+        async def request():
+            response = await self.client().messages.create(
                 messages=messages,
                 model=self.AI_MODEL,
                 max_tokens=4096,
             )
             return response.content[0].text
-        except Exception as e:
-            logging.info(f"[CLAUDE PROVIDER] Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                raise f"Claude Error: Too many failures. {e}"
-            else:
-                # https://console.anthropic.com/settings/limits
-                # Rate limits that impact AGiXT most with Anthropic API are the input tokens per minute being limited to 80k.
-                # If we hit an error, it is almost always because we exceeded this by sending 2 or more prompts in a row exceeding 80k.
-                # To get around it, we sleep for 61 seconds.
-                time.sleep(61)
-                return await self.inference(prompt=prompt, tokens=tokens, images=images)
+
+        # https://console.anthropic.com/settings/limits
+        # Rate limits that impact AGiXT most with Anthropic API are the input tokens per minute being limited to 80k.
+        # If we hit an error, it is almost always because we exceeded this by sending 2 or more prompts in a row exceeding 80k.
+        # To get around it, we back off for about a minute unless the API says how long to wait.
+        return await request_with_retries(
+            name="Claude",
+            key=("anthropic", self.GOOGLE_VERTEX_PROJECT_ID),
+            request=request,
+            wait_between_requests=int(self.WAIT_BETWEEN_REQUESTS),
+            wait_after_failure=61,
+        )
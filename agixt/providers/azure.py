@@ -1,6 +1,5 @@
-from openai import AzureOpenAI
-import logging
-import time
+from openai import AsyncAzureOpenAI
+from ProviderClients import get_client, new_http_client, request_with_retries
 
 
 class AzureProvider:
@@ -34,21 +33,27 @@ class AzureProvider:
         self.WAIT_BETWEEN_REQUESTS = (
             AZURE_WAIT_BETWEEN_REQUESTS if AZURE_WAIT_BETWEEN_REQUESTS else 1
         )
-        self.failures = 0
 
     @staticmethod
     def services():
         return ["llm", "vision"]
 
+    def client(self) -> AsyncAzureOpenAI:
+        return get_client(
+            ("azure", self.AZURE_OPENAI_ENDPOINT, self.AI_MODEL, self.AZURE_API_KEY),
+            lambda: AsyncAzureOpenAI(
+                api_key=self.AZURE_API_KEY,
+                api_version="2024-02-01",
+                azure_endpoint=self.AZURE_OPENAI_ENDPOINT,
+                azure_deployment=self.AI_MODEL,
+                max_retries=0,
+                http_client=new_http_client(),
+            ),
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if not self.AZURE_OPENAI_ENDPOINT.endswith("/"):
             self.AZURE_OPENAI_ENDPOINT += "/"
-        openai = AzureOpenAI(
-            api_key=self.AZURE_API_KEY,
-            api_version="2024-02-01",
-            azure_endpoint=self.AZURE_OPENAI_ENDPOINT,
-            azure_deployment=self.AI_MODEL,
-        )
         if self.AZURE_API_KEY == "" or self.AZURE_API_KEY == "YOUR_API_KEY":
             if self.AZURE_OPENAI_ENDPOINT == "https://your-endpoint.openai.azure.com":
                 return "Please go to the Agent Management page to set your Azure OpenAI API key."
@@ -81,10 +86,9 @@ class AzureProvider:
                     )
         else:
             messages.append({"role": "user", "content": prompt})
-        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
+
+        async def request():
+            response = await self.client().chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -94,12 +98,11 @@ class AzureProvider:
                 stream=False,
             )
             return response.choices[0].message.content
-        except Exception as e:
-            logging.warning(f"Azure OpenAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                raise f"Azure OpenAI API Error: Too many failures. {e}"
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+
+        return await request_with_retries(
+            name="Azure OpenAI",
+            key=("azure", self.AZURE_OPENAI_ENDPOINT, self.AI_MODEL),
+            request=request,
+            wait_between_requests=int(self.WAIT_BETWEEN_REQUESTS),
+            wait_after_failure=int(self.WAIT_AFTER_FAILURE),
+        )
@@ -1,5 +1,4 @@
-import time
-import logging
+from ProviderClients import get_client, new_http_client, request_with_retries
 
 try:
     import openai
@@ -46,8 +45,6 @@ class DeepseekProvider:
             DEEPSEEK_WAIT_BETWEEN_REQUESTS if DEEPSEEK_WAIT_BETWEEN_REQUESTS else 1
         )
         self.DEEPSEEK_API_KEY = DEEPSEEK_API_KEY
-        self.FAILURES = []
-        self.failures = 0
 
     @staticmethod
     def services():
@@ -56,10 +53,20 @@ class DeepseekProvider:
             "vision",
         ]
 
+    def client(self) -> openai.AsyncOpenAI:
+        base_url = self.API_URI if self.API_URI else "https://api.deepseek.com/"
+        api_key = self.DEEPSEEK_API_KEY
+        return get_client(
+            ("deepseek", base_url, api_key),
+            lambda: openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=new_http_client(),
+            ),
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.deepseek.com/"
-        openai.api_key = self.DEEPSEEK_API_KEY
-        openai.api_type = "openai"
         messages = []
         if len(images) > 0:
             messages.append(
@@ -90,10 +97,8 @@ class DeepseekProvider:
         else:
             messages.append({"role": "user", "content": prompt})
 
-        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
+        async def request():
+            response = await self.client().chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -103,12 +108,11 @@ class DeepseekProvider:
                 stream=False,
             )
             return response.choices[0].message.content
-        except Exception as e:
-            logging.info(f"Deepseek API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                raise f"Deepseek API Error: Too many failures. {e}"
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+
+        return await request_with_retries(
+            name="Deepseek",
+            key=("deepseek", self.API_URI),
+            request=request,
+            wait_between_requests=int(self.WAIT_BETWEEN_REQUESTS),
+            wait_after_failure=int(self.WAIT_AFTER_FAILURE),
+        )
@@ -1,10 +1,11 @@
-import requests
-import time
+import asyncio
+import random
 import logging
 import uuid
 import base64
 import io
 from PIL import Image
+from ProviderClients import get_http_client, provider_slot, retry_after
 
 
 class HuggingfaceProvider:
@@ -72,21 +73,24 @@ class HuggingfaceProvider:
             tries += 1
             if int(tries) > int(self.MAX_RETRIES):
                 raise ValueError(f"Reached max retries: {self.MAX_RETRIES}")
-            response = requests.post(
-                self.HUGGINGFACE_API_URL,
-                json=payload,
-                headers=headers,
-            )
+            async with provider_slot(("huggingface", self.HUGGINGFACE_API_URL)):
+                response = await get_http_client().post(
+                    self.HUGGINGFACE_API_URL,
+                    json=payload,
+                    headers=headers,
+                )
+            # Jittered so concurrent requests that were limited together don't retry together
+            wait = retry_after(response) or random.uniform(tries / 2, tries)
             if response.status_code == 429:
                 logging.info(
-                    f"Server Error {response.status_code}: Getting rate-limited / wait for {tries} seconds."
+                    f"Server Error {response.status_code}: Getting rate-limited / wait for {wait:.1f} seconds."
                 )
-                time.sleep(tries)
+                await asyncio.sleep(wait)
             elif response.status_code >= 500:
                 logging.info(
-                    f"Server Error {response.status_code}: {response.json()['error']} / wait for {tries} seconds"
+                    f"Server Error {response.status_code}: {response.json()['error']} / wait for {wait:.1f} seconds"
                 )
-                time.sleep(tries)
+                await asyncio.sleep(wait)
             elif response.status_code != 200:
                 raise ValueError(f"Error {response.status_code}: {response.text}")
             else:
@@ -181,11 +185,12 @@ class HuggingfaceProvider:
                 "width": width if width else 1920,
             }
         try:
-            response = requests.post(
-                self.STABLE_DIFFUSION_API_URL,
-                headers=headers,
-                json=generation_settings,  # Use the 'json' parameter instead
-            )
+            async with provider_slot(("huggingface", self.STABLE_DIFFUSION_API_URL)):
+                response = await get_http_client().post(
+                    self.STABLE_DIFFUSION_API_URL,
+                    headers=headers,
+                    json=generation_settings,  # Use the 'json' parameter instead
+                )
             if self.HUGGINGFACE_API_KEY != "":
                 image_data = response.content
             else:
@@ -1,9 +1,13 @@
-import time
 import logging
 import random
-import requests
 import uuid
 from Globals import getenv
+from ProviderClients import (
+    get_client,
+    get_http_client,
+    new_http_client,
+    request_with_retries,
+)
 import numpy as np
 
 try:
@@ -16,6 +20,10 @@ except ImportError:
     import openai
 
 
+# Thread-safe clients for the synchronous embeddings path, keyed by base URL and key
+SYNC_CLIENTS = {}
+
+
 class OpenaiProvider:
     """
     This provider uses the OpenAI API to generate text from prompts. Get your OpenAI API key at <https://platform.openai.com/account/api-keys>.
@@ -55,7 +63,6 @@ class OpenaiProvider:
             OPENAI_TRANSCRIPTION_MODEL if OPENAI_TRANSCRIPTION_MODEL else "whisper-1"
         )
         self.FAILURES = []
-        self.failures = 0
         self.chunk_size = 1024
 
     @staticmethod
@@ -76,18 +83,40 @@ class OpenaiProvider:
         for uri in uri_list:
             if uri not in self.FAILURES:
                 self.API_URI = uri
-                openai.base_url = self.API_URI
                 break
 
+    def base_url(self):
+        base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
+        return base_url if base_url.endswith("/") else f"{base_url}/"
+
+    def client(self) -> openai.AsyncOpenAI:
+        """Pooled async client for this endpoint and key, never the shared module client"""
+        base_url = self.base_url()
+        api_key = self.OPENAI_API_KEY if self.OPENAI_API_KEY else "none"
+        return get_client(
+            ("openai", base_url, api_key),
+            lambda: openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=new_http_client(),
+            ),
+        )
+
+    def sync_client(self) -> openai.OpenAI:
+        base_url = self.base_url()
+        api_key = self.OPENAI_API_KEY if self.OPENAI_API_KEY else "none"
+        key = (base_url, api_key)
+        if key not in SYNC_CLIENTS:
+            SYNC_CLIENTS[key] = openai.OpenAI(api_key=api_key, base_url=base_url)
+        return SYNC_CLIENTS[key]
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if images != []:
             if "vision" not in self.AI_MODEL and self.AI_MODEL != "gpt-4o":
                 self.AI_MODEL = "gpt-4o"
         if not self.API_URI.endswith("/"):
             self.API_URI += "/"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         if self.OPENAI_API_KEY == "" or self.OPENAI_API_KEY == "YOUR_OPENAI_API_KEY":
             if self.API_URI == "https://api.openai.com/v1/":
                 return (
@@ -123,56 +152,47 @@ class OpenaiProvider:
         else:
             messages.append({"role": "user", "content": prompt})
 
-        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
-                model=self.AI_MODEL,
-                messages=messages,
-                temperature=float(self.AI_TEMPERATURE),
-                max_tokens=4096,
-                top_p=float(self.AI_TOP_P),
-                n=1,
-                stream=False,
-            )
+        async def request():
+            try:
+                response = await self.client().chat.completions.create(
+                    model=self.AI_MODEL,
+                    messages=messages,
+                    temperature=float(self.AI_TEMPERATURE),
+                    max_tokens=4096,
+                    top_p=float(self.AI_TOP_P),
+                    n=1,
+                    stream=False,
+                )
+            except Exception:
+                if "," in self.API_URI:
+                    self.rotate_uri()
+                raise
             return response.choices[0].message.content
-        except Exception as e:
-            logging.info(f"OpenAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                raise f"OpenAI API Error: Too many failures. {e}"
-            if "," in self.API_URI:
-                self.rotate_uri()
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+
+        return await request_with_retries(
+            name="OpenAI",
+            key=("openai", self.API_URI),
+            request=request,
+            wait_between_requests=int(self.WAIT_BETWEEN_REQUESTS),
+            wait_after_failure=int(self.WAIT_AFTER_FAILURE),
+        )
 
     async def transcribe_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            transcription = openai.audio.transcriptions.create(
+            transcription = await self.client().audio.transcriptions.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return transcription.text
 
     async def translate_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            translation = openai.audio.translations.create(
+            translation = await self.client().audio.translations.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return translation.text
 
     async def text_to_speech(self, text: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
-        tts_response = openai.audio.speech.create(
+        tts_response = await self.client().audio.speech.create(
             model="tts-1",
             voice=self.VOICE,
             input=text,
@@ -182,10 +202,7 @@ class OpenaiProvider:
     async def generate_image(self, prompt: str) -> str:
         filename = f"{uuid.uuid4()}.png"
         image_path = f"./WORKSPACE/{filename}"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
-        response = openai.images.generate(
+        response = await self.client().images.generate(
             prompt=prompt,
             model="dall-e-3",
             n=1,
@@ -195,15 +212,12 @@ class OpenaiProvider:
         logging.info(f"Image Generated for prompt:{prompt}")
         url = response.data[0].url
         with open(image_path, "wb") as f:
-            f.write(requests.get(url).content)
+            f.write((await get_http_client().get(url)).content)
         agixt_uri = getenv("AGIXT_URI")
         return f"{agixt_uri}/outputs/{filename}"
 
     def embeddings(self, input) -> np.ndarray:
-        openai.base_url = self.API_URI
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
-        response = openai.embeddings.create(
+        response = self.sync_client().embeddings.create(
             input=input,
             model="text-embedding-3-small",
         )
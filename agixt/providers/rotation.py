@@ -1,7 +1,7 @@
 import logging
 from Providers import get_providers, Providers
 from typing import List, Dict, Any
-from Globals import getenv
+from Globals import getenv, estimate_tokens, get_tokens
 
 
 class RotationProvider:
@@ -107,6 +107,12 @@ class RotationProvider:
         # Get provider token limits
         provider_max_tokens = self._get_provider_token_limits()
 
+        if tokens <= 0 and prompt and provider_max_tokens:
+            # An upper bound is enough when it already fits the smallest limit
+            tokens = estimate_tokens(prompt)
+            if tokens > min(provider_max_tokens.values()):
+                tokens = get_tokens(prompt)
+
         # Filter providers that can handle the token count
         if tokens > 0:
             suitable_providers = self._filter_suitable_providers(
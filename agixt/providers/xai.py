@@ -1,5 +1,4 @@
-import time
-import logging
+from ProviderClients import get_client, new_http_client, request_with_retries
 
 try:
     import openai
@@ -45,8 +44,6 @@ class XaiProvider:
             XAI_WAIT_BETWEEN_REQUESTS if XAI_WAIT_BETWEEN_REQUESTS else 1
         )
         self.XAI_API_KEY = XAI_API_KEY
-        self.FAILURES = []
-        self.failures = 0
 
     @staticmethod
     def services():
@@ -55,10 +52,20 @@ class XaiProvider:
             "vision",
         ]
 
+    def client(self) -> openai.AsyncOpenAI:
+        base_url = self.API_URI if self.API_URI else "https://api.x.ai/v1/"
+        api_key = f"Bearer {self.XAI_API_KEY}"
+        return get_client(
+            ("xai", base_url, api_key),
+            lambda: openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=new_http_client(),
+            ),
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.x.ai/v1/"
-        openai.api_key = f"Bearer {self.XAI_API_KEY}"
-        openai.api_type = "openai"
         messages = []
         if len(images) > 0:
             messages.append(
@@ -89,10 +96,8 @@ class XaiProvider:
         else:
             messages.append({"role": "user", "content": prompt})
 
-        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
+        async def request():
+            response = await self.client().chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -102,12 +107,11 @@ class XaiProvider:
                 stream=False,
             )
             return response.choices[0].message.content
-        except Exception as e:
-            logging.info(f"xAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                raise f"xAI API Error: Too many failures. {e}"
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+
+        return await request_with_retries(
+            name="xAI",
+            key=("xai", self.API_URI),
+            request=request,
+            wait_between_requests=int(self.WAIT_BETWEEN_REQUESTS),
+            wait_after_failure=int(self.WAIT_AFTER_FAILURE),
+        )
@@ -0,0 +1,128 @@
+"""
+Embedding benchmark: fixed-length padding against length-bucketed batches.
+
+Embeds the same texts the way embed() used to, with every input padded to
+EMBEDDING_MAX_LENGTH tokens and batched in input order, and through
+EmbeddingEngine.embed_bucketed. Reports vectors/sec for both and fails if the
+vectors are not numerically equivalent.
+
+Run from the repository root with the ONNX model in agixt/onnx:
+
+    python tests/benchmark_embeddings.py --texts 2000 --repeat 3
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+AGIXT_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agixt"
+)
+sys.path.insert(0, AGIXT_DIRECTORY)
+os.chdir(AGIXT_DIRECTORY)
+
+from tokenizers import Tokenizer
+from Embeddings import EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_LENGTH, EmbeddingEngine
+
+WORDS = (
+    "the agent reads a memory chunk and answers the user about files tasks chains "
+    "prompts providers conversations embeddings vectors search results context "
+    "schedule follow up summary notes meeting project budget deadline report code "
+    "python function database query index latency throughput worker request"
+).split()
+
+
+def sample_texts(count: int, seed: int = 0) -> list:
+    """Short queries and long memory chunks, like the texts embed() sees"""
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            length = rng.randint(3, 20)
+        else:
+            length = int(np.exp(rng.uniform(np.log(20), np.log(400))))
+        texts.append(" ".join(rng.choice(WORDS) for _ in range(length)))
+    return texts
+
+
+def fixed_padding_tokenizer(engine: EmbeddingEngine) -> Tokenizer:
+    tokenizer = Tokenizer.from_str(engine.tokenizer.to_str())
+    tokenizer.enable_truncation(max_length=EMBEDDING_MAX_LENGTH)
+    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=EMBEDDING_MAX_LENGTH)
+    return tokenizer
+
+
+def embed_fixed_padding(
+    engine: EmbeddingEngine, tokenizer: Tokenizer, texts: list
+) -> np.ndarray:
+    """The previous embed(): batches in input order, every input padded to full length"""
+    batches = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        encoded = tokenizer.encode_batch(texts[i : i + EMBEDDING_BATCH_SIZE])
+        batches.append(engine.run_encodings(encoded))
+    return np.concatenate(batches)
+
+
+def measure(embed, texts: list, repeat: int):
+    """Best wall time of `repeat` runs and the vectors of the last one"""
+    best = float("inf")
+    vectors = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vectors = embed(texts)
+        best = min(best, time.perf_counter() - start)
+    return best, vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--texts", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--model-directory", default=None)
+    args = parser.parse_args()
+
+    model_directory = args.model_directory or os.path.join(AGIXT_DIRECTORY, "onnx")
+    if not os.path.exists(os.path.join(model_directory, "model.onnx")):
+        print(f"No model.onnx in {model_directory}, nothing to benchmark.")
+        sys.exit(2)
+    engine = EmbeddingEngine(model_directory)
+    tokenizer = fixed_padding_tokenizer(engine)
+    texts = sample_texts(args.texts)
+    lengths = [len(e.ids) for e in engine.tokenizer.encode_batch(texts)]
+    print(
+        f"{len(texts)} texts, {np.mean(lengths):.0f} tokens on average "
+        f"(median {np.median(lengths):.0f}, max {max(lengths)})"
+    )
+
+    fixed_seconds, fixed = measure(
+        lambda batch: embed_fixed_padding(engine, tokenizer, batch),
+        texts,
+        args.repeat,
+    )
+    bucketed_seconds, bucketed = measure(engine.embed_bucketed, texts, args.repeat)
+
+    print(
+        f"fixed {EMBEDDING_MAX_LENGTH}-token padding: {len(texts) / fixed_seconds:10.1f} vectors/sec"
+    )
+    print(
+        f"length-bucketed batches:  {len(texts) / bucketed_seconds:10.1f} vectors/sec"
+    )
+    print(f"speedup: {fixed_seconds / bucketed_seconds:.2f}x")
+
+    difference = float(np.max(np.abs(fixed - bucketed)))
+    cosine = float(np.min(np.sum(fixed * bucketed, axis=1)))
+    print(f"max abs difference {difference:.2e}, min cosine similarity {cosine:.6f}")
+    if fixed.shape != bucketed.shape or not np.allclose(
+        fixed, bucketed, atol=args.atol
+    ):
+        print(f"FAIL: embeddings differ by more than {args.atol}")
+        sys.exit(1)
+    print("OK: embeddings are numerically equivalent")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Token accounting microbenchmark for Globals.get_tokens, TokenCounter and
+estimate_tokens.
+
+Compares the previous get_tokens, which looked up the cl100k_base encoding on
+every call, with the cached encoder and memoized counts, and re-counting a growing
+prompt after every section with TokenCounter's running total. Fails if
+estimate_tokens is ever below get_tokens on the sample texts, since the rotation
+provider relies on it as an upper bound.
+
+Run from the repository root (tiktoken must be able to load cl100k_base):
+
+    python tests/benchmark_tokens.py --repeat 200
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+AGIXT_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agixt"
+)
+sys.path.insert(0, AGIXT_DIRECTORY)
+os.chdir(AGIXT_DIRECTORY)
+
+import tiktoken
+from Globals import TokenCounter, estimate_tokens, get_encoding, get_tokens
+
+
+def previous_get_tokens(text: str) -> int:
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text))
+
+
+def sample_texts() -> dict:
+    """Prompts shipped with the repo plus text that tokenizes unusually"""
+    texts = {}
+    for path in sorted(
+        glob.glob(os.path.join("prompts", "**", "*.txt"), recursive=True)
+    ):
+        with open(path, "r", encoding="utf-8") as f:
+            texts[os.path.relpath(path, "prompts")] = f.read()
+    with open(__file__, "r", encoding="utf-8") as f:
+        texts["python source"] = f.read()
+    texts["json"] = json.dumps(
+        {
+            "memories": [
+                {"id": i, "text": f"note {i}", "score": i / 7} for i in range(200)
+            ]
+        }
+    )
+    texts["chinese"] = (
+        "记忆检索需要在上下文窗口内完成，代理会总结对话并安排后续任务。" * 40
+    )
+    texts["japanese"] = "エージェントは会話を要約し、次のタスクを予定します。" * 40
+    texts["emoji"] = "🚀✨🤖👍🏽 " * 200
+    texts["accents"] = "Résumé naïve façade coöperate déjà vu " * 100
+    texts["whitespace"] = ("    \n\t  " * 300) + "end"
+    texts["digits"] = "31415926535897932384626433832795028841971693993751" * 40
+    texts["repeated characters"] = "a" * 5000 + "=" * 5000
+    texts["empty"] = ""
+    return texts
+
+
+def timed(function, repeat: int) -> float:
+    """Microseconds per call, best of three rounds of `repeat` calls"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    try:
+        get_encoding()
+    except Exception as e:
+        print(f"Unable to load the cl100k_base encoding, nothing to benchmark: {e}")
+        sys.exit(2)
+
+    texts = sample_texts()
+    failures = []
+    for name, text in texts.items():
+        tokens, estimate = get_tokens(text), estimate_tokens(text)
+        if tokens != previous_get_tokens(text):
+            failures.append(f"{name}: get_tokens changed the count")
+        if estimate < tokens:
+            failures.append(f"{name}: estimate {estimate} < {tokens} tokens")
+    print(f"estimate_tokens >= get_tokens on {len(texts)} sample texts")
+
+    short = "What is on my schedule for tomorrow?"
+    context = "\n".join(text for text in texts.values() if text)[:20000]
+    print(f"\n{'':36} {'previous us':>12} {'now us':>10} {'speedup':>8}")
+    for label, text in [
+        ("short query", short),
+        ("20k context, memoized", context),
+    ]:
+        previous = timed(lambda: previous_get_tokens(text), args.repeat)
+        now = timed(lambda: get_tokens(text), args.repeat)
+        print(
+            f"get_tokens, {label:24} {previous:>12.1f} {now:>10.2f} {previous / now:>7.0f}x"
+        )
+
+    sections = [text for text in texts.values() if text][:12]
+
+    def recount_joined():
+        prompt = ""
+        for section in sections:
+            prompt += section
+            previous_get_tokens(prompt)
+
+    def running_total():
+        counter = TokenCounter()
+        for section in sections:
+            counter.add(section)
+            int(counter)
+
+    previous = timed(recount_joined, max(args.repeat // 20, 1))
+    now = timed(running_total, max(args.repeat // 20, 1))
+    print(
+        f"budget check after {len(sections)} appends {'':4} {previous:>12.1f} "
+        f"{now:>10.2f} {previous / now:>7.0f}x"
+    )
+    tokenize = timed(lambda: len(get_encoding().encode_ordinary(context)), args.repeat)
+    estimate = timed(lambda: estimate_tokens(context), args.repeat)
+    print(
+        f"estimate_tokens vs tokenizing context {tokenize:>12.1f} "
+        f"{estimate:>10.2f} {tokenize / estimate:>7.0f}x"
+    )
+
+    if failures:
+        print("\nFAIL:\n" + "\n".join(failures))
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
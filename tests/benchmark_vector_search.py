@@ -0,0 +1,199 @@
+"""
+Memory search benchmark: per-row similarity against the batched vector index.
+
+For each collection size, builds a MemoryVectorIndex over clustered synthetic
+embeddings and reports query latency of the previous per-row path
+(calculate_vector_similarity over every row, then a full sort), of single and
+batched index searches, and recall@k of the index against exact scoring.
+Collections of VECTOR_INDEX_IVF_MIN_SIZE rows or more are searched through the
+approximate IVF lists, smaller ones exhaustively.
+
+Run from the repository root:
+
+    python tests/benchmark_vector_search.py --sizes 10000,100000,1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+AGIXT_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agixt"
+)
+sys.path.insert(0, AGIXT_DIRECTORY)
+os.chdir(AGIXT_DIRECTORY)
+os.environ.setdefault("DATABASE_TYPE", "sqlite")
+
+from DB import calculate_vector_similarity
+from VectorIndex import (
+    IVF_MIN_SIZE,
+    IVF_NPROBE,
+    MemoryVectorIndex,
+    normalize_vectors,
+    top_k_similarities,
+)
+
+CHUNK_SIZE = 50000
+
+
+class SyntheticCollection:
+    """
+    Clustered embeddings generated chunk by chunk from a seed, so a million rows
+    can be scanned again without being held in memory twice.
+    """
+
+    def __init__(
+        self, size: int, dimension: int, clusters: int, noise: float, seed: int = 0
+    ):
+        self.size = size
+        self.dimension = dimension
+        self.noise = noise
+        self.seed = seed
+        self.centers = np.random.default_rng(seed).standard_normal(
+            (clusters, dimension), dtype=np.float32
+        )
+
+    def sample(self, rng, count: int) -> np.ndarray:
+        clusters = rng.integers(0, len(self.centers), count)
+        noise = rng.standard_normal((count, self.dimension), dtype=np.float32)
+        return self.centers[clusters] + self.noise * noise
+
+    def chunks(self):
+        for number, start in enumerate(range(0, self.size, CHUNK_SIZE)):
+            count = min(CHUNK_SIZE, self.size - start)
+            rng = np.random.default_rng([self.seed, number + 1])
+            yield start, self.sample(rng, count)
+
+    def queries(self, count: int) -> np.ndarray:
+        return self.sample(np.random.default_rng([self.seed, 0]), count)
+
+
+def exact_top_k(collection: SyntheticCollection, queries: np.ndarray, limit: int):
+    """Ids of the true `limit` nearest rows of each query, by exhaustive scoring"""
+    queries = normalize_vectors(queries)
+    best = [(np.empty(0, dtype=np.int64), np.empty(0)) for _ in queries]
+    for start, vectors in collection.chunks():
+        matches = top_k_similarities(queries, normalize_vectors(vectors), limit)
+        for number, (rows, scores) in enumerate(matches):
+            ids = np.concatenate([best[number][0], rows + start])
+            merged = np.concatenate([best[number][1], scores])
+            keep = np.argsort(-merged)[:limit]
+            best[number] = (ids[keep], merged[keep])
+    return [set(ids.tolist()) for ids, _ in best]
+
+
+def per_row_search(collection: SyntheticCollection, query, limit: int):
+    """The previous get_similar_memories scoring, minus the database read"""
+    scores = []
+    for start, vectors in collection.chunks():
+        for row, embedding in enumerate(vectors):
+            scores.append((start + row, calculate_vector_similarity(query, embedding)))
+    scores.sort(key=lambda x: x[1], reverse=True)
+    return scores[:limit]
+
+
+def build_index(collection: SyntheticCollection) -> MemoryVectorIndex:
+    index = MemoryVectorIndex()
+    for start, vectors in collection.chunks():
+        index.add(list(range(start, start + len(vectors))), vectors, train=False)
+    index._maybe_train()
+    return index
+
+
+def benchmark(size: int, args) -> dict:
+    collection = SyntheticCollection(size, args.dimension, args.clusters, args.noise)
+    queries = collection.queries(args.queries)
+
+    start = time.perf_counter()
+    index = build_index(collection)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [index.search(query, args.k, -1.0) for query in queries]
+    single_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    batched = index.search_many(queries, args.k, -1.0)
+    batched_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    old_queries = queries[: args.old_queries]
+    start = time.perf_counter()
+    old = [per_row_search(collection, query, args.k) for query in old_queries]
+    old_ms = (time.perf_counter() - start) * 1000 / max(len(old_queries), 1)
+
+    truth = exact_top_k(collection, queries, args.k)
+    recall = np.mean(
+        [
+            len(truth[number] & {memory_id for memory_id, _ in results}) / args.k
+            for number, results in enumerate(single)
+        ]
+    )
+    old_recall = np.mean(
+        [
+            len(truth[number] & {row for row, _ in results}) / args.k
+            for number, results in enumerate(old)
+        ]
+    )
+    assert all(
+        [memory_id for memory_id, _ in a] == [memory_id for memory_id, _ in b]
+        for a, b in zip(single, batched)
+    ), "batched search returned different results than single searches"
+    return {
+        "size": size,
+        "mode": "ivf" if index.centroids is not None else "flat",
+        "build_seconds": build_seconds,
+        "old_ms": old_ms,
+        "single_ms": single_ms,
+        "batched_ms": batched_ms,
+        "recall": recall,
+        "old_recall": old_recall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=256)
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=1.0,
+        help="spread of each cluster relative to the distance between clusters",
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument(
+        "--old-queries",
+        type=int,
+        default=3,
+        help="queries timed on the per-row path, which takes seconds per query at 1M rows",
+    )
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    print(
+        f"dimension {args.dimension}, {args.clusters} clusters, noise {args.noise}, "
+        f"k={args.k}, {args.queries} queries, "
+        f"IVF from {IVF_MIN_SIZE} rows with nprobe={IVF_NPROBE}"
+    )
+    print(
+        f"{'rows':>9} {'mode':>5} {'build s':>8} {'per-row ms':>11} "
+        f"{'index ms':>9} {'batched ms':>11} {'speedup':>8} {'recall@k':>9}"
+    )
+    for size in [int(size) for size in args.sizes.split(",")]:
+        result = benchmark(size, args)
+        print(
+            f"{result['size']:>9} {result['mode']:>5} {result['build_seconds']:>8.2f} "
+            f"{result['old_ms']:>11.2f} {result['single_ms']:>9.3f} "
+            f"{result['batched_ms']:>11.3f} "
+            f"{result['old_ms'] / result['single_ms']:>7.0f}x "
+            f"{result['recall']:>9.3f}"
+        )
+        if result["old_recall"] < 1.0:
+            print(f"  per-row path recall {result['old_recall']:.3f}")
+
+
+if __name__ == "__main__":
+    main()